@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018-2021 The Pastel Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+#
+# Parallel runner for the rpc-tests.sh test groups.
+#
+# The groups are read from rpc-tests.sh so both runners stay in sync. Tests
+# are started longest-first, using the durations recorded by earlier runs,
+# on --jobs job slots. Every slot gets its own PORT_SEED, which keeps the
+# p2p/rpc/zmq ports of tests running side by side apart (see
+# test_framework.util.port_seed).
+#
+
+import argparse
+import json
+import os
+import queue
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GROUPS = ['testScripts', 'testScriptsExt', 'testScriptsMN']
+
+sys.path.insert(0, os.path.join(CURDIR, '..', 'rpc-tests'))
+from test_framework.util import MAX_NODES, PORT_RANGE
+
+MAX_JOBS = PORT_RANGE // MAX_NODES
+
+def read_config(path):
+    """Variables assigned in tests-config.sh; disabled features are comments."""
+    config = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r'^(\w+)="?([^"]*)"?$', line.strip())
+            if m:
+                config[m.group(1)] = re.sub(r'\$\{?(\w+)\}?',
+                    lambda v: config.get(v.group(1), ''), m.group(2))
+    return config
+
+def read_groups(path, config):
+    """Test script arrays declared in rpc-tests.sh, without commented out entries."""
+    with open(path) as f:
+        text = f.read()
+    groups = {}
+    for name, body in re.findall(r'^declare -a (\w+)=\((.*?)^\)', text, re.M | re.S):
+        groups[name] = re.findall(r"^\s*'([^']+)'", body, re.M)
+    if config.get('ENABLE_PROTON') == '1':
+        groups['testScripts'].append('proton_test.py')
+    return groups
+
+def format_time(secs):
+    return '%02d:%02d:%06.3f' % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+class TestResult(object):
+    def __init__(self, name, group):
+        self.name = name
+        self.group = group
+        self.slot = None
+        self.returncode = None
+        self.duration = 0.0
+        self.output = ''
+
+    @property
+    def passed(self):
+        return self.returncode == 0
+
+class TestRunner(object):
+    def __init__(self, builddir, jobs, test_params, tmpdir=None):
+        self.builddir = builddir
+        self.jobs = jobs
+        self.test_params = test_params
+        self.tmpdir = tmpdir
+        self.slots = queue.Queue()
+        for slot in range(jobs):
+            self.slots.put(slot)
+        self.env = dict(os.environ)
+        self.env['PASTELCLI'] = os.path.join(builddir, 'qa', 'pull-tester', 'run-pastel-cli')
+
+    def command(self, name):
+        # entries may carry script options, e.g. 'txn_doublespend.py --mineblock'
+        args = shlex.split(name)
+        script = os.path.splitext(args[0])[0] + '.py'
+        cmd = [os.path.join(self.builddir, 'qa', 'rpc-tests', script)] + args[1:]
+        cmd.append('--srcdir=' + os.path.join(self.builddir, 'src'))
+        if self.tmpdir is not None:
+            cmd.append('--tmpdir=' + os.path.join(self.tmpdir, re.sub(r'[^\w.-]+', '_', name)))
+        return cmd + self.test_params
+
+    def run(self, result):
+        slot = self.slots.get()
+        try:
+            result.slot = slot
+            env = dict(self.env, PORT_SEED=str(slot))
+            print('=== Running testscript %s [job %d] ===' % (result.name, slot), flush=True)
+            with tempfile.TemporaryFile(mode='w+') as log:
+                time_start = time.time()
+                try:
+                    result.returncode = subprocess.call(self.command(result.name), env=env,
+                        stdout=log, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    result.returncode = 127
+                    log.write('%s\n' % e)
+                result.duration = time.time() - time_start
+                log.seek(0)
+                result.output = log.read()
+        finally:
+            self.slots.put(slot)
+        if result.passed:
+            print('--- Success: %s --- | exectime: %s' % (result.name, format_time(result.duration)), flush=True)
+        else:
+            print('!!! FAIL: %s !!! | exectime: %s\n%s' % (result.name, format_time(result.duration), result.output), flush=True)
+        return result
+
+    def run_all(self, tests):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(self.run, tests))
+
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_durations(path, durations, results):
+    for result in results:
+        if result.passed:
+            durations[result.name] = round(result.duration, 3)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def write_json_report(path, results, elapsed, jobs):
+    report = {
+        'jobs': jobs,
+        'time': round(elapsed, 3),
+        'tests': [{
+            'name': r.name,
+            'group': r.group,
+            'status': 'passed' if r.passed else 'failed',
+            'returncode': r.returncode,
+            'duration': round(r.duration, 3),
+            'job': r.slot,
+        } for r in results],
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def write_junit_report(path, results, elapsed):
+    failures = [r for r in results if not r.passed]
+    suites = ET.Element('testsuites', tests=str(len(results)),
+        failures=str(len(failures)), time='%.3f' % elapsed)
+    suite = ET.SubElement(suites, 'testsuite', name='rpc-tests', tests=str(len(results)),
+        failures=str(len(failures)), time='%.3f' % sum(r.duration for r in results))
+    for r in results:
+        case = ET.SubElement(suite, 'testcase', classname=r.group, name=r.name,
+            time='%.3f' % r.duration)
+        if not r.passed:
+            ET.SubElement(case, 'failure', message='exit code %d' % r.returncode)
+            ET.SubElement(case, 'system-out').text = r.output
+    ET.ElementTree(suites).write(path, encoding='utf-8', xml_declaration=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Pastel RPC-test parallel runner',
+        epilog='Unknown options are passed to every test script as is.')
+    parser.add_argument('-g', '--group', action='append', default=[],
+        help='Test script group to run, may be repeated (default: %s)' % ' '.join(DEFAULT_GROUPS))
+    parser.add_argument('-n', '--name', action='append', default=[],
+        help='Test script to run, may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=min(os.cpu_count() or 1, MAX_JOBS),
+        help='Number of tests to run in parallel (default: %%(default)s, max: %d)' % MAX_JOBS)
+    parser.add_argument('--tmpdir', help='Root directory for the temp data dirs of all tests')
+    parser.add_argument('--durations', help='Recorded test durations used for scheduling'
+        ' (default: BUILDDIR/qa/pull-tester/rpc-test-durations.json)')
+    parser.add_argument('--junit', help='Write a JUnit XML report to this file')
+    parser.add_argument('--json', help='Write a JSON timing report to this file')
+    args, test_params = parser.parse_known_args()
+
+    if not 1 <= args.jobs <= MAX_JOBS:
+        parser.error('--jobs must be between 1 and %d' % MAX_JOBS)
+
+    config = read_config(os.path.join(CURDIR, 'tests-config.sh'))
+    if not all(config.get(k) == '1' for k in ('ENABLE_PASTELD', 'ENABLE_UTILS', 'ENABLE_WALLET')):
+        print('No rpc tests to run. Wallet, utils, and pasteld must all be enabled')
+        sys.exit(0)
+    builddir = config['BUILDDIR']
+    os.environ['PASTELD'] = config['REAL_PASTELD']
+
+    groups = read_groups(os.path.join(CURDIR, 'rpc-tests.sh'), config)
+    tests = [TestResult(name, 'single') for name in args.name]
+    for group in args.group or ([] if args.name else DEFAULT_GROUPS):
+        if group not in groups:
+            parser.error("unknown group '%s' (choose from %s)" % (group, ', '.join(groups)))
+        tests += [TestResult(name, group) for name in groups[group]]
+
+    durations_path = args.durations or os.path.join(builddir, 'qa', 'pull-tester', 'rpc-test-durations.json')
+    durations = load_durations(durations_path)
+    # Tests without a recorded duration go first, then the longest ones
+    tests.sort(key=lambda t: durations.get(t.name, float('inf')), reverse=True)
+
+    print('Executing %d test scripts on %d jobs' % (len(tests), args.jobs))
+    time_start = time.time()
+    results = TestRunner(builddir, args.jobs, test_params, args.tmpdir).run_all(tests)
+    elapsed = time.time() - time_start
+
+    save_durations(durations_path, durations, results)
+    if args.json:
+        write_json_report(args.json, results, elapsed, args.jobs)
+    if args.junit:
+        write_junit_report(args.junit, results, elapsed)
+
+    failures = [r.name for r in results if not r.passed]
+    print('\n\nTests completed: %d | exectime: %s' % (len(results), format_time(elapsed)))
+    print('successes %d; failures: %d' % (len(results) - len(failures), len(failures)))
+    if failures:
+        print('\nFailing tests: %s' % ' '.join(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,8 @@ $0 [test_script_name] [test_script_params]
   --tracerpc      Print out all RPC calls as they are made.
   --srcdir=SRCDIR Source directory containing pasteld/pastel-cli (default: ../../src).
   --tmpdir=TMPDIR Root directory for all temp data dirs.
+
+Use rpc-tests.py to run the same groups in parallel (rpc-tests.py --help).
 EOF
 }
 
@@ -40,7 +40,8 @@ class BIP65Test(ComparisonTestFramework):
         self.is_network_split = False
 
     def run_test(self):
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, differential=self.options.differential,
+                           compare_log=self.options.comparelog)
         test.add_all_connections(self.nodes)
         NetworkThread().start() # Start up network handling in another thread
         test.run()
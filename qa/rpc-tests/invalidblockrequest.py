@@ -10,7 +10,6 @@ from test_framework.comptool import TestManager, TestInstance
 from test_framework.mininode import NetworkThread
 from test_framework.blocktools import create_block, create_coinbase, create_transaction
 
-import copy
 import time
 
 
@@ -31,7 +30,8 @@ class InvalidBlockRequestTest(ComparisonTestFramework):
         self.num_nodes = 1
 
     def run_test(self):
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, differential=self.options.differential,
+                           compare_log=self.options.comparelog)
         test.add_all_connections(self.nodes)
         self.tip = None
         self.block_time = None
@@ -85,7 +85,7 @@ class InvalidBlockRequestTest(ComparisonTestFramework):
         block2.rehash()
         block2.solve()
         orig_hash = block2.sha256
-        block2_orig = copy.deepcopy(block2)
+        block2_orig = block2.copy()
 
         # Mutate block 2
         block2.vtx.append(tx2)
@@ -5,7 +5,7 @@
 #
 
 from test_framework.mininode import NodeConn, NodeConnCB, NetworkThread, \
-    EarlyDisconnectError, CInv, msg_inv, mininode_lock
+    EarlyDisconnectError, CInv, msg_inv
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import initialize_chain_clean, start_nodes, \
     p2p_port
@@ -66,7 +66,7 @@ class TestManager(NodeConnCB):
                 time.sleep(2)
 
                 total_requests = 0
-                with mininode_lock:
+                with self.cb_lock:
                     for key in self.blockReqCounts:
                         total_requests += self.blockReqCounts[key]
                         if self.blockReqCounts[key] > 1:
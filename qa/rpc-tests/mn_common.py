@@ -7,7 +7,7 @@ from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal, assert_greater_than, initialize_chain_clean, \
     initialize_datadir, start_nodes, start_node, connect_nodes_bi, \
     pasteld_processes, wait_and_assert_operationid_status, p2p_port, \
-    stop_node
+    stop_node, wait_for_sync, call_all
 from test_framework.authproxy import JSONRPCException
 
 import os
@@ -99,8 +99,8 @@ class MasterNodeCommon (BitcoinTestFramework):
             if i != hot_node_num:
                 connect_nodes_bi(self.nodes, hot_node_num, i)
         
-        print("Waiting 90 seconds...")
-        time.sleep(90)
+        print("Waiting up to 90 seconds for masternode sync...")
+        wait_for_sync("mnsync", lambda: self.nodes[hot_node_num].mnsync("status")["IsSynced"], 5, 90)
         print(f"Checking sync status of node {hot_node_num}...")
         assert_equal(self.nodes[hot_node_num].mnsync("status")["IsSynced"], True)
         assert_equal(self.nodes[hot_node_num].mnsync("status")["IsFailed"], False)
@@ -162,18 +162,16 @@ def create_masternode_conf(name, n, dirname, txid, vin, private_key, mn_port):
 
 def wait_for_it(init_wait, more_wait, wait_for, node_list, mnId, repeatMore=1):
     debug = False
-    print(f'Waiting {init_wait} seconds...')
-    time.sleep(init_wait)
-
-    for _ in range(repeatMore):
-        result = all(node.masternode("list")[mnId] == wait_for for node in node_list)
-        if not result:
-            if debug:
-                [print(node.masternode("list")) for node in node_list]
-            print(f'Waiting {more_wait} seconds more...')
-            time.sleep(more_wait)
-        else:
-            break
+    timeout = init_wait + more_wait * repeatMore
+    print(f'Waiting up to {timeout} seconds for {wait_for}...')
+
+    def reached():
+        lists = call_all(node_list, "masternode", "list")
+        result = all(mn_list.get(mnId) == wait_for for mn_list in lists)
+        if not result and debug:
+            [print(mn_list) for mn_list in lists]
+        return result
+    wait_for_sync("wait_for_it", reached, 5, timeout)
 
     if debug:
         [print(node.masternode("list")) for node in node_list]
@@ -5,8 +5,7 @@
 #
 
 from test_framework.mininode import CBlockHeader, CInv, NodeConn, NodeConnCB, \
-    NetworkThread, msg_block, msg_headers, msg_inv, msg_ping, msg_pong, \
-    mininode_lock
+    NetworkThread, msg_block, msg_headers, msg_inv, msg_ping, msg_pong
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal, initialize_chain_clean, \
     start_node, p2p_port
@@ -79,16 +78,12 @@ class TestNode(NodeConnCB):
     def on_getdata(self, conn, message):
         self.last_getdata = message
 
-    # Spin until verack message is received from the node.
+    # Wait until verack message is received from the node.
     # We use this to signal that our test can begin. This
-    # is called from the testing thread, so it needs to acquire
-    # the global lock.
+    # is called from the testing thread; wait_until() wakes
+    # up when the network thread delivers the verack.
     def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
+        self.wait_until(lambda: self.verack_received, timeout=None)
 
     # Wrapper for the NodeConn's send_message function
     def send_message(self, message):
@@ -100,14 +95,8 @@ class TestNode(NodeConnCB):
     # Sync up with the node after delivery of a block
     def sync_with_ping(self, timeout=30):
         self.connection.send_message(msg_ping(nonce=self.ping_counter))
-        received_pong = False
-        sleep_time = 0.05
-        while not received_pong and timeout > 0:
-            time.sleep(sleep_time)
-            timeout -= sleep_time
-            with mininode_lock:
-                if self.last_pong.nonce == self.ping_counter:
-                    received_pong = True
+        received_pong = self.wait_until(
+            lambda: self.last_pong.nonce == self.ping_counter, timeout)
         self.ping_counter += 1
         return received_pong
 
@@ -270,13 +259,13 @@ class AcceptBlockTest(BitcoinTestFramework):
         # 6. Try to get node to request the missing block.
         # Poke the node with an inv for block at height 3 and see if that
         # triggers a getdata on block 2 (it should if block 2 is missing).
-        with mininode_lock:
+        with test_node.cb_lock:
             # Clear state so we can check the getdata request
             test_node.last_getdata = None
             test_node.send_message(msg_inv([CInv(2, blocks_h3[0].sha256)]))
 
         test_node.sync_with_ping()
-        with mininode_lock:
+        with test_node.cb_lock:
             getdata = test_node.last_getdata
 
         # Check that the getdata includes the right block
@@ -4,7 +4,7 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
 from test_framework.mininode import NodeConn, NodeConnCB, NetworkThread, \
-    msg_filteradd, msg_filterclear, mininode_lock, BLOSSOM_PROTO_VERSION
+    msg_filteradd, msg_filterclear, BLOSSOM_PROTO_VERSION
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import initialize_chain_clean, start_nodes, \
     p2p_port, assert_equal
@@ -22,16 +22,12 @@ class TestNode(NodeConnCB):
     def add_connection(self, conn):
         self.connection = conn
 
-    # Spin until verack message is received from the node.
+    # Wait until verack message is received from the node.
     # We use this to signal that our test can begin. This
-    # is called from the testing thread, so it needs to acquire
-    # the global lock.
+    # is called from the testing thread; wait_until() wakes
+    # up when the network thread delivers the verack.
     def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
+        self.wait_until(lambda: self.verack_received, timeout=None)
 
     # Wrapper for the NodeConn's send_message function
     def send_message(self, message):
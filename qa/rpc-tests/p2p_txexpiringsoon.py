@@ -5,7 +5,7 @@
 
 from test_framework.authproxy import JSONRPCException
 from test_framework.mininode import NodeConn, NetworkThread, CInv, \
-    msg_mempool, msg_getdata, msg_tx, mininode_lock, BLOSSOM_PROTO_VERSION
+    msg_mempool, msg_getdata, msg_tx, BLOSSOM_PROTO_VERSION
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal, connect_nodes_bi, fail, \
     initialize_chain_clean, p2p_port, start_nodes, sync_blocks, sync_mempools
@@ -51,14 +51,14 @@ class TxExpiringSoonTest(BitcoinTestFramework):
         testnode.sync_with_ping()
 
         # Send p2p message "mempool" to receive contents from pasteld node in "inv" message
-        with mininode_lock:
+        with testnode.cb_lock:
             testnode.last_inv = None
             testnode.send_message(msg_mempool())
 
         # Sync up with node after p2p messages delivered
         testnode.sync_with_ping()
 
-        with mininode_lock:
+        with testnode.cb_lock:
             msg = testnode.last_inv
             assert_equal(len(msg.inv), 1)
             assert_equal(tx.sha256, msg.inv[0].hash)
@@ -67,7 +67,7 @@ class TxExpiringSoonTest(BitcoinTestFramework):
         # Send p2p message "getdata" to verify tx gets sent in "tx" message
         getdatamsg = msg_getdata()
         getdatamsg.inv = [CInv(1, tx.sha256)]
-        with mininode_lock:
+        with testnode.cb_lock:
             testnode.last_notfound = None
             testnode.last_tx = None
             testnode.send_message(getdatamsg)
@@ -77,7 +77,7 @@ class TxExpiringSoonTest(BitcoinTestFramework):
         testnode.sync_with_ping()
 
         # Verify data received in "tx" message is for tx
-        with mininode_lock:
+        with testnode.cb_lock:
             incoming_tx = testnode.last_tx.tx
             incoming_tx.rehash()
             assert_equal(tx.sha256, incoming_tx.sha256)
@@ -182,11 +182,11 @@ class TxExpiringSoonTest(BitcoinTestFramework):
         testnode0.sync_with_ping()
 
         # Verify node 0 does not reply to "getdata" by sending "tx" message, as tx2 is expiring soon
-        with mininode_lock:
+        with testnode0.cb_lock:
             assert_equal(testnode0.last_tx, None)
 
         # Verify mininode received a "notfound" message containing the txid of tx2
-        with mininode_lock:
+        with testnode0.cb_lock:
             msg = testnode0.last_notfound
             assert_equal(len(msg.inv), 1)
             assert_equal(tx2.sha256, msg.inv[0].hash)
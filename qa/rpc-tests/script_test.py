@@ -145,7 +145,8 @@ class ScriptTest(ComparisonTestFramework):
 
     def run_test(self):
         # Set up the comparison tool TestManager
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, differential=self.options.differential,
+                           compare_log=self.options.comparelog)
         test.add_all_connections(self.nodes)
 
         # Load scripts
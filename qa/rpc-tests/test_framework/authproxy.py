@@ -5,7 +5,9 @@
   ServiceProxy class:
 
   - HTTP connections persist for the life of the AuthServiceProxy object
-    (if server supports HTTP/1.1)
+    (if server supports HTTP/1.1) and are pooled, so the proxy and the
+    method proxies it returns can be used from several threads at once
+  - pipeline() sends several calls as one JSON-RPC batch
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
   - sends Basic HTTP authentication headers
@@ -33,10 +35,15 @@
   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """
 
+import asyncio
 import base64
+import codecs
 import decimal
+import itertools
 import simplejson as json
 import logging
+from collections import deque
+from concurrent.futures import Future
 from http.client import HTTPConnection, HTTPSConnection, BadStatusLine
 from urllib.parse import urlparse
 
@@ -61,86 +68,328 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
-class AuthServiceProxy():
-    __id_count = 0
+# Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset.
+# ConnectionResetError happens on FreeBSD with Python 3.4.
+def connection_dropped(e):
+    return ((isinstance(e, BadStatusLine) and (e.line == "''" or e.line == "No status line received - the server has closed the connection"))
+            or isinstance(e, (BrokenPipeError, ConnectionResetError)))
 
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None):
-        self.__service_url = service_url
-        self.__service_name = service_name
-        self.__url = urlparse(service_url)
-        (user, passwd) = (self.__url.username, self.__url.password)
-        try:
-            user = user.encode('utf8')
-        except AttributeError:
-            pass
+_decimal_decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+
+def decode_response(data):
+    response = _decimal_decoder.decode(data.decode('utf8'))
+    # Re-encoding a large result is expensive, only do it for the log
+    if log.isEnabledFor(logging.DEBUG):
+        if "error" in response and response["error"] is None:
+            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal)))
+        else:
+            log.debug("<-- "+data.decode('utf8'))
+    return response
+
+# Bytes read from the connection at a time by AuthServiceProxy.stream()
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class _JSONStream():
+    """
+    Text of a JSON document arriving in chunks, consumed one value or
+    punctuation character at a time
+    """
+    def __init__(self, chunks, decoder):
+        self.chunks = chunks
+        self.decoder = decoder
+        self.text_decoder = codecs.getincrementaldecoder('utf8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            raise ValueError("Unexpected end of JSON-RPC response")
+        # Drop what has been consumed before growing the buffer
+        buf = self.buf[self.pos:]
+        self.pos = 0
         try:
-            passwd = passwd.encode('utf8')
-        except AttributeError:
-            pass
-        authpair = user + b':' + passwd
-        self.__auth_header = b'Basic ' + base64.b64encode(authpair)
+            buf += self.text_decoder.decode(next(self.chunks))
+        except StopIteration:
+            buf += self.text_decoder.decode(b'', True)
+            self.eof = True
+        self.buf = buf
 
-        self.timeout = timeout
-        self._set_conn(connection)
+    def peek(self):
+        while True:
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] in ' \t\n\r':
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            self.read_more()
 
-    def _set_conn(self, connection=None):
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
+    def next_char(self):
+        pos = self.pos
+        if pos < len(self.buf) and self.buf[pos] not in ' \t\n\r':
+            self.pos = pos + 1
+            return self.buf[pos]
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, c):
+        if self.next_char() != c:
+            raise ValueError("Malformed JSON-RPC response: expected %r" % c)
+
+    def value(self):
+        while True:
+            buf, pos = self.buf, self.pos
+            if pos >= len(buf) or buf[pos] in ' \t\n\r':
+                self.peek()
+                buf, pos = self.buf, self.pos
+            try:
+                # The C scanner, without the Python wrapper of raw_decode()
+                value, end = self.decoder.scan_once(buf, pos)
+                # A number may continue in the next chunk ("3." decodes as 3)
+                if self.eof or (end < len(buf) and buf[end] not in '0123456789.eE+-'):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def items(self, end, pairs):
+        """
+        Values, or (name, value) pairs if pairs, of the array or object
+        whose opening bracket has been read, up to its closing bracket end
+        """
+        if self.peek() == end:
+            self.pos += 1
+            return
+        scan_once = self.decoder.scan_once
+        while True:
+            # Fast path for an item wholly in the buffer and followed by
+            # its separator, so a number cannot continue in the next chunk.
+            # Whitespace is skipped here rather than left to make
+            # scan_once() fail, which costs a count of the lines before pos.
+            buf, pos = self.buf, self.pos
+            try:
+                while buf[pos] in ' \t\n\r':
+                    pos += 1
+                if pairs:
+                    name, pos = scan_once(buf, pos)
+                    while buf[pos] in ' \t\n\r':
+                        pos += 1
+                    if buf[pos] != ':':
+                        raise ValueError
+                    pos += 1
+                    while buf[pos] in ' \t\n\r':
+                        pos += 1
+                value, pos = scan_once(buf, pos)
+                while buf[pos] in ' \t\n\r':
+                    pos += 1
+                sep = buf[pos]
+                item = (name, value) if pairs else value
+            except (ValueError, IndexError):
+                # The end of the buffer or malformed text
+                sep = None
+            if sep == ',' or sep == end:
+                self.pos = pos + 1
+            else:
+                if pairs:
+                    name = self.value()
+                    self.expect(':')
+                    item = name, self.value()
+                else:
+                    item = self.value()
+                sep = self.next_char()
+            yield item
+            if sep == end:
+                return
+            if sep != ',':
+                raise ValueError("Malformed JSON-RPC response: expected ','")
+
+class _FloatText(str):
+    """Literal text of a JSON float, kept until its field is known"""
+    __slots__ = ()
+
+_float_text_decoder = json.JSONDecoder(parse_float=_FloatText)
+
+def _convert_floats(value, decimal_fields=()):
+    """
+    Replace the _FloatText in value, in place where it is a container, with
+    float, or with Decimal for the decimal_fields of a top-level object
+    """
+    if type(value) is dict:
+        for k, v in value.items():
+            t = type(v)
+            if t is _FloatText:
+                value[k] = decimal.Decimal(v) if k in decimal_fields else float(v)
+            elif t is dict or t is list:
+                _convert_floats(v)
+    elif type(value) is list:
+        for i, v in enumerate(value):
+            t = type(v)
+            if t is _FloatText:
+                value[i] = float(v)
+            elif t is dict or t is list:
+                _convert_floats(v)
+    elif type(value) is _FloatText:
+        return float(value)
+    return value
+
+def iter_json_result(chunks, decimal_fields=None):
+    """
+    Decode a JSON-RPC response from an iterable of byte strings and yield
+    the items of its result (see AuthServiceProxy.stream()) as soon as each
+    one is complete
+    """
+    if decimal_fields is None:
+        stream = _JSONStream(iter(chunks), _decimal_decoder)
+        convert = lambda value: value
+    else:
+        # Floats stay text until the field they belong to is known, so
+        # decimal_fields get the exact Decimal of the literal
+        stream = _JSONStream(iter(chunks), _float_text_decoder)
+        decimal_fields = frozenset(decimal_fields)
+        convert = lambda value: _convert_floats(value, decimal_fields)
+
+    result = error = None
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.next_char()
+    else:
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            c = stream.peek()
+            if key == 'result' and c in '[{':
+                stream.next_char()
+                if c == '[':
+                    for value in stream.items(']', False):
+                        yield convert(value)
+                else:
+                    for name, value in stream.items('}', True):
+                        yield name, convert(value)
+            elif key == 'result':
+                result = stream.value()
+            elif key == 'error':
+                error = convert(stream.value())
+            else:
+                stream.value()
+            sep = stream.next_char()
+            if sep == '}':
+                break
+            if sep != ',':
+                raise ValueError("Malformed JSON-RPC response: expected ','")
+    if error is not None:
+        raise JSONRPCException(error)
+    if result is not None:
+        raise JSONRPCException({
+            'code': -343, 'message': 'JSON-RPC result is not an array or object'})
+
+# Request ids; next() on it is atomic, so threads never reuse an id
+_id_counter = itertools.count(1)
+
+def request_headers(url):
+    (user, passwd) = (url.username, url.password)
+    try:
+        user = user.encode('utf8')
+    except AttributeError:
+        pass
+    try:
+        passwd = passwd.encode('utf8')
+    except AttributeError:
+        pass
+    authpair = user + b':' + passwd
+    return {'Host': url.hostname,
+            'User-Agent': USER_AGENT,
+            'Authorization': b'Basic ' + base64.b64encode(authpair),
+            'Content-type': 'application/json'}
+
+class ConnectionPool():
+    """
+    Keep-alive connections to one server. A connection is taken out of the
+    pool for the duration of a request, so concurrent requests from several
+    threads each get their own.
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT, connection=None):
+        self.url = url
+        self.timeout = timeout
+        self.idle = deque()
         if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
             self.timeout = connection.timeout
-        elif self.__url.scheme == 'https':
-            self.__conn = HTTPSConnection(self.__url.hostname, port, timeout=self.timeout)
+            self.idle.append(connection)
+        self.headers = request_headers(url)
+
+    def get(self):
+        try:
+            return self.idle.pop()
+        except IndexError:
+            pass
+        if self.url.port is None:
+            port = 80
         else:
-            self.__conn = HTTPConnection(self.__url.hostname, port, timeout=self.timeout)
+            port = self.url.port
+        if self.url.scheme == 'https':
+            return HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        return HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    def put(self, connection):
+        self.idle.append(connection)
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+class AuthServiceProxy():
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, pool=None):
+        self.__service_url = service_url
+        self.__service_name = service_name
+        self.__url = urlparse(service_url)
+        if pool is None:
+            pool = ConnectionPool(self.__url, timeout, connection)
+        self.__pool = pool
+        self.__async_proxy = None
+        self.timeout = pool.timeout
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
             # Python internal stuff
             raise AttributeError
+        method = name
         if self.__service_name is not None:
-            name = "%s.%s" % (self.__service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+            method = "%s.%s" % (self.__service_name, name)
+        proxy = AuthServiceProxy(self.__service_url, method, pool=self.__pool)
+        # Later lookups of the same method find it without calling __getattr__
+        self.__dict__[name] = proxy
+        return proxy
 
     def _request(self, method, path, postdata):
         '''
         Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
         This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
         '''
-        headers = {'Host': self.__url.hostname,
-                   'User-Agent': USER_AGENT,
-                   'Authorization': self.__auth_header,
-                   'Content-type': 'application/json'}
+        conn = self.__pool.get()
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except Exception as e:
-            # If connection was closed, try again.
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset.
-            # ConnectionResetError happens on FreeBSD with Python 3.4.
-            # This can be simplified now that we depend on Python 3 (previously, we could not
-            # refer to BrokenPipeError or ConnectionResetError which did not exist on Python 2)
-            if ((isinstance(e, BadStatusLine) and (e.line == "''" or e.line == "No status line received - the server has closed the connection"))
-                or e.__class__.__name__ in ('BrokenPipeError', 'ConnectionResetError')):
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
-
-    def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
+            try:
+                conn.request(method, path, postdata, self.__pool.headers)
+                response = self._get_response(conn)
+            except Exception as e:
+                # If connection was closed, try again.
+                if not connection_dropped(e):
+                    raise
+                conn.close()
+                conn.request(method, path, postdata, self.__pool.headers)
+                response = self._get_response(conn)
+        except:
+            # Whatever is left on the connection can't be matched to a request
+            conn.close()
+            raise
+        self.__pool.put(conn)
+        return response
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self.__service_name,
-                                 json.dumps(args, default=EncodeDecimal)))
-        postdata = json.dumps({'version': '1.1',
-                               'method': self.__service_name,
-                               'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal)
-        response = self._request('POST', self.__url.path, postdata)
+    @staticmethod
+    def _result(response):
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -149,13 +398,87 @@ class AuthServiceProxy():
         else:
             return response['result']
 
+    def __call__(self, *args):
+        request_id = next(_id_counter)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(request_id, self.__service_name,
+                                     json.dumps(args, default=EncodeDecimal)))
+        postdata = json.dumps({'version': '1.1',
+                               'method': self.__service_name,
+                               'params': args,
+                               'id': request_id}, default=EncodeDecimal)
+        response = self._request('POST', self.__url.path, postdata)
+        return self._result(response)
+
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
-        log.debug("--> "+postdata)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> "+postdata)
         return self._request('POST', self.__url.path, postdata)
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def pipeline(self):
+        """
+        Return an RPCPipeline for this proxy. Calls made on it return
+        futures and are sent as one batch when the with block ends:
+
+            with node.pipeline() as p:
+                count = p.getblockcount()
+                balance = p.getbalance()
+            print(count.result(), balance.result())
+        """
+        return RPCPipeline(self, self.__service_name)
+
+    def async_proxy(self):
+        """
+        Return an AsyncAuthServiceProxy for the same server and method
+        """
+        if self.__async_proxy is None:
+            self.__async_proxy = AsyncAuthServiceProxy(
+                self.__service_url, self.__service_name, self.timeout)
+        return self.__async_proxy
+
+    def stream(self, method, *args, decimal_fields=None):
+        """
+        Call method and iterate over the items of its result as they are
+        received and decoded, without holding the whole result in memory.
+        Array results yield their items, object results (key, value)
+        pairs. With decimal_fields, JSON floats are decoded as float except
+        for the named fields of object items, which become the Decimal of
+        their literal.
+        """
+        if self.__service_name is not None:
+            method = "%s.%s" % (self.__service_name, method)
+        request_id = next(_id_counter)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(request_id, method,
+                                     json.dumps(args, default=EncodeDecimal)))
+        postdata = json.dumps({'version': '1.1',
+                               'method': method,
+                               'params': args,
+                               'id': request_id}, default=EncodeDecimal)
+        conn = self.__pool.get()
+        try:
+            try:
+                conn.request('POST', self.__url.path, postdata, self.__pool.headers)
+                http_response = self._get_http_response(conn)
+            except Exception as e:
+                if not connection_dropped(e):
+                    raise
+                conn.close()
+                conn.request('POST', self.__url.path, postdata, self.__pool.headers)
+                http_response = self._get_http_response(conn)
+            chunks = iter(lambda: http_response.read(STREAM_CHUNK_SIZE), b'')
+            yield from iter_json_result(chunks, decimal_fields)
+        except:
+            # Also when the caller stops early: the rest of the response
+            # is still on the connection
+            conn.close()
+            raise
+        self.__pool.put(conn)
+
+    def _get_http_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -164,11 +487,246 @@ class AuthServiceProxy():
         if content_type != 'application/json':
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
+        return http_response
 
-        responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal)))
+    def _get_response(self, conn):
+        return decode_response(self._get_http_response(conn).read())
+
+
+class RPCPipeline():
+    """
+    Collects RPC calls and sends them through AuthServiceProxy._batch() in
+    one request, see AuthServiceProxy.pipeline()
+    """
+    def __init__(self, proxy, service_name=None):
+        self.proxy = proxy
+        self.service_name = service_name
+        self.calls = []
+        self.futures = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        if self.service_name is not None:
+            name = "%s.%s" % (self.service_name, name)
+        return lambda *args: self.call(name, *args)
+
+    def call(self, method, *args):
+        request_id = next(_id_counter)
+        future = Future()
+        self.calls.append({'version': '1.1',
+                           'method': method,
+                           'params': args,
+                           'id': request_id})
+        self.futures[request_id] = future
+        return future
+
+    def execute(self):
+        """
+        Send the calls collected so far and resolve their futures
+        """
+        calls, self.calls = self.calls, []
+        futures, self.futures = self.futures, {}
+        if not calls:
+            return
+        try:
+            responses = self.proxy._batch(calls)
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+            raise
+        if isinstance(responses, dict):
+            # The whole batch was rejected
+            responses = [dict(responses, id=request_id) for request_id in futures]
+        for response in responses:
+            future = futures.pop(response.get('id'), None)
+            if future is None:
+                continue
+            try:
+                future.set_result(AuthServiceProxy._result(response))
+            except JSONRPCException as e:
+                future.set_exception(e)
+        for future in futures.values():
+            future.set_exception(JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
         else:
-            log.debug("<-- "+responsedata)
-        return response
+            for future in self.futures.values():
+                future.cancel()
+
+
+class AsyncHTTPConnection():
+    """
+    Minimal HTTP/1.1 client connection for asyncio, kept open between
+    requests unless the server closes it
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.loop = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        port = self.url.port
+        if port is None:
+            port = 443 if self.url.scheme == 'https' else 80
+        self.reader, self.writer = await asyncio.open_connection(
+            self.url.hostname, port, ssl=(self.url.scheme == 'https'))
+        self.loop = asyncio.get_running_loop()
+
+    def close(self):
+        if self.writer is not None and not self.loop.is_closed():
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body, headers):
+        """
+        Send the request and return (status, reason, headers, body). The
+        header names are lower case.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        lines = ["%s %s HTTP/1.1" % (method, path or '/'),
+                 "Content-Length: %d" % len(body)]
+        for name, value in headers.items():
+            if isinstance(value, bytes):
+                value = value.decode('latin-1')
+            lines.append("%s: %s" % (name, value))
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+        reused = self.writer is not None
+        if not reused:
+            await self.connect()
+        try:
+            self.writer.write(data)
+            return await self._get_response()
+        except (ConnectionError, asyncio.IncompleteReadError, BadStatusLine):
+            if not reused:
+                raise
+            # The server closed the idle connection; try once on a new one
+            self.close()
+            await self.connect()
+            self.writer.write(data)
+            return await self._get_response()
+
+    async def _get_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise BadStatusLine("No status line received - the server has closed the connection")
+        version, status, reason = (status_line.decode('latin-1').rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Trailers up to the empty line
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b"".join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            self.close()
+        return int(status), reason, headers, body
+
+class AsyncAuthServiceProxy():
+    """
+    asyncio counterpart of AuthServiceProxy: calling a method returns a
+    coroutine, so calls to several nodes can run at once with
+    asyncio.gather(). Connections are reused within one event loop.
+    """
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, pool=None):
+        self.__service_url = service_url
+        self.__service_name = service_name
+        self.__url = urlparse(service_url)
+        if pool is None:
+            pool = AsyncConnectionPool(self.__url, timeout)
+        self.__pool = pool
+        self.timeout = pool.timeout
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        method = name
+        if self.__service_name is not None:
+            method = "%s.%s" % (self.__service_name, name)
+        proxy = AsyncAuthServiceProxy(self.__service_url, method, pool=self.__pool)
+        self.__dict__[name] = proxy
+        return proxy
+
+    async def _request(self, method, path, postdata):
+        conn = self.__pool.get()
+        try:
+            status, reason, headers, body = await asyncio.wait_for(
+                conn.request(method, path, postdata, self.__pool.headers), self.timeout)
+        except:
+            conn.close()
+            raise
+        self.__pool.put(conn)
+
+        if headers.get('content-type') != 'application/json':
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (status, reason)})
+        return decode_response(body)
+
+    async def __call__(self, *args):
+        request_id = next(_id_counter)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(request_id, self.__service_name,
+                                     json.dumps(args, default=EncodeDecimal)))
+        postdata = json.dumps({'version': '1.1',
+                               'method': self.__service_name,
+                               'params': args,
+                               'id': request_id}, default=EncodeDecimal)
+        response = await self._request('POST', self.__url.path, postdata)
+        return AuthServiceProxy._result(response)
+
+    async def _batch(self, rpc_call_list):
+        postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> "+postdata)
+        return await self._request('POST', self.__url.path, postdata)
+
+    def close(self):
+        self.__pool.close()
+
+class AsyncConnectionPool(ConnectionPool):
+    """
+    ConnectionPool of AsyncHTTPConnections. Connections opened on an event
+    loop that is no longer running are dropped instead of reused.
+    """
+    def get(self):
+        loop = asyncio.get_running_loop()
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.loop is loop:
+                return conn
+            conn.close()
+        return AsyncHTTPConnection(self.url, self.timeout)
@@ -4,31 +4,295 @@
 #             and for constructing a getheaders message
 #
 
-from .mininode import CBlock, CBlockHeader, CBlockLocator, CTransaction, msg_block, msg_headers, msg_tx
+from .mininode import ByteReader, CBlock, CBlockHeader, CBlockLocator, CTransaction, msg_block, msg_headers, msg_tx, \
+    msg_raw, hash256, ser_uint256, uint256_from_str
 
+import copy
 import sys
-from io import BytesIO
-import dbm.ndbm
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+# Storage backends keep serialized objects keyed by their 32-byte hash.
+# They all provide get(key) (None if missing), put(key, value), contains(key),
+# keys() and close(); the network thread reads them while the test writes.
+
+class MemoryBackend(object):
+    """Plain dict, for short runs that don't need the data afterwards."""
+    def __init__(self, datadir, name):
+        self.db = dict()
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db[key] = value
+
+    def contains(self, key):
+        return key in self.db
+
+    def keys(self):
+        return list(self.db)
+
+    def close(self):
+        self.db.clear()
+
+class DbmBackend(object):
+    """dbm.ndbm file in datadir, as the store has always used."""
+    def __init__(self, datadir, name):
+        import dbm.ndbm
+        self.db = dbm.ndbm.open(datadir + "/" + name, 'c')
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db[key] = value
+
+    def contains(self, key):
+        return key in self.db
+
+    def keys(self):
+        return self.db.keys()
+
+    def close(self):
+        self.db.close()
+
+class SQLiteBackend(object):
+    """SQLite file in datadir for big runs; reads go through a memory map."""
+    MMAP_SIZE = 1 << 30
+
+    def __init__(self, datadir, name):
+        self.lock = Lock()
+        self.db = sqlite3.connect(datadir + "/" + name + ".sqlite",
+                                  isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA mmap_size=%d" % self.MMAP_SIZE)
+        # Test data can be regenerated, so don't pay for durability
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects "
+                        "(key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM objects WHERE key=?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?)", (key, value))
+
+    def contains(self, key):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM objects WHERE key=?", (key,)).fetchone() is not None
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT key FROM objects")]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+STORE_BACKENDS = {
+    "memory": MemoryBackend,
+    "dbm": DbmBackend,
+    "sqlite": SQLiteBackend,
+}
+
+def open_backend(backend, datadir, name):
+    if backend not in STORE_BACKENDS:
+        raise ValueError("unknown store backend %r (choose from %s)" %
+                         (backend, ", ".join(STORE_BACKENDS)))
+    return STORE_BACKENDS[backend](datadir, name)
+
+# Blocks and transactions are stored as the 4-byte message checksum followed
+# by the serialized object, so getdata is answered without re-encoding them.
+CHECKSUM_SIZE = 4
+
+def make_record(payload):
+    return hash256(payload)[:CHECKSUM_SIZE] + payload
+
+def record_message(command, record):
+    view = memoryview(record)
+    return msg_raw(command, view[CHECKSUM_SIZE:], view[:CHECKSUM_SIZE].tobytes())
+
+class PreparedObject(object):
+    """Snapshot of a block or transaction for add_prepared(): the hash,
+    a copy of a block's header and the record, taken while the caller may
+    still change the object afterwards. record is None if it failed to
+    serialize."""
+    __slots__ = ("sha256", "header", "record")
+
+    def __init__(self, sha256, header, record):
+        self.sha256 = sha256
+        self.header = header
+        self.record = record
+
+def prepare_record(obj):
+    try:
+        return make_record(bytes(obj.serialize()))
+    except TypeError as e:
+        print(f'Unexpected error: {sys.exc_info()[0]} {e.args}')
+        return None
+
+class LRUCache(object):
+    """The most recently used deserialized objects, so repeated getdata
+    requests for the same block or transaction skip deserialize().
+    Cached objects are shared and must not be modified."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            obj = self.entries.get(key)
+            if obj is not None:
+                self.entries.move_to_end(key)
+            return obj
+
+    def put(self, key, obj):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = obj
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+# Height of the ancestor that BlockIndex.skip points to, as in pasteld's
+# CBlockIndex::BuildSkip()
+def get_skip_height(height):
+    if height < 2:
+        return 0
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+class BlockIndex(object):
+    """Position of a header in the header tree.
+
+    Headers whose parent is not in the store start a new tree at height 0,
+    until the parent is stored and BlockStore re-indexes them under it.
+    """
+    __slots__ = ("header", "height", "prev", "skip")
+
+    def __init__(self, header, prev):
+        self.header = header
+        self.prev = prev
+        if prev is None:
+            self.height = 0
+            self.skip = None
+        else:
+            self.height = prev.height + 1
+            self.skip = prev.get_ancestor(get_skip_height(self.height))
+
+    # O(log n) walk using the skip pointers
+    def get_ancestor(self, height):
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        while walk.height > height:
+            height_skip = get_skip_height(walk.height)
+            height_skip_prev = get_skip_height(walk.height - 1)
+            if walk.skip is not None and \
+                (height_skip == height or
+                 (height_skip > height and not (height_skip_prev < height_skip - 2 and
+                                                height_skip_prev >= height))):
+                walk = walk.skip
+            else:
+                walk = walk.prev
+        return walk
 
 class BlockStore():
-    def __init__(self, datadir):
-        self.blockDB = dbm.ndbm.open(datadir + "/blocks", 'c')
+    def __init__(self, datadir, backend="dbm", cache_size=128):
+        self.blockDB = open_backend(backend, datadir, "blocks")
+        # Every header we know about, so the index can be rebuilt on reopen
+        # without reading block bodies. The tip is kept under "tip".
+        self.headerDB = open_backend(backend, datadir, "headers")
+        self.cache = LRUCache(cache_size)
         self.currentBlock = 0
         self.headers_map = dict()
+        self.index = dict()
+        # Hashes of the stored headers by the hash of their parent
+        self.children = dict()
+        self.load_headers()
 
     def close(self):
         self.blockDB.close()
+        self.headerDB.close()
+
+    def load_headers(self):
+        for key in self.headerDB.keys():
+            if key == b"tip":
+                self.currentBlock = uint256_from_str(self.headerDB.get(key))
+                continue
+            header = CBlockHeader()
+            header.deserialize(ByteReader(self.headerDB.get(key)))
+            header.calc_sha256()
+            self.headers_map[header.sha256] = header
+            self.children.setdefault(header.hashPrevBlock, []).append(header.sha256)
+        # Parents have to be indexed before their children
+        for blockhash in self.headers_map:
+            pending = []
+            while blockhash in self.headers_map and blockhash not in self.index:
+                pending.append(self.headers_map[blockhash])
+                blockhash = self.headers_map[blockhash].hashPrevBlock
+            for header in reversed(pending):
+                self.index[header.sha256] = BlockIndex(
+                    header, self.index.get(header.hashPrevBlock))
+
+    def _store_header(self, header):
+        if header.sha256 not in self.index:
+            self.headerDB.put(ser_uint256(header.sha256), CBlockHeader.serialize(header))
+            self.children.setdefault(header.hashPrevBlock, []).append(header.sha256)
+            self.index[header.sha256] = BlockIndex(
+                header, self.index.get(header.hashPrevBlock))
+            self._reindex_children(header.sha256)
+        else:
+            self.index[header.sha256].header = header
+        self.headers_map[header.sha256] = header
+
+    # Headers stored before their parent started a tree of their own; links
+    # them (and everything built on them) to the parent that just arrived.
+    # Entries are replaced rather than changed, as the network thread reads
+    # the index without locking the store.
+    def _reindex_children(self, blockhash):
+        pending = [blockhash]
+        while pending:
+            parent = self.index[pending.pop()]
+            for child in self.children.get(parent.header.sha256, ()):
+                self.index[child] = BlockIndex(self.index[child].header, parent)
+                pending.append(child)
+
+    def contains(self, blockhash):
+        key = ser_uint256(blockhash)
+        return self.cache.contains(key) or self.blockDB.contains(key)
 
     def get(self, blockhash):
-        serialized_block = None
-        try:
-            serialized_block = self.blockDB[repr(blockhash)]
-        except KeyError:
+        key = ser_uint256(blockhash)
+        ret = self.cache.get(key)
+        if ret is not None:
+            return ret
+        record = self.blockDB.get(key)
+        if record is None:
             return None
-        f = BytesIO(serialized_block)
         ret = CBlock()
-        ret.deserialize(f)
+        ret.deserialize(ByteReader(record, CHECKSUM_SIZE))
         ret.calc_sha256()
+        self.cache.put(key, ret)
         return ret
 
     def get_header(self, blockhash):
@@ -37,27 +301,31 @@ class BlockStore():
         except KeyError:
             return None
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
+    # Returns the headers from the last locator entry on the current chain
+    # (or the start of the chain) up to hash_stop or the tip, at most 2000.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        tip = self.index.get(current_tip)
+        if tip is None:
             return None
 
-        response = msg_headers()
-        headersList = [ current_block_header ]
+        start_height = 0
+        for blockhash in locator.vHave:
+            entry = self.index.get(blockhash)
+            if entry is not None and entry.height > start_height and \
+                    tip.get_ancestor(entry.height) is entry:
+                start_height = entry.height
+
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
-        headersList = headersList[:maxheaders] # truncate if we have too many
+        entry = tip.get_ancestor(min(tip.height, start_height + maxheaders - 1))
+        headersList = []
+        while entry is not None and entry.height >= start_height:
+            headersList.append(entry.header)
+            entry = entry.prev
+        headersList.reverse()
+
+        response = msg_headers()
         hashList = [x.sha256 for x in headersList]
         index = len(headersList)
         if (hash_stop in hashList):
@@ -65,17 +333,37 @@ class BlockStore():
         response.headers = headersList[:index]
         return response
 
-    def add_block(self, block):
+    @staticmethod
+    def prepare_block(block):
         block.calc_sha256()
-        try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
-        except TypeError as e:
-            print(f'Unexpected error: {sys.exc_info()[0]} {e.args}')
-        self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        header = CBlockHeader(block)
+        header.nSolution = copy.copy(header.nSolution)
+        return PreparedObject(block.sha256, header, prepare_record(block))
+
+    def add_block(self, block):
+        self.add_prepared(self.prepare_block(block))
+
+    def add_prepared(self, prepared):
+        key = ser_uint256(prepared.sha256)
+        # The caller keeps the block and may modify it, so it isn't cached
+        self.cache.discard(key)
+        if prepared.record is not None:
+            self.blockDB.put(key, prepared.record)
+        # The network thread answers getheaders without locking the store,
+        # so the new tip has to be indexed before it becomes current.
+        self._store_header(prepared.header)
+        self.headerDB.put(b"tip", key)
+        self.currentBlock = prepared.sha256
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self._store_header(header)
+
+    # Serialized block, or None
+    def get_raw(self, blockhash):
+        record = self.blockDB.get(ser_uint256(blockhash))
+        if record is None:
+            return None
+        return memoryview(record)[CHECKSUM_SIZE:]
 
     def get_blocks(self, inv):
         responses = []
@@ -86,19 +374,26 @@ class BlockStore():
                     responses.append(msg_block(block))
         return responses
 
+    # Same as get_blocks(), but sends the stored bytes without deserializing
+    def get_block_messages(self, inv):
+        responses = []
+        for i in inv:
+            if (i.type == 2): # MSG_BLOCK
+                record = self.blockDB.get(ser_uint256(i.hash))
+                if record is not None:
+                    responses.append(record_message(b"block", record))
+        return responses
+
     def get_locator(self, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
         r = []
         counter = 0
         step = 1
-        lastBlock = self.get(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
+        entry = self.index.get(current_tip)
+        while entry is not None:
+            r.append(entry.header.hashPrevBlock)
+            entry = entry.get_ancestor(entry.height - step)
             counter += 1
             if counter > 10:
                 step *= 2
@@ -107,30 +402,44 @@ class BlockStore():
         return locator
 
 class TxStore(object):
-    def __init__(self, datadir):
-        self.txDB = dbm.ndbm.open(datadir + "/transactions", 'c')
+    def __init__(self, datadir, backend="dbm", cache_size=1024):
+        self.txDB = open_backend(backend, datadir, "transactions")
+        self.cache = LRUCache(cache_size)
 
     def close(self):
         self.txDB.close()
 
+    def contains(self, txhash):
+        key = ser_uint256(txhash)
+        return self.cache.contains(key) or self.txDB.contains(key)
+
     def get(self, txhash):
-        serialized_tx = None
-        try:
-            serialized_tx = self.txDB[repr(txhash)]
-        except KeyError:
+        key = ser_uint256(txhash)
+        ret = self.cache.get(key)
+        if ret is not None:
+            return ret
+        record = self.txDB.get(key)
+        if record is None:
             return None
-        f = BytesIO(serialized_tx)
         ret = CTransaction()
-        ret.deserialize(f)
+        ret.deserialize(ByteReader(record, CHECKSUM_SIZE))
         ret.calc_sha256()
+        self.cache.put(key, ret)
         return ret
 
-    def add_transaction(self, tx):
+    @staticmethod
+    def prepare_transaction(tx):
         tx.calc_sha256()
-        try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
-        except TypeError as e:
-            print("Unexpected error: ", sys.exc_info()[0], e.args)
+        return PreparedObject(tx.sha256, None, prepare_record(tx))
+
+    def add_transaction(self, tx):
+        self.add_prepared(self.prepare_transaction(tx))
+
+    def add_prepared(self, prepared):
+        key = ser_uint256(prepared.sha256)
+        self.cache.discard(key)
+        if prepared.record is not None:
+            self.txDB.put(key, prepared.record)
 
     def get_transactions(self, inv):
         responses = []
@@ -140,3 +449,20 @@ class TxStore(object):
                 if tx is not None:
                     responses.append(msg_tx(tx))
         return responses
+
+    # Serialized transaction, or None
+    def get_raw(self, txhash):
+        record = self.txDB.get(ser_uint256(txhash))
+        if record is None:
+            return None
+        return memoryview(record)[CHECKSUM_SIZE:]
+
+    # Same as get_transactions(), but sends the stored bytes without deserializing
+    def get_tx_messages(self, inv):
+        responses = []
+        for i in inv:
+            if (i.type == 1): # MSG_TX
+                record = self.txDB.get(ser_uint256(i.hash))
+                if record is not None:
+                    responses.append(record_message(b"tx", record))
+        return responses
@@ -4,9 +4,11 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or https://www.opensource.org/licenses/mit-license.php .
 
-from .mininode import CBlock, CTransaction, CTxIn, CTxOut, COutPoint
+from .mininode import BlockSolver, CBlock, CTransaction, CTxIn, CTxOut, COutPoint
 from .script import CScript, OP_0, OP_EQUAL, OP_HASH160, OP_TRUE, OP_CHECKSIG
 
+from concurrent.futures import ThreadPoolExecutor
+
 _reward = 6250
 _coin = 100000
 
@@ -32,6 +34,30 @@ def create_block(hashprev, coinbase, nTime=None, nBits=None, hashFinalSaplingRoo
     block.calc_sha256()
     return block
 
+# Solve a sequence of blocks, linking each one to its predecessor (the first
+# block keeps its hashPrevBlock).  The Merkle root of block i+1 is computed
+# while block i is being solved; with workers > 1 all blocks share one
+# BlockSolver process pool.
+def solve_chain(blocks, n=48, k=5, workers=None, deterministic=False):
+    solver = BlockSolver(workers) if workers is not None and workers > 1 else None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as prepare:
+            merkle_root = prepare.submit(blocks[0].calc_merkle_root) if blocks else None
+            for i, block in enumerate(blocks):
+                block.hashMerkleRoot = merkle_root.result()
+                if i + 1 < len(blocks):
+                    merkle_root = prepare.submit(blocks[i+1].calc_merkle_root)
+                if i > 0:
+                    block.hashPrevBlock = blocks[i-1].sha256
+                if solver is not None:
+                    solver.solve(block, n, k, deterministic)
+                else:
+                    block.solve(n, k)
+    finally:
+        if solver is not None:
+            solver.close()
+    return blocks
+
 def serialize_script_num(value):
     r = bytearray(0)
     if value == 0:
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# comparison.py - per-node outcome log and divergence report for comptool
+#
+# TestManager records one row per checked block or transaction: what the
+# test expected, and for every node whether it accepted the object, its tip,
+# the reject message it sent for the object (if any) and, for transactions,
+# a hash of its mempool (None for blocks). Rows are kept column by column,
+# so thousands of checks stay cheap to record and the log can be dumped as
+# is.
+#
+
+from .mininode import ser_uint256
+
+import hashlib
+import json
+
+def mempool_hash(txhashes):
+    """Short digest of a mempool, independent of the order of txhashes."""
+    return hashlib.sha256(b"".join(ser_uint256(h) for h in sorted(txhashes))).hexdigest()[:16]
+
+class ComparisonLog(object):
+    def __init__(self, num_nodes):
+        self.num_nodes = num_nodes
+        self.test = []
+        self.kind = []
+        self.objhash = []
+        self.expected = []
+        self.matched = []
+        self.accepted = [[] for _ in range(num_nodes)]
+        self.tip = [[] for _ in range(num_nodes)]
+        self.reject = [[] for _ in range(num_nodes)]
+        self.mempool = [[] for _ in range(num_nodes)]
+
+    def __len__(self):
+        return len(self.test)
+
+    # nodes is a list of (accepted, tip, reject, mempool) tuples, one per
+    # node; reject is a (code, reason) tuple or None, mempool is None on
+    # block checks
+    def record(self, test_number, kind, objhash, expected, matched, nodes):
+        self.test.append(test_number)
+        self.kind.append(kind)
+        self.objhash.append(objhash)
+        self.expected.append(expected)
+        self.matched.append(matched)
+        for n, (accepted, tip, reject, mempool) in enumerate(nodes):
+            self.accepted[n].append(accepted)
+            self.tip[n].append(tip)
+            self.reject[n].append(reject)
+            self.mempool[n].append(mempool)
+
+    def divergences(self):
+        return [row for row, matched in enumerate(self.matched) if not matched]
+
+    # Rows that diverge in the same way, e.g. the same node rejecting every
+    # block for the same reason, are reported together
+    def signature(self, row):
+        return (self.kind[row], self.expected[row],
+                tuple(self.accepted[n][row] for n in range(self.num_nodes)),
+                tuple(self.reject[n][row] for n in range(self.num_nodes)))
+
+    def describe_node(self, n, row):
+        reject = self.reject[n][row]
+        if self.accepted[n][row]:
+            text = "accepted"
+        elif reject is not None:
+            text = "rejected %d %r" % (reject[0], reject[1].decode(errors="replace"))
+        else:
+            text = "not accepted"
+        if self.kind[row] == "block" and not self.accepted[n][row] and self.tip[n][row] is not None:
+            text += " (tip %064x)" % self.tip[n][row]
+        return "node%d %s" % (n, text)
+
+    def report(self, limit=20):
+        rows = self.divergences()
+        runs = []
+        for row in rows:
+            if runs and runs[-1][-1] + 1 == row and self.signature(runs[-1][0]) == self.signature(row):
+                runs[-1].append(row)
+            else:
+                runs.append([row])
+        lines = ["Comparison of %d nodes: %d checks, %d divergences in %d runs" %
+                 (self.num_nodes, len(self), len(rows), len(runs))]
+        for run in runs[:limit]:
+            first, last = run[0], run[-1]
+            expected = {True: "accept", False: "reject", None: "agreement"}[self.expected[first]]
+            tests = "test %d, %s" % (self.test[first], self.kind[first]) if first == last else \
+                "tests %d-%d (%d checks), first %s" % (self.test[first], self.test[last], len(run), self.kind[first])
+            lines.append("  %s %064x: %s; expected %s" % (
+                tests, self.objhash[first],
+                ", ".join(self.describe_node(n, first) for n in range(self.num_nodes)), expected))
+            mempools = set(self.mempool[n][first] for n in range(self.num_nodes))
+            if len(mempools) > 1:
+                lines.append("    mempools differ: " + ", ".join(
+                    "node%d %s" % (n, self.mempool[n][first]) for n in range(self.num_nodes)))
+        if len(runs) > limit:
+            lines.append("  ... %d more runs" % (len(runs) - limit))
+        return "\n".join(lines)
+
+    def write(self, path):
+        def reject_text(reject):
+            return None if reject is None else [reject[0], reject[1].decode(errors="replace")]
+        columns = {
+            "test": self.test,
+            "kind": self.kind,
+            "hash": ["%064x" % h for h in self.objhash],
+            "expected": self.expected,
+            "matched": self.matched,
+        }
+        for n in range(self.num_nodes):
+            columns["accepted.%d" % n] = self.accepted[n]
+            columns["tip.%d" % n] = [None if t is None else "%064x" % t for t in self.tip[n]]
+            columns["reject.%d" % n] = [reject_text(r) for r in self.reject[n]]
+            columns["mempool.%d" % n] = self.mempool[n]
+        with open(path, "w") as f:
+            json.dump({"nodes": self.num_nodes, "rows": len(self), "columns": columns}, f)
@@ -3,25 +3,28 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or https://www.opensource.org/licenses/mit-license.php .
 
-from .blockstore import BlockStore, TxStore
+from .blockstore import BlockStore, TxStore, record_message
+from .comparison import ComparisonLog, mempool_hash
 from .mininode import (
     CBlock,
     CBlockHeader,
     CTransaction,
     CInv,
-    msg_block,
     msg_getheaders,
     msg_inv,
     msg_mempool,
     msg_ping,
-    mininode_lock,
     MAX_INV_SZ,
     NodeConn,
     NodeConnCB,
 )
-from .util import p2p_port
+from .mininode import wait_until as wait_for_delivery
+from .util import p2p_port, record_sync_wait
 
 import time
+from contextlib import ExitStack, contextmanager
+from queue import Queue, Empty
+from threading import Event, Thread
 
 '''
 This is a tool for comparing two or more pastelds to each other
@@ -40,19 +43,17 @@ generator that returns TestInstance objects.  See below for definition.
 # on_getheaders: provide headers via BlockStore
 # on_getdata: provide blocks via BlockStore
 
+# attempts is kept from when this polled every 50ms; the predicate is now
+# checked again as soon as any of the connections delivers a message.
 def wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
-
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
-            if predicate():
-                return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
-
-    return False
+    timeout = min(timeout, attempts * 0.05)
+    if timeout == float('inf'):
+        timeout = None
+    start = time.time()
+    try:
+        return wait_for_delivery(predicate, timeout=timeout)
+    finally:
+        record_sync_wait("comptool.wait_until", time.time() - start)
 
 class TestNode(NodeConnCB):
 
@@ -71,6 +72,8 @@ class TestNode(NodeConnCB):
         self.pingMap = {} 
         self.lastInv = []
         self.closed = False
+        # (code, reason) of the reject messages received, by block/tx hash
+        self.rejects = {}
 
     def on_close(self, conn):
         self.closed = True
@@ -89,9 +92,10 @@ class TestNode(NodeConnCB):
         if response is not None:
             conn.send_message(response)
 
+    # Answers the whole getdata with the stored bytes in one write
     def on_getdata(self, conn, message):
-        [conn.send_message(r) for r in self.block_store.get_blocks(message.inv)]
-        [conn.send_message(r) for r in self.tx_store.get_transactions(message.inv)]
+        conn.send_messages(self.block_store.get_block_messages(message.inv) +
+                           self.tx_store.get_tx_messages(message.inv))
 
         for i in message.inv:
             if i.type == 1:
@@ -102,6 +106,10 @@ class TestNode(NodeConnCB):
     def on_inv(self, conn, message):
         self.lastInv = [x.hash for x in message.inv]
 
+    def on_reject(self, conn, message):
+        if message.message in (b"block", b"tx"):
+            self.rejects[message.data] = (message.code, message.reason)
+
     def on_pong(self, conn, message):
         try:
             del self.pingMap[message.nonce]
@@ -120,14 +128,16 @@ class TestNode(NodeConnCB):
 
     # This assumes BIP31
     def send_ping(self, nonce):
-        self.pingMap[nonce] = True
+        with self.cb_lock:
+            self.pingMap[nonce] = True
         self.conn.send_message(msg_ping(nonce))
 
     def received_ping_response(self, nonce):
         return nonce not in self.pingMap
 
     def send_mempool(self):
-        self.lastInv = []
+        with self.cb_lock:
+            self.lastInv = []
         self.conn.send_message(msg_mempool())
 
 # TestInstance:
@@ -165,15 +175,90 @@ class TestInstance(object):
         self.sync_every_block = sync_every_block
         self.sync_every_tx = sync_every_tx
 
+# What TestManager runs: a TestInstance whose objects were snapshotted by
+# TestManager.prepare_instance(). prepared is a blockstore.PreparedObject for
+# blocks and transactions and a copy of the header for block headers.
+BLOCK, HEADER, TX = range(3)
+
+class TestObject(object):
+    __slots__ = ("kind", "prepared", "outcome", "tip")
+
+    def __init__(self, kind, prepared, outcome, tip):
+        self.kind = kind
+        self.prepared = prepared
+        self.outcome = outcome
+        self.tip = tip
+
+class PreparedInstance(object):
+    def __init__(self, objects, sync_every_block, sync_every_tx):
+        self.objects = objects
+        self.sync_every_block = sync_every_block
+        self.sync_every_tx = sync_every_tx
+
+# Runs the test generator on its own thread, at most depth prepared
+# TestInstances ahead of the ones being synced. A thread rather than a
+# process, because generators use the test's RPC connections.
+class TestProducer(Thread):
+    def __init__(self, tests, depth):
+        Thread.__init__(self, name="comptool-producer", daemon=True)
+        self.tests = tests
+        self.queue = Queue(maxsize=depth)
+        self.stopped = Event()
+
+    def run(self):
+        try:
+            for test_instance in self.tests:
+                self.queue.put((test_instance, None))
+                if self.stopped.is_set():
+                    return
+            self.queue.put((None, None))
+        except Exception as e:
+            self.queue.put((None, e))
+
+    def __iter__(self):
+        while True:
+            test_instance, error = self.queue.get()
+            if error is not None:
+                raise error
+            if test_instance is None:
+                return
+            yield test_instance
+
+    # Unblocks a producer waiting for room in the queue; it exits after
+    # its next put()
+    def stop(self):
+        self.stopped.set()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
 class TestManager(object):
 
-    def __init__(self, testgen, datadir):
+    # store_backend is one of blockstore.STORE_BACKENDS. The default "dbm" is
+    # the on-disk store in datadir, which a later run can reopen to resume;
+    # "sqlite" keeps big runs out of memory and "memory" suits short runs.
+    # With pipeline_depth > 0 the generator runs on a TestProducer thread and
+    # prepares up to that many TestInstances while the current one is synced.
+    # Only use it with generators that don't depend on the nodes having
+    # processed the instances they yielded before.
+    # Every check is recorded in a comparison.ComparisonLog, written to
+    # compare_log if given. With differential=True mismatches don't stop the
+    # run; it ends with a report of all divergences instead.
+    def __init__(self, testgen, datadir, store_backend="dbm", pipeline_depth=0,
+                 differential=False, compare_log=None):
         self.test_generator = testgen
         self.connections    = []
         self.test_nodes     = []
-        self.block_store    = BlockStore(datadir)
-        self.tx_store       = TxStore(datadir)
+        self.block_store    = BlockStore(datadir, store_backend)
+        self.tx_store       = TxStore(datadir, store_backend)
         self.ping_counter   = 1
+        self.pipeline_depth = pipeline_depth
+        self.stage_times    = dict.fromkeys(("generate", "send", "sync", "verify"), 0.0)
+        self.differential   = differential
+        self.compare_log    = compare_log
+        self.comparison     = None
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -185,19 +270,28 @@ class TestManager(object):
             # associated NodeConn
             test_node.add_connection(self.connections[-1])
 
+    # Whether predicate(node) holds for every TestNode, each one checked
+    # under its cb_lock, as the network thread changes them under it
+    def all_nodes(self, predicate):
+        for node in self.test_nodes:
+            with node.cb_lock:
+                if not predicate(node):
+                    return False
+        return True
+
     def wait_for_disconnections(self):
         def disconnected():
-            return all(node.closed for node in self.test_nodes)
+            return self.all_nodes(lambda node: node.closed)
         return wait_until(disconnected, timeout=10)
 
     def wait_for_verack(self):
         def veracked():
-            return all(node.verack_received for node in self.test_nodes)
+            return self.all_nodes(lambda node: node.verack_received)
         return wait_until(veracked, timeout=10)
 
     def wait_for_pings(self, counter):
         def received_pongs():
-            return all(node.received_ping_response(counter) for node in self.test_nodes)
+            return self.all_nodes(lambda node: node.received_ping_response(counter))
         return wait_until(received_pongs)
 
     # sync_blocks: Wait for all connections to request the blockhash given
@@ -205,13 +299,12 @@ class TestManager(object):
     # the response by using a ping (and waiting for pong with same nonce).
     def sync_blocks(self, blockhash, num_blocks):
         def blocks_requested():
-            return all(
-                blockhash in node.block_request_map and node.block_request_map[blockhash]
-                for node in self.test_nodes
-            )
+            return self.all_nodes(
+                lambda node: blockhash in node.block_request_map and node.block_request_map[blockhash])
 
-        # --> error if not requested
-        if not wait_until(blocks_requested, attempts=20*num_blocks):
+        # --> error if not requested; in differential mode the nodes that
+        # didn't ask show up in the comparison log
+        if not wait_until(blocks_requested, attempts=20*num_blocks) and not self.differential:
             # print [ c.cb.block_request_map for c in self.connections ]
             raise AssertionError("Not all nodes requested block")
 
@@ -225,15 +318,13 @@ class TestManager(object):
 
     # Analogous to sync_block (see above)
     def sync_transaction(self, txhash, num_events):
-        # Wait for nodes to request transaction (50ms sleep * 20 tries * num_events)
+        # Wait for nodes to request transaction (1 second per event)
         def transaction_requested():
-            return all(
-                txhash in node.tx_request_map and node.tx_request_map[txhash]
-                for node in self.test_nodes
-            )
+            return self.all_nodes(
+                lambda node: txhash in node.tx_request_map and node.tx_request_map[txhash])
 
         # --> error if not requested
-        if not wait_until(transaction_requested, attempts=20*num_events):
+        if not wait_until(transaction_requested, attempts=20*num_events) and not self.differential:
             # print [ c.cb.tx_request_map for c in self.connections ]
             raise AssertionError("Not all nodes requested transaction")
 
@@ -246,20 +337,24 @@ class TestManager(object):
         self.ping_counter += 1
 
         # Sort inv responses from each node
-        with mininode_lock:
-            [ c.cb.lastInv.sort() for c in self.connections ]
+        for c in self.connections:
+            with c.cb.cb_lock:
+                c.cb.lastInv.sort()
 
     # Verify that the tip of each connection all agree with each other, and
     # with the expected outcome (if given)
     def check_results(self, blockhash, outcome):
-        with mininode_lock:
-            for c in self.connections:
-                if outcome is None:
-                    if c.cb.bestblockhash != self.connections[0].cb.bestblockhash:
-                        return False
-                elif ((c.cb.bestblockhash == blockhash) != outcome):
+        tips = []
+        for c in self.connections:
+            with c.cb.cb_lock:
+                tips.append(c.cb.bestblockhash)
+        for tip in tips:
+            if outcome is None:
+                if tip != tips[0]:
                     return False
-            return True
+            elif ((tip == blockhash) != outcome):
+                return False
+        return True
 
     # Either check that the mempools all agree with each other, or that
     # txhash's presence in the mempool matches the outcome specified.
@@ -268,24 +363,140 @@ class TestManager(object):
     # perhaps it would be useful to add the ability to check explicitly that
     # a particular tx's existence in the mempool is the same across all nodes.
     def check_mempool(self, txhash, outcome):
-        with mininode_lock:
-            for c in self.connections:
-                if outcome is None:
-                    # Make sure the mempools agree with each other
-                    if c.cb.lastInv != self.connections[0].cb.lastInv:
-                        # print c.rpc.getrawmempool()
-                        return False
-                elif ((txhash in c.cb.lastInv) != outcome):
-                    # print c.rpc.getrawmempool(), c.cb.lastInv
+        invs = []
+        for c in self.connections:
+            with c.cb.cb_lock:
+                invs.append(list(c.cb.lastInv))
+        for inv in invs:
+            if outcome is None:
+                # Make sure the mempools agree with each other
+                if inv != invs[0]:
+                    # print c.rpc.getrawmempool()
                     return False
-            return True
+            elif ((txhash in inv) != outcome):
+                # print c.rpc.getrawmempool(), c.cb.lastInv
+                return False
+        return True
+
+    # Accumulates the time spent in stage ("generate", "send", "sync" or
+    # "verify"); generate runs on the producer thread in pipelined mode.
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stage_times[name] += time.time() - start
+
+    # Holds the cb_lock of every connection, always taken in the same order
+    # and before any store lock, as on_getdata does
+    @contextmanager
+    def all_cb_locks(self):
+        with ExitStack() as stack:
+            for c in self.connections:
+                stack.enter_context(c.cb.cb_lock)
+            yield
+
+    # The mempool is only known right after check_mempool() asked for it,
+    # so block checks leave it out
+    def node_outcomes(self, objhash, accepted, mempool=False):
+        nodes = []
+        for c in self.connections:
+            with c.cb.cb_lock:
+                nodes.append((accepted(c.cb), c.cb.bestblockhash,
+                              c.cb.rejects.get(objhash),
+                              mempool_hash(c.cb.lastInv) if mempool else None))
+        return nodes
+
+    # Records the check of a block in the comparison log; raises on a
+    # mismatch unless running in differential mode
+    def verify_block(self, test_number, blockhash, tip, outcome, error):
+        matched = self.check_results(tip, outcome)
+        self.comparison.record(test_number, "block", blockhash, outcome, matched,
+                               self.node_outcomes(blockhash, lambda node: node.bestblockhash == tip))
+        if not matched and not self.differential:
+            raise AssertionError(error)
+
+    def verify_tx(self, test_number, txhash, outcome, error):
+        matched = self.check_mempool(txhash, outcome)
+        self.comparison.record(test_number, "tx", txhash, outcome, matched,
+                               self.node_outcomes(txhash, lambda node: txhash in node.lastInv,
+                                                 mempool=True))
+        if not matched and not self.differential:
+            raise AssertionError(error)
+
+    # Snapshots the objects of a TestInstance, so the generator can change
+    # them again while they are being synced
+    def prepare_instance(self, test_instance):
+        objects = []
+        for test_obj in test_instance.blocks_and_transactions:
+            b_or_t = test_obj[0]
+            if isinstance(b_or_t, CBlock):
+                prepared = self.block_store.prepare_block(b_or_t)
+                # each test_obj can have an optional third argument
+                # to specify the tip we should compare with
+                # (default is to use the block being tested)
+                tip = test_obj[2] if len(test_obj) >= 3 else b_or_t.sha256
+                objects.append(TestObject(BLOCK, prepared, test_obj[1], tip))
+            elif isinstance(b_or_t, CBlockHeader):
+                objects.append(TestObject(HEADER, CBlockHeader(b_or_t), None, None))
+            else:
+                assert(isinstance(b_or_t, CTransaction))
+                prepared = self.tx_store.prepare_transaction(b_or_t)
+                objects.append(TestObject(TX, prepared, test_obj[1], None))
+        return PreparedInstance(objects, test_instance.sync_every_block,
+                                test_instance.sync_every_tx)
+
+    def prepared_tests(self):
+        tests = iter(self.test_generator.get_tests())
+        while True:
+            with self.stage("generate"):
+                test_instance = next(tests, None)
+                if test_instance is None:
+                    return
+                prepared = self.prepare_instance(test_instance)
+            yield prepared
+
+    def report_stages(self, elapsed):
+        print("comptool stages: " + ", ".join(
+            "%s %.2fs" % (name, secs) for name, secs in self.stage_times.items()) +
+            " (run %.2fs%s)" % (elapsed, ", pipelined" if self.pipeline_depth else ""))
 
     def run(self):
         # Wait until verack is received
         self.wait_for_verack()
 
+        start = time.time()
+        self.comparison = ComparisonLog(len(self.connections))
+        if self.pipeline_depth:
+            producer = TestProducer(self.prepared_tests(), self.pipeline_depth)
+            producer.start()
+            tests = iter(producer)
+        else:
+            producer = None
+            tests = self.prepared_tests()
+        try:
+            self.run_tests(tests)
+        finally:
+            if producer is not None:
+                producer.stop()
+            if self.compare_log is not None:
+                self.comparison.write(self.compare_log)
+        self.report_stages(time.time() - start)
+        divergences = len(self.comparison.divergences())
+        if divergences:
+            print(self.comparison.report())
+
+        [ c.disconnect_node() for c in self.connections ]
+        self.wait_for_disconnections()
+        self.block_store.close()
+        self.tx_store.close()
+        if divergences:
+            raise AssertionError("%d of %d checks diverged" % (divergences, len(self.comparison)))
+
+    def run_tests(self, tests):
         test_number = 1
-        for test_instance in self.test_generator.get_tests():
+        for test_instance in tests:
             print(f'Running test #{test_number}...')
             # We use these variables to keep track of the last block
             # and last transaction in the tests, which are used
@@ -293,20 +504,15 @@ class TestManager(object):
             [ block, block_outcome, tip ] = [ None, None, None ]
             [ tx, tx_outcome ] = [ None, None ]
             invqueue = []
+            checked = len(self.comparison)
 
-            for test_obj in test_instance.blocks_and_transactions:
-                b_or_t = test_obj[0]
-                outcome = test_obj[1]
+            for test_obj in test_instance.objects:
+                outcome = test_obj.outcome
                 # Determine if we're dealing with a block or tx
-                if isinstance(b_or_t, CBlock):  # Block test runner
-                    block = b_or_t
+                if test_obj.kind == BLOCK:  # Block test runner
+                    block = test_obj.prepared
                     block_outcome = outcome
-                    tip = block.sha256
-                    # each test_obj can have an optional third argument
-                    # to specify the tip we should compare with
-                    # (default is to use the block being tested)
-                    if len(test_obj) >= 3:
-                        tip = test_obj[2]
+                    tip = test_obj.tip
 
                     # Add to shared block_store, set as current block
                     # If there was an open getdata request for the block
@@ -314,73 +520,84 @@ class TestManager(object):
                     # block_store, then immediately deliver, because the
                     # node wouldn't send another getdata request while
                     # the earlier one is outstanding.
-                    first_block_with_hash = True
-                    if self.block_store.get(block.sha256) is not None:
-                        first_block_with_hash = False
-                    with mininode_lock:
-                        self.block_store.add_block(block)
+                    # All cb_locks are held while the block is stored, so
+                    # an on_getdata can't slip in between the insert and the
+                    # request_map check and get the block sent twice.
+                    with self.stage("send"), self.all_cb_locks():
+                        first_block_with_hash = not self.block_store.contains(block.sha256)
+                        self.block_store.add_prepared(block)
                         for c in self.connections:
                             if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
                                 # There was a previous request for this block hash
                                 # Most likely, we delivered a header for this block
                                 # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
+                                if block.record is not None:
+                                    c.send_message(record_message(b"block", block.record))
                             else:
                                 c.cb.block_request_map[block.sha256] = False
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
-                        [ c.cb.send_inv(block) for c in self.connections ]
-                        self.sync_blocks(block.sha256, 1)
-                        if (not self.check_results(tip, outcome)):
-                            raise AssertionError("Test #%d FAILED" % test_number)
+                        with self.stage("send"):
+                            [ c.send_message(msg_inv([CInv(2, block.sha256)])) for c in self.connections ]
+                        with self.stage("sync"):
+                            self.sync_blocks(block.sha256, 1)
+                        with self.stage("verify"):
+                            self.verify_block(test_number, block.sha256, tip, outcome,
+                                              "Test #%d FAILED" % test_number)
                     else:
                         invqueue.append(CInv(2, block.sha256))
-                elif isinstance(b_or_t, CBlockHeader):
-                    block_header = b_or_t
-                    self.block_store.add_header(block_header)
+                elif test_obj.kind == HEADER:
+                    with self.stage("send"):
+                        self.block_store.add_header(test_obj.prepared)
                 else:  # Tx test runner
-                    assert(isinstance(b_or_t, CTransaction))
-                    tx = b_or_t
+                    tx = test_obj.prepared
                     tx_outcome = outcome
                     # Add to shared tx store and clear map entry
-                    with mininode_lock:
-                        self.tx_store.add_transaction(tx)
+                    with self.stage("send"), self.all_cb_locks():
+                        self.tx_store.add_prepared(tx)
                         for c in self.connections:
                             c.cb.tx_request_map[tx.sha256] = False
                     # Again, either inv to all nodes or save for later
                     if (test_instance.sync_every_tx):
-                        [ c.cb.send_inv(tx) for c in self.connections ]
-                        self.sync_transaction(tx.sha256, 1)
-                        if (not self.check_mempool(tx.sha256, outcome)):
-                            raise AssertionError("Test failed at test %d" % test_number)
+                        with self.stage("send"):
+                            [ c.send_message(msg_inv([CInv(1, tx.sha256)])) for c in self.connections ]
+                        with self.stage("sync"):
+                            self.sync_transaction(tx.sha256, 1)
+                        with self.stage("verify"):
+                            self.verify_tx(test_number, tx.sha256, outcome,
+                                           "Test failed at test %d" % test_number)
                     else:
                         invqueue.append(CInv(1, tx.sha256))
                 # Ensure we're not overflowing the inv queue
                 if len(invqueue) == MAX_INV_SZ:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
+                    with self.stage("send"):
+                        [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
                     invqueue = []
 
             # Do final sync if we weren't syncing on every block or every tx.
             if (not test_instance.sync_every_block and block is not None):
                 if len(invqueue) > 0:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
+                    with self.stage("send"):
+                        [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
                     invqueue = []
-                self.sync_blocks(block.sha256, len(test_instance.blocks_and_transactions))
-                if (not self.check_results(tip, block_outcome)):
-                    raise AssertionError("Block test failed at test %d" % test_number)
+                with self.stage("sync"):
+                    self.sync_blocks(block.sha256, len(test_instance.objects))
+                with self.stage("verify"):
+                    self.verify_block(test_number, block.sha256, tip, block_outcome,
+                                      "Block test failed at test %d" % test_number)
             if (not test_instance.sync_every_tx and tx is not None):
                 if len(invqueue) > 0:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
+                    with self.stage("send"):
+                        [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
                     invqueue = []
-                self.sync_transaction(tx.sha256, len(test_instance.blocks_and_transactions))
-                if (not self.check_mempool(tx.sha256, tx_outcome)):
-                    raise AssertionError("Mempool test failed at test %d" % test_number)
-
-            print("Test #%d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ])
+                with self.stage("sync"):
+                    self.sync_transaction(tx.sha256, len(test_instance.objects))
+                with self.stage("verify"):
+                    self.verify_tx(test_number, tx.sha256, tx_outcome,
+                                   "Mempool test failed at test %d" % test_number)
+
+            with self.stage("verify"):
+                print("Test #%d: %s" % (test_number, "PASS" if all(self.comparison.matched[checked:]) else "DIVERGED"),
+                      [ c.rpc.getblockcount() for c in self.connections ])
             test_number += 1
-
-        [ c.disconnect_node() for c in self.connections ]
-        self.wait_for_disconnections()
-        self.block_store.close()
-        self.tx_store.close()
@@ -1,6 +1,11 @@
 from operator import itemgetter
 import struct
-from functools import reduce
+from functools import reduce, lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DEBUG = False
 VERBOSE = False
@@ -9,83 +14,96 @@ VERBOSE = False
 word_size = 32
 word_mask = (1<<word_size)-1
 
+class CodecPlan(object):
+    '''Precomputed tables for converting between a packed big-endian stream
+    of bit_len-bit elements and an array of (bit_len+7)//8 + byte_pad byte
+    big-endian elements.
+
+    Parameters are checked once, when the plan is built; shift tables are
+    cached per element count.  Use codec_plan() to get the shared instance.'''
+
+    _formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    def __init__(self, bit_len, byte_pad=0):
+        assert bit_len >= 8 and word_size >= 7+bit_len
+        self.bit_len = bit_len
+        self.byte_pad = byte_pad
+        self.width = (bit_len+7)//8 + byte_pad
+        self.mask = (1 << bit_len) - 1
+        # Shift that moves the leading byte of an element to the low byte
+        self.lead_shift = 8*(self.width-1)
+        self._format = self._formats.get(self.width)
+        self._shifts = {}
+
+    def shifts(self, count):
+        '''Offsets of count packed elements from the end of the stream.'''
+        shifts = self._shifts.get(count)
+        if shifts is None:
+            shifts = self._shifts[count] = [
+                self.bit_len*(count-j-1) for j in range(count)]
+        return shifts
+
+    def unpack(self, inp):
+        '''Return the values of the packed elements of inp.'''
+        count = 8*len(inp)//self.bit_len
+        acc = int.from_bytes(inp, 'big') >> (8*len(inp) - count*self.bit_len)
+        mask = self.mask
+        return [(acc >> s) & mask for s in self.shifts(count)]
+
+    def pack(self, values, out_len):
+        '''Return the first out_len bytes of the packed stream of values.'''
+        count = len(values)
+        acc = 0
+        for v, s in zip(values, self.shifts(count)):
+            acc |= v << s
+        acc >>= count*self.bit_len - 8*out_len
+        return bytearray(acc.to_bytes(out_len, 'big'))
+
+    def to_elements(self, values):
+        if self._format is not None:
+            return bytearray(struct.pack('>%d%s' % (len(values), self._format), *values))
+        width = self.width
+        return bytearray(b''.join([v.to_bytes(width, 'big') for v in values]))
+
+    def from_elements(self, inp):
+        count = len(inp)//self.width
+        if self._format is not None:
+            values = struct.unpack_from('>%d%s' % (count, self._format), inp)
+        else:
+            width = self.width
+            values = [int.from_bytes(inp[i:i+width], 'big')
+                      for i in range(0, count*width, width)]
+        # Like compress_array() always has, mask the element to bit_len bits
+        # and OR in its raw leading byte.
+        mask, lead_shift = self.mask, self.lead_shift
+        return [(v & mask) | ((v >> lead_shift) & 0xFF) for v in values]
+
+    def expand(self, inp, out_len):
+        assert out_len == 8*self.width*len(inp)//self.bit_len
+        out = self.to_elements(self.unpack(inp))
+        if len(out) < out_len:
+            out.extend(bytes(out_len - len(out)))
+        return out
+
+    def compress(self, inp, out_len):
+        assert out_len == self.bit_len*len(inp)//(8*self.width)
+        return self.pack(self.from_elements(inp), out_len)
+
+@lru_cache(maxsize=None)
+def codec_plan(bit_len, byte_pad=0):
+    return CodecPlan(bit_len, byte_pad)
+
 def expand_array(inp, out_len, bit_len, byte_pad=0):
-    assert bit_len >= 8 and word_size >= 7+bit_len
-    bit_len_mask = (1<<bit_len)-1
-
-    out_width = (bit_len+7)//8 + byte_pad
-    assert out_len == 8*out_width*len(inp)//bit_len
-    out = bytearray(out_len)
-
-    bit_len_mask = (1 << bit_len) - 1
-
-    # The acc_bits least-significant bits of acc_value represent a bit sequence
-    # in big-endian order.
-    acc_bits = 0;
-    acc_value = 0;
-
-    j = 0
-    for i in range(len(inp)):
-        acc_value = ((acc_value << 8) & word_mask) | inp[i]
-        acc_bits += 8
-
-        # When we have bit_len or more bits in the accumulator, write the next
-        # output element.
-        if acc_bits >= bit_len:
-            acc_bits -= bit_len
-            for x in range(byte_pad, out_width):
-                out[j+x] = (
-                    # Big-endian
-                    acc_value >> (acc_bits+(8*(out_width-x-1)))
-                ) & (
-                    # Apply bit_len_mask across byte boundaries
-                    (bit_len_mask >> (8*(out_width-x-1))) & 0xFF
-                )
-            j += out_width
-
-    return out
+    return codec_plan(bit_len, byte_pad).expand(inp, out_len)
 
 def compress_array(inp, out_len, bit_len, byte_pad=0):
-    assert bit_len >= 8 and word_size >= 7+bit_len
-
-    in_width = (bit_len+7)//8 + byte_pad
-    assert out_len == bit_len*len(inp)//(8*in_width)
-    out = bytearray(out_len)
-
-    bit_len_mask = (1 << bit_len) - 1
-
-    # The acc_bits least-significant bits of acc_value represent a bit sequence
-    # in big-endian order.
-    acc_bits = 0;
-    acc_value = 0;
-
-    j = 0
-    for i in range(out_len):
-        # When we have fewer than 8 bits left in the accumulator, read the next
-        # input element.
-        if acc_bits < 8:
-            acc_value = ((acc_value << bit_len) & word_mask) | inp[j]
-            for x in range(byte_pad, in_width):
-                acc_value = acc_value | (
-                    (
-                        # Apply bit_len_mask across byte boundaries
-                        inp[j+x] & ((bit_len_mask >> (8*(in_width-x-1))) & 0xFF)
-                    ) << (8*(in_width-x-1))); # Big-endian
-            j += in_width
-            acc_bits += bit_len
-
-        acc_bits -= 8
-        out[i] = (acc_value >> acc_bits) & 0xFF
-
-    return out
+    return codec_plan(bit_len, byte_pad).compress(inp, out_len)
 
 def get_indices_from_minimal(minimal, bit_len):
     eh_index_size = 4
     assert (bit_len+7)//8 <= eh_index_size
-    len_indices = 8*eh_index_size*len(minimal)//bit_len
     byte_pad = eh_index_size - (bit_len+7)//8
-    expanded = expand_array(minimal, len_indices, bit_len, byte_pad)
-    return [struct.unpack('>I', expanded[i:i+4])[0] for i in range(0, len_indices, eh_index_size)]
+    return codec_plan(bit_len, byte_pad).unpack(minimal)
 
 def get_minimal_from_indices(indices, bit_len):
     eh_index_size = 4
@@ -93,8 +111,9 @@ def get_minimal_from_indices(indices, bit_len):
     len_indices = len(indices)*eh_index_size
     min_len = bit_len*len_indices//(8*eh_index_size)
     byte_pad = eh_index_size - (bit_len+7)//8
-    byte_indices = bytearray(b''.join([struct.pack('>I', i) for i in indices]))
-    return compress_array(byte_indices, min_len, bit_len, byte_pad)
+    plan = codec_plan(bit_len, byte_pad)
+    mask, lead_shift = plan.mask, plan.lead_shift
+    return plan.pack([(i & mask) | ((i >> lead_shift) & 0xFF) for i in indices], min_len)
 
 
 def hash_nonce(digest, nonce):
@@ -228,56 +247,266 @@ def gbp_basic(digest, n, k):
             j -= 1
     return [get_minimal_from_indices(soln, collision_length+1) for soln in solns]
 
-def gbp_validate(digest, minimal, n, k):
+def _np_expand_hashes(hashes, n, k):
+    '''Vectorized expand_array() over a (rows, n/8) uint8 matrix of hash
+    outputs, returning the expanded StepRows packed into big-endian uint32
+    words (so that word-wise lexicographic order equals byte order).'''
+    collision_length = n//(k+1)
+    out_width = (collision_length+7)//8
+    hash_length = (k+1)*out_width
+    rows = len(hashes)
+
+    bits = np.unpackbits(hashes, axis=1)[:, :(k+1)*collision_length]
+    bits = bits.reshape(rows, k+1, collision_length).astype(np.uint32)
+    weights = np.left_shift(np.uint32(1), np.arange(collision_length-1, -1, -1, dtype=np.uint32))
+    values = (bits*weights).sum(axis=2, dtype=np.uint32)
+
+    shifts = np.arange(8*(out_width-1), -1, -8, dtype=np.uint32)
+    expanded = (values[:, :, None] >> shifts) & 0xFF
+    expanded = expanded.astype(np.uint8).reshape(rows, hash_length)
+
+    words = (hash_length+3)//4
+    padded = np.zeros((rows, 4*words), dtype=np.uint8)
+    padded[:, :hash_length] = expanded
+    return padded.view('>u4').astype(np.uint32)
+
+def _np_byte_mask(words, start, end):
+    '''Per-word masks selecting bytes [start, end) of a packed StepRow.'''
+    mask = np.zeros(words, dtype=np.uint32)
+    for b in range(start, end):
+        mask[b//4] |= np.uint32(0xFF << (8*(3 - b%4)))
+    return mask
+
+def _np_sort_rows(X, idx):
+    order = np.lexsort(X.T[::-1])
+    return X[order], idx[order]
+
+def _np_collision_pairs(X, mask):
+    '''Return the (left, right) row pairs that collide on the masked bytes,
+    in exactly the order gbp_basic() visits them: groups from the end of the
+    sorted list backwards, and within a group l = 0.., m = l+1.. counted from
+    the last row of the group.'''
+    rows = len(X)
+    if rows < 2:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+    boundary = ((X[1:] ^ X[:-1]) & mask).any(axis=1)
+    starts = np.flatnonzero(np.concatenate(([True], boundary)))
+    ends = np.append(starts[1:], rows)
+    sizes = ends - starts
+
+    lefts, rights, groups, ranks = [], [], [], []
+    for size in np.unique(sizes[sizes > 1]):
+        sel = np.flatnonzero(sizes == size)
+        l, m = np.triu_indices(size, 1)
+        last = (ends[sel] - 1)[:, None]
+        lefts.append((last - l).ravel())
+        rights.append((last - m).ravel())
+        groups.append(np.repeat(sel, len(l)))
+        ranks.append(np.tile(np.arange(len(l)), len(sel)))
+    if not lefts:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+
+    left = np.concatenate(lefts)
+    right = np.concatenate(rights)
+    order = np.lexsort((np.concatenate(ranks), -np.concatenate(groups)))
+    return left[order], right[order]
+
+def _np_distinct_indices(idx, left, right):
+    joined = np.sort(np.concatenate((idx[left], idx[right]), axis=1), axis=1)
+    return ~(joined[:, 1:] == joined[:, :-1]).any(axis=1)
+
+def _np_join_indices(idx, left, right):
+    # Order the index subtrees by their first index, as gbp_basic() does
+    swap = (idx[left, 0] > idx[right, 0])[:, None]
+    lr = np.concatenate((idx[left], idx[right]), axis=1)
+    rl = np.concatenate((idx[right], idx[left]), axis=1)
+    return np.where(swap, rl, lr)
+
+def gbp_numpy(digest, n, k):
+    '''Vectorized implementation of Basic Wagner's algorithm for the GBP.
+
+    Produces exactly the same solutions, in the same order, as gbp_basic();
+    rows are kept as packed uint32 hash words plus index arrays.'''
     validate_params(n, k)
+    assert n % 8 == 0, 'Hash outputs must be byte-aligned'
     collision_length = n//(k+1)
-    hash_length = (k+1)*((collision_length+7)//8)
     indices_per_hash_output = 512//n
-    solution_width = (1 << k)*(collision_length+1)//8
-
-    if len(minimal) != solution_width:
-        print('Invalid solution length: %d (expected %d)' % \
-            (len(minimal), solution_width))
-        return False
+    init_size = 2**(collision_length+1)
 
-    X = []
-    for i in get_indices_from_minimal(minimal, collision_length+1):
-        r = i % indices_per_hash_output
+    # 1) Generate first list
+    if DEBUG: print('Generating first list')
+    tmp_hashes = []
+    for g in range((init_size + indices_per_hash_output - 1)//indices_per_hash_output):
         # X_i = H(I||V||x_i)
         curr_digest = digest.copy()
-        hash_xi(curr_digest, i//indices_per_hash_output)
+        hash_xi(curr_digest, g)
         tmp_hash = curr_digest.digest()
-        X.append((
-            expand_array(bytearray(tmp_hash[r*n//8:(r+1)*n//8]),
-                         hash_length, collision_length),
-            (i,)
-        ))
+        tmp_hashes.append(tmp_hash[:indices_per_hash_output*n//8])
+    hashes = np.frombuffer(b''.join(tmp_hashes), dtype=np.uint8)
+    hashes = hashes.reshape(-1, n//8)[:init_size]
+    X = _np_expand_hashes(hashes, n, k)
+    idx = np.arange(init_size, dtype=np.uint32)[:, None]
+
+    # 3) Repeat step 2 until 2n/(k+1) bits remain
+    for i in range(1, k):
+        if DEBUG: print('Round %d:' % i)
+        # 2a) Sort the list
+        X, idx = _np_sort_rows(X, idx)
+        # 2b) Find collisions on the i-th segment
+        mask = _np_byte_mask(X.shape[1], (i-1)*collision_length//8, i*collision_length//8)
+        left, right = _np_collision_pairs(X, mask)
+        # 2c) Keep pairs with distinct indices and store (X_i ^ X_j, (i, j))
+        keep = _np_distinct_indices(idx, left, right)
+        left, right = left[keep], right[keep]
+        X, idx = X[left] ^ X[right], _np_join_indices(idx, left, right)
+
+    # k+1) Find a collision on last 2n(k+1) bits
+    if DEBUG: print('Final round:')
+    X, idx = _np_sort_rows(X, idx)
+    mask = _np_byte_mask(X.shape[1], (k-1)*collision_length//8, (k+1)*collision_length//8)
+    left, right = _np_collision_pairs(X, mask)
+    keep = ~(X[left] ^ X[right]).any(axis=1)
+    left, right = left[keep], right[keep]
+    keep = _np_distinct_indices(idx, left, right)
+    solns = _np_join_indices(idx, left[keep], right[keep])
+    return [get_minimal_from_indices(soln.tolist(), collision_length+1) for soln in solns]
+
+# Fastest available solver; used by CBlock.solve()
+gbp_solve = gbp_numpy if np is not None else gbp_basic
+
+INVALID_COLLISION = 'Invalid solution: invalid collision length between StepRows'
+INVALID_ORDER = 'Invalid solution: Index tree incorrectly ordered'
+INVALID_DUPLICATES = 'Invalid solution: duplicate indices'
+
+def _solution_hashes(digest, indices, n):
+    '''Return the n-bit hash output for every index of a solution, calling
+    hash_xi() only once for indices that share a hash output.'''
+    indices_per_hash_output = 512//n
+    outputs = {}
+    hashes = []
+    for i in indices:
+        g, r = divmod(i, indices_per_hash_output)
+        tmp_hash = outputs.get(g)
+        if tmp_hash is None:
+            # X_i = H(I||V||x_i)
+            curr_digest = digest.copy()
+            hash_xi(curr_digest, g)
+            tmp_hash = outputs[g] = curr_digest.digest()
+        hashes.append(tmp_hash[r*n//8:(r+1)*n//8])
+    return hashes
+
+def gbp_check(digest, minimal, n, k):
+    '''Validate a solution, returning None if it is valid or the reason it
+    is not.'''
+    validate_params(n, k)
+    collision_length = n//(k+1)
+    hash_length = (k+1)*((collision_length+7)//8)
+    solution_width = (1 << k)*(collision_length+1)//8
+
+    if len(minimal) != solution_width:
+        return 'Invalid solution length: %d (expected %d)' % \
+            (len(minimal), solution_width)
+
+    indices = get_indices_from_minimal(minimal, collision_length+1)
+    X = [(expand_array(bytearray(h), hash_length, collision_length), (i,))
+         for h, i in zip(_solution_hashes(digest, indices, n), indices)]
 
     for r in range(1, k+1):
         Xc = []
         for i in range(0, len(X), 2):
             if not has_collision(X[i][0], X[i+1][0], r, collision_length):
-                print('Invalid solution: invalid collision length between StepRows')
-                return False
+                return INVALID_COLLISION
             if X[i+1][1][0] < X[i][1][0]:
-                print('Invalid solution: Index tree incorrectly ordered')
-                return False
+                return INVALID_ORDER
             if not distinct_indices(X[i][1], X[i+1][1]):
-                print('Invalid solution: duplicate indices')
-                return False
+                return INVALID_DUPLICATES
             Xc.append((xor(X[i][0], X[i+1][0]), X[i][1] + X[i+1][1]))
         X = Xc
 
     if len(X) != 1:
-        print('Invalid solution: incorrect length after end of rounds: %d' % len(X))
-        return False
+        return 'Invalid solution: incorrect length after end of rounds: %d' % len(X)
 
     if count_zeroes(X[0][0]) != 8*hash_length:
-        print('Invalid solution: incorrect number of zeroes: %d' % count_zeroes(X[0][0]))
-        return False
+        return 'Invalid solution: incorrect number of zeroes: %d' % count_zeroes(X[0][0])
 
+    return None
+
+def gbp_validate(digest, minimal, n, k):
+    reason = gbp_check(digest, minimal, n, k)
+    if reason is not None:
+        print(reason)
+        return False
     return True
 
+def _np_check_rounds(X, idx, n, k):
+    '''Run the collision rounds of gbp_check() over a whole batch at once.
+
+    X holds the packed StepRows (batch, 2^k, words) and idx the solution
+    indices (batch, 2^k); returns a reason (or None) per solution.'''
+    collision_length = n//(k+1)
+    hash_length = (k+1)*((collision_length+7)//8)
+    batch, words = len(X), X.shape[2]
+    reasons = [None]*batch
+    alive = np.ones(batch, dtype=bool)
+    failures = (None, INVALID_COLLISION, INVALID_ORDER, INVALID_DUPLICATES)
+
+    for r in range(1, k+1):
+        left, right = X[:, 0::2], X[:, 1::2]
+        mask = _np_byte_mask(words, (r-1)*collision_length//8, r*collision_length//8)
+        collides = ~((left ^ right) & mask).any(axis=2)
+        width = 1 << (r-1)
+        tree = idx.reshape(batch, -1, 2*width)
+        ordered = tree[:, :, width] >= tree[:, :, 0]
+        leaves = np.sort(tree, axis=2)
+        distinct = ~(leaves[:, :, 1:] == leaves[:, :, :-1]).any(axis=2)
+        # Failure code of every pair, in the order gbp_check() tests them
+        code = np.where(~collides, 1, np.where(~ordered, 2, np.where(~distinct, 3, 0)))
+        failed = alive & code.any(axis=1)
+        for b in np.flatnonzero(failed):
+            reasons[b] = failures[code[b][code[b] != 0][0]]
+        alive &= ~failed
+        X = left ^ right
+
+    for b in np.flatnonzero(alive & X[:, 0].any(axis=1)):
+        final = bytearray(X[b, 0].astype('>u4').tobytes()[:hash_length])
+        reasons[b] = 'Invalid solution: incorrect number of zeroes: %d' % count_zeroes(final)
+    return reasons
+
+def gbp_validate_many(items, n, k):
+    '''Validate a batch of (digest, minimal) pairs.
+
+    Returns a (valid, reason) tuple per pair, in input order, with reason None
+    for valid solutions.  With NumPy available the hashes of the whole batch
+    are expanded in bulk and the collision rounds run on arrays.'''
+    validate_params(n, k)
+    if np is None or n % 8:
+        reasons = [gbp_check(digest, minimal, n, k) for digest, minimal in items]
+        return [(reason is None, reason) for reason in reasons]
+
+    collision_length = n//(k+1)
+    solution_width = (1 << k)*(collision_length+1)//8
+    reasons = [None]*len(items)
+    checked, indices, hashes = [], [], []
+    for pos, (digest, minimal) in enumerate(items):
+        if len(minimal) != solution_width:
+            reasons[pos] = 'Invalid solution length: %d (expected %d)' % \
+                (len(minimal), solution_width)
+            continue
+        soln = get_indices_from_minimal(minimal, collision_length+1)
+        checked.append(pos)
+        indices.append(soln)
+        hashes.extend(_solution_hashes(digest, soln, n))
+
+    if checked:
+        raw = np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(-1, n//8)
+        X = _np_expand_hashes(raw, n, k).reshape(len(checked), 1 << k, -1)
+        idx = np.array(indices, dtype=np.uint32)
+        for pos, reason in zip(checked, _np_check_rounds(X, idx, n, k)):
+            reasons[pos] = reason
+    return [(reason is None, reason) for reason in reasons]
+
 def zcash_person(n, k):
     return b'ZcashPoW' + struct.pack('<II', n, k)
 
@@ -24,22 +24,26 @@
 
 import struct
 import socket
-import asyncore
+import asyncio
 import time
 import sys
 import random
 from binascii import hexlify
-from io import BytesIO
+from collections import deque
 import hashlib
-from threading import RLock
+import itertools
+from operator import attrgetter
+from threading import Condition, Lock, RLock
 from threading import Thread
 import logging
-import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pyblake2 import blake2b
 
 from .equihash import (
-    gbp_basic,
+    gbp_solve,
     gbp_validate,
+    gbp_validate_many,
     hash_nonce,
     zcash_person,
 )
@@ -62,19 +66,79 @@ MAX_INV_SZ = 50000
 
 COIN = 100000 # 1 PSL in patoshis
 
-# Keep our own socket map for asyncore, so that we can track disconnects
-# ourselves (to workaround an issue with closing an asyncore socket when
-# using select)
+# All open NodeConns, keyed by id(). The NetworkThread keeps running the
+# event loop for as long as there are connections in here.
 mininode_socket_map = dict()
 
-# One lock for synchronizing all data access between the networking thread (see
-# NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
+# The asyncio event loop that every NodeConn runs on; see NetworkThread
+_network_loop = None
+
+def network_event_loop():
+    global _network_loop
+    with mininode_lock:
+        if _network_loop is None or _network_loop.is_closed():
+            _network_loop = asyncio.new_event_loop()
+        return _network_loop
+
+def in_network_thread():
+    try:
+        return asyncio.get_running_loop() is _network_loop
+    except RuntimeError:
+        return False
+
+# Schedules a coroutine (for example NodeConn.send_message_async()) on the
+# network thread and returns a concurrent.futures.Future for its result.
+def run_in_network_thread(coro):
+    return asyncio.run_coroutine_threadsafe(coro, network_event_loop())
+
+# Guards the creation of the network event loop. Message delivery does not
+# take it: each NodeConnCB has its own cb_lock, held while a message is
+# delivered to it, and NodeConn queues outgoing messages without locking.
+# The thread running the test logic should hold a callback's cb_lock while
+# accessing data shared with that NodeConnCB.
 mininode_lock = RLock()
 
+# Wakes the threads blocked in wait_until() whenever a message has been
+# delivered (or a connection closed) on any connection. The network thread
+# only takes the lock when some thread is actually waiting.
+_delivery_cond = Condition(Lock())
+_delivery_count = 0
+_delivery_waiters = 0
+
+def _notify_delivery():
+    global _delivery_count
+    _delivery_count += 1
+    if _delivery_waiters:
+        with _delivery_cond:
+            _delivery_cond.notify_all()
+
+# Waits until predicate() returns true, evaluating it again after every
+# delivered message instead of polling. Returns False on timeout; a timeout
+# of None waits forever. predicate() runs without any lock held, so it has
+# to take the cb_lock of each NodeConnCB whose state it reads (see
+# NodeConnCB.wait_until() for waiting on a single one).
+def wait_until(predicate, timeout=60):
+    global _delivery_waiters
+    deadline = None if timeout is None else time.time() + timeout
+    with _delivery_cond:
+        _delivery_waiters += 1
+    try:
+        while True:
+            seen = _delivery_count
+            if predicate():
+                return True
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            with _delivery_cond:
+                if _delivery_count == seen:
+                    _delivery_cond.wait(remaining)
+    finally:
+        with _delivery_cond:
+            _delivery_waiters -= 1
+
 # Serialization/deserialization tools
 def sha256(s):
     return hashlib.new('sha256', s).digest()
@@ -96,14 +160,101 @@ def ser_compactsize(n):
     return struct.pack("<BQ", 255, n)
 
 
+class ByteReader(object):
+    """Cursor over a bytes-like object, for deserializing without copying
+    the whole message.
+
+    Objects' deserialize(f) methods accept a ByteReader as well as any
+    file-like object.  Fixed-size fields are decoded in place with
+    precompiled Struct objects.  Variable-size fields (scripts, proofs,
+    ciphertexts, the Equihash solution) are still copied out by read():
+    received payloads are views into the connection's receive buffer, which
+    is reused for the next messages, and building the solution list from
+    bytes is faster than from a memoryview.  view() hands out memoryview
+    slices for data that is only used right away."""
+    __slots__ = ('buf', 'pos')
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data)
+        self.pos = pos
+
+    def read(self, n=-1):
+        return self.view(n).tobytes()
+
+    def view(self, n=-1):
+        pos = self.pos
+        end = len(self.buf) if n < 0 else min(pos + n, len(self.buf))
+        self.pos = end
+        return self.buf[pos:end]
+
+    def unpack(self, st):
+        r = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return r
+
+    def uint256(self):
+        pos = self.pos
+        if pos + 32 > len(self.buf):
+            raise struct.error("unpack requires a buffer of 32 bytes")
+        self.pos = pos + 32
+        return int.from_bytes(self.buf[pos:pos+32], "little")
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        return len(self.buf) - self.pos
+
+
+_uint8 = struct.Struct("<B")
+_uint16 = struct.Struct("<H")
+_uint32 = struct.Struct("<I")
+_int32 = struct.Struct("<i")
+_int64 = struct.Struct("<q")
+_uint64 = struct.Struct("<Q")
+# Message header: magic, NUL-padded command, payload length, checksum
+_msg_header = struct.Struct("<4s12sI4s")
+_msg_header_nochecksum = struct.Struct("<4s12sI")
+
+
+def deser_struct(f, st):
+    if isinstance(f, ByteReader):
+        return f.unpack(st)[0]
+    return st.unpack(f.read(st.size))[0]
+
+
+def deser_uint8(f):
+    return deser_struct(f, _uint8)
+
+
+def deser_uint16(f):
+    return deser_struct(f, _uint16)
+
+
+def deser_uint32(f):
+    return deser_struct(f, _uint32)
+
+
+def deser_int32(f):
+    return deser_struct(f, _int32)
+
+
+def deser_int64(f):
+    return deser_struct(f, _int64)
+
+
+def deser_uint64(f):
+    return deser_struct(f, _uint64)
+
+
 def deser_compactsize(f):
-    size = struct.unpack("<B", f.read(1))[0]
+    size = deser_uint8(f)
     if size == 253:
-        size = struct.unpack("<H", f.read(2))[0]
+        size = deser_uint16(f)
     elif size == 254:
-        size = struct.unpack("<I", f.read(4))[0]
+        size = deser_uint32(f)
     elif size == 255:
-        size = struct.unpack("<Q", f.read(8))[0]
+        size = deser_uint64(f)
     return size
 
 
@@ -121,27 +272,25 @@ def ser_string(s):
 
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    if isinstance(f, ByteReader):
+        return f.uint256()
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return int.from_bytes(s, "little")
+
+
+UINT256_MASK = (1 << 256) - 1
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    if len(s) < 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return int.from_bytes(s[:32], "little")
 
 
 def uint256_from_compact(c):
@@ -160,11 +309,16 @@ def deser_vector(f, c):
     return r
 
 
-def ser_vector(l):
-    r = ser_compactsize(len(l))
+def ser_vector_into(buf, l):
+    buf += ser_compactsize(len(l))
     for i in l:
-        r += i.serialize()
-    return r
+        i.serialize_into(buf)
+
+
+def ser_vector(l):
+    buf = bytearray()
+    ser_vector_into(buf, l)
+    return bytes(buf)
 
 
 def deser_uint256_vector(f):
@@ -177,10 +331,7 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compactsize(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compactsize(len(l)) + b"".join([ser_uint256(i) for i in l])
 
 
 def deser_string_vector(f):
@@ -193,45 +344,60 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compactsize(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    return ser_compactsize(len(l)) + b"".join([ser_string(sv) for sv in l])
 
 
 def deser_int_vector(f):
     size = deser_compactsize(f)
     r = []
     for i in range(size):
-        t = struct.unpack("<i", f.read(4))[0]
+        t = deser_int32(f)
         r.append(t)
     return r
 
 
 def ser_int_vector(l):
-    r = ser_compactsize(len(l))
-    for i in l:
-        r += struct.pack("<i", i)
-    return r
+    return ser_compactsize(len(l)) + struct.pack("<%di" % len(l), *l)
 
 def deser_char_vector(f):
     size = deser_compactsize(f)
-    r = []
-    for i in range(size):
-        t = struct.unpack("<B", f.read(1))[0]
-        r.append(t)
-    return r
+    r = f.read(size)
+    if len(r) != size:
+        raise struct.error("unpack requires a buffer of %d bytes" % size)
+    return list(r)
 
 
 def ser_char_vector(l):
-    r = ser_compactsize(len(l))
-    for i in l:
-        r += struct.pack("B", i)
-    return r
+    return ser_compactsize(len(l)) + bytes(l)
 
 # Objects that map to pasteld objects, which can be serialized/deserialized
+#
+# They use __slots__ to keep large blocks and chains small in memory, and
+# provide copy() as a fast replacement for copy.deepcopy().
+
+# Base of the serializable classes: serialize() is a thin wrapper around the
+# class' serialize_into(buf)
+class Serializable(object):
+    __slots__ = ()
+
+    def serialize(self):
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+
+def _copy_slots(obj):
+    # Shallow copy, for objects whose fields are all immutable
+    cls = obj.__class__
+    c = cls.__new__(cls)
+    for name in cls.__slots__:
+        setattr(c, name, getattr(obj, name))
+    return c
+
+
+class CAddress(Serializable):
+    __slots__ = ("nServices", "pchReserved", "ip", "port")
 
-class CAddress(object):
     def __init__(self):
         self.nServices = 1
         self.pchReserved = b"\x00" * 10 + b"\xff" * 2
@@ -239,70 +405,82 @@ class CAddress(object):
         self.port = 0
 
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+        self.nServices = deser_uint64(f)
         self.pchReserved = f.read(12)
         self.ip = socket.inet_ntoa(f.read(4))
         self.port = struct.unpack(">H", f.read(2))[0]
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nServices)
-        r += self.pchReserved
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+    def serialize_into(self, buf):
+        buf += _uint64.pack(self.nServices)
+        buf += self.pchReserved
+        buf += socket.inet_aton(self.ip)
+        buf += struct.pack(">H", self.port)
+
+    def copy(self):
+        return _copy_slots(self)
 
     def __repr__(self):
         return "CAddress(nServices=%i ip=%s port=%i)" % (self.nServices,
                                                          self.ip, self.port)
 
 
-class CInv(object):
+class CInv(Serializable):
     typemap = {
         0: b"Error",
         1: b"TX",
         2: b"Block"}
 
+    __slots__ = ("type", "hash")
+
     def __init__(self, t=0, h=0):
         self.type = t
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
+        self.type = deser_int32(f)
         self.hash = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
+    def serialize_into(self, buf):
+        buf += _int32.pack(self.type)
+        buf += ser_uint256(self.hash)
+
+    def copy(self):
+        return CInv(self.type, self.hash)
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
             % (self.typemap[self.type], self.hash)
 
 
-class CBlockLocator(object):
+class CBlockLocator(Serializable):
+    __slots__ = ("nVersion", "vHave")
+
     def __init__(self):
         self.nVersion = SPROUT_PROTO_VERSION
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_int32(f)
         self.vHave = deser_uint256_vector(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
+    def serialize_into(self, buf):
+        buf += _int32.pack(self.nVersion)
+        buf += ser_uint256_vector(self.vHave)
+
+    def copy(self):
+        c = CBlockLocator()
+        c.nVersion = self.nVersion
+        c.vHave = list(self.vHave)
+        return c
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%r)" \
             % (self.nVersion, self.vHave)
 
 
-class SpendDescription(object):
+class SpendDescription(Serializable):
+    __slots__ = ("cv", "anchor", "nullifier", "rk", "zkproof", "spendAuthSig")
+
     def __init__(self):
         self.cv = None
         self.anchor = None
@@ -319,22 +497,26 @@ class SpendDescription(object):
         self.zkproof = f.read(192)
         self.spendAuthSig = f.read(64)
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.cv)
-        r += ser_uint256(self.anchor)
-        r += ser_uint256(self.nullifier)
-        r += ser_uint256(self.rk)
-        r += self.zkproof
-        r += self.spendAuthSig
-        return r
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.cv)
+        buf += ser_uint256(self.anchor)
+        buf += ser_uint256(self.nullifier)
+        buf += ser_uint256(self.rk)
+        buf += self.zkproof
+        buf += self.spendAuthSig
+
+    def copy(self):
+        return _copy_slots(self)
 
     def __repr__(self):
         return "SpendDescription(cv=%064x, anchor=%064x, nullifier=%064x, rk=%064x, zkproof=%064x, spendAuthSig=%064x)" \
             % (self.cv, self.anchor, self.nullifier, self.rk, self.zkproof, self.spendauthsig)
 
 
-class OutputDescription(object):
+class OutputDescription(Serializable):
+    __slots__ = ("cv", "cmu", "ephemeralKey", "encCiphertext", "outCiphertext",
+                 "zkproof")
+
     def __init__(self):
         self.cv = None
         self.cmu = None
@@ -351,15 +533,16 @@ class OutputDescription(object):
         self.outCiphertext = f.read(80)
         self.zkproof = f.read(192)
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.cv)
-        r += ser_uint256(self.cmu)
-        r += ser_uint256(self.ephemeralKey)
-        r += self.encCiphertext
-        r += self.outCiphertext
-        r += self.zkproof
-        return r
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.cv)
+        buf += ser_uint256(self.cmu)
+        buf += ser_uint256(self.ephemeralKey)
+        buf += self.encCiphertext
+        buf += self.outCiphertext
+        buf += self.zkproof
+
+    def copy(self):
+        return _copy_slots(self)
 
     def __repr__(self):
         return "OutputDescription(cv=%064x, cmu=%064x, ephemeralKey=%064x, encCiphertext=%064x, outCiphertext=%064x, zkproof=%064x)" \
@@ -369,7 +552,10 @@ class OutputDescription(object):
 G1_PREFIX_MASK = 0x02
 G2_PREFIX_MASK = 0x0a
 
-class ZCProof(object):
+class ZCProof(Serializable):
+    __slots__ = ("g_A", "g_A_prime", "g_B", "g_B_prime", "g_C", "g_C_prime",
+                 "g_K", "g_H")
+
     def __init__(self):
         self.g_A = None
         self.g_A_prime = None
@@ -381,14 +567,14 @@ class ZCProof(object):
         self.g_H = None
 
     def deserialize(self, f):
-        def deser_g1(self, f):
-            leadingByte = struct.unpack("<B", f.read(1))[0]
+        def deser_g1(f):
+            leadingByte = deser_uint8(f)
             return {
                 'y_lsb': leadingByte & 1,
                 'x': f.read(32),
             }
-        def deser_g2(self, f):
-            leadingByte = struct.unpack("<B", f.read(1))[0]
+        def deser_g2(f):
+            leadingByte = deser_uint8(f)
             return {
                 'y_gt': leadingByte & 1,
                 'x': f.read(64),
@@ -402,21 +588,26 @@ class ZCProof(object):
         self.g_K = deser_g1(f)
         self.g_H = deser_g1(f)
 
-    def serialize(self):
-        def ser_g1(self, p):
-            return chr(G1_PREFIX_MASK | p['y_lsb']) + p['x']
-        def ser_g2(self, p):
-            return chr(G2_PREFIX_MASK | p['y_gt']) + p['x']
-        r = b""
-        r += ser_g1(self.g_A)
-        r += ser_g1(self.g_A_prime)
-        r += ser_g2(self.g_B)
-        r += ser_g1(self.g_B_prime)
-        r += ser_g1(self.g_C)
-        r += ser_g1(self.g_C_prime)
-        r += ser_g1(self.g_K)
-        r += ser_g1(self.g_H)
-        return r
+    def serialize_into(self, buf):
+        def ser_g1(p):
+            return bytes([G1_PREFIX_MASK | p['y_lsb']]) + p['x']
+        def ser_g2(p):
+            return bytes([G2_PREFIX_MASK | p['y_gt']]) + p['x']
+        buf += ser_g1(self.g_A)
+        buf += ser_g1(self.g_A_prime)
+        buf += ser_g2(self.g_B)
+        buf += ser_g1(self.g_B_prime)
+        buf += ser_g1(self.g_C)
+        buf += ser_g1(self.g_C_prime)
+        buf += ser_g1(self.g_K)
+        buf += ser_g1(self.g_H)
+
+    def copy(self):
+        c = ZCProof.__new__(ZCProof)
+        for name in ZCProof.__slots__:
+            p = getattr(self, name)
+            setattr(c, name, None if p is None else dict(p))
+        return c
 
     def __repr__(self):
         return "ZCProof(g_A=%r g_A_prime=%r g_B=%r g_B_prime=%r g_C=%r g_C_prime=%r g_K=%r g_H=%r)" \
@@ -450,7 +641,10 @@ ZC_NOTECIPHERTEXT_SIZE = (
   NOTEENCRYPTION_AUTH_BYTES
 )
 
-class JSDescription(object):
+class JSDescription(Serializable):
+    __slots__ = ("vpub_old", "vpub_new", "anchor", "nullifiers", "commitments",
+                 "onetimePubKey", "randomSeed", "macs", "proof", "ciphertexts")
+
     def __init__(self):
         self.vpub_old = 0
         self.vpub_new = 0
@@ -464,8 +658,8 @@ class JSDescription(object):
         self.ciphertexts = [None] * ZC_NUM_JS_OUTPUTS
 
     def deserialize(self, f):
-        self.vpub_old = struct.unpack("<q", f.read(8))[0]
-        self.vpub_new = struct.unpack("<q", f.read(8))[0]
+        self.vpub_old = deser_int64(f)
+        self.vpub_new = deser_int64(f)
         self.anchor = deser_uint256(f)
 
         self.nullifiers = []
@@ -490,69 +684,136 @@ class JSDescription(object):
         for i in range(ZC_NUM_JS_OUTPUTS):
             self.ciphertexts.append(f.read(ZC_NOTECIPHERTEXT_SIZE))
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.vpub_old)
-        r += struct.pack("<q", self.vpub_new)
-        r += ser_uint256(self.anchor)
+    def serialize_into(self, buf):
+        buf += _int64.pack(self.vpub_old)
+        buf += _int64.pack(self.vpub_new)
+        buf += ser_uint256(self.anchor)
         for i in range(ZC_NUM_JS_INPUTS):
-            r += ser_uint256(self.nullifiers[i])
+            buf += ser_uint256(self.nullifiers[i])
         for i in range(ZC_NUM_JS_OUTPUTS):
-            r += ser_uint256(self.commitments[i])
-        r += ser_uint256(self.onetimePubKey)
-        r += ser_uint256(self.randomSeed)
+            buf += ser_uint256(self.commitments[i])
+        buf += ser_uint256(self.onetimePubKey)
+        buf += ser_uint256(self.randomSeed)
         for i in range(ZC_NUM_JS_INPUTS):
-            r += ser_uint256(self.macs[i])
-        r += self.proof.serialize()
+            buf += ser_uint256(self.macs[i])
+        self.proof.serialize_into(buf)
         for i in range(ZC_NUM_JS_OUTPUTS):
-            r += ser_uint256(self.ciphertexts[i])
-        return r
+            buf += self.ciphertexts[i]
+
+    def copy(self):
+        c = _copy_slots(self)
+        c.nullifiers = list(self.nullifiers)
+        c.commitments = list(self.commitments)
+        c.macs = list(self.macs)
+        c.ciphertexts = list(self.ciphertexts)
+        if self.proof is not None:
+            c.proof = self.proof.copy()
+        return c
 
     def __repr__(self):
         return "JSDescription(vpub_old=%i.%08i vpub_new=%i.%08i anchor=%064x onetimePubKey=%064x randomSeed=%064x proof=%r)" \
             % (self.vpub_old, self.vpub_new, self.anchor,
                self.onetimePubKey, self.randomSeed, self.proof)
 
-class COutPoint(object):
+# Change tracking for the CTransaction serialization cache. Assigning any
+# serialized field of a transaction, its inputs, outputs or prevouts, and
+# changing vin/vout in place, moves _tx_epoch on; a cache filled at another
+# epoch is checked against a fresh serialization before it is used again.
+# deserialize() and the constructors write the underlying slots directly,
+# so received transactions pay nothing for the tracking. Scripts are
+# immutable bytes (ser_string() takes nothing else).
+_tx_epoch_counter = itertools.count(1)
+_tx_epoch = 0
+
+def _tx_changed():
+    global _tx_epoch
+    _tx_epoch = next(_tx_epoch_counter)
+
+def _tracked(name):
+    slot = "_" + name
+    def set(self, value):
+        setattr(self, slot, value)
+        _tx_changed()
+    return property(attrgetter(slot), set)
+
+def _tracked_list(name):
+    slot = "_" + name
+    def set(self, value):
+        setattr(self, slot, value if type(value) is _TxList else _TxList(value))
+        _tx_changed()
+    return property(attrgetter(slot), set)
+
+# vin/vout of a CTransaction. A list assigned to them is copied into one.
+class _TxList(list):
+    __slots__ = ()
+
+def _track_list_method(name):
+    method = getattr(list, name)
+    def mutate(self, *args, **kwargs):
+        r = method(self, *args, **kwargs)
+        _tx_changed()
+        return r
+    setattr(_TxList, name, mutate)
+
+for _name in ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append",
+              "extend", "insert", "pop", "remove", "clear", "sort", "reverse"):
+    _track_list_method(_name)
+del _name
+
+
+class COutPoint(Serializable):
+    __slots__ = ("_hash", "_n")
+
+    hash = _tracked("hash")
+    n = _tracked("n")
+
     def __init__(self, hash=0, n=0):
-        self.hash = hash
-        self.n = n
+        self._hash = hash
+        self._n = n
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        self._hash = deser_uint256(f)
+        self._n = deser_uint32(f)
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+    def serialize_into(self, buf):
+        buf += ser_uint256(self._hash)
+        buf += _uint32.pack(self._n)
+
+    def copy(self):
+        return COutPoint(self._hash, self._n)
 
     def __repr__(self):
-        return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
+        return "COutPoint(hash=%064x n=%i)" % (self._hash, self._n)
+
+
+class CTxIn(Serializable):
+    __slots__ = ("_prevout", "_scriptSig", "_nSequence")
 
+    prevout = _tracked("prevout")
+    scriptSig = _tracked("scriptSig")
+    nSequence = _tracked("nSequence")
 
-class CTxIn(object):
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
-            self.prevout = COutPoint()
+            self._prevout = COutPoint()
         else:
-            self.prevout = outpoint
-        self.scriptSig = scriptSig
-        self.nSequence = nSequence
+            self._prevout = outpoint
+        self._scriptSig = scriptSig
+        self._nSequence = nSequence
 
     def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self._prevout = COutPoint()
+        self._prevout.deserialize(f)
+        self._scriptSig = deser_string(f)
+        self._nSequence = deser_uint32(f)
 
-    def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+    def serialize_into(self, buf):
+        self._prevout.serialize_into(buf)
+        buf += ser_string(self._scriptSig)
+        buf += _uint32.pack(self._nSequence)
+
+    def copy(self):
+        return CTxIn(self._prevout.copy(), self._scriptSig, self._nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -560,20 +821,26 @@ class CTxIn(object):
                self.nSequence)
 
 
-class CTxOut(object):
+class CTxOut(Serializable):
+    __slots__ = ("_nValue", "_scriptPubKey")
+
+    nValue = _tracked("nValue")
+    scriptPubKey = _tracked("scriptPubKey")
+
     def __init__(self, nValue=0, scriptPubKey=b""):
-        self.nValue = nValue
-        self.scriptPubKey = scriptPubKey
+        self._nValue = nValue
+        self._scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        self._nValue = deser_int64(f)
+        self._scriptPubKey = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+    def serialize_into(self, buf):
+        buf += _int64.pack(self._nValue)
+        buf += ser_string(self._scriptPubKey)
+
+    def copy(self):
+        return CTxOut(self._nValue, self._scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -581,17 +848,32 @@ class CTxOut(object):
                hexlify(self.scriptPubKey))
 
 
-class CTransaction(object):
+class CTransaction(Serializable):
+    __slots__ = ("_fOverwintered", "_nVersion", "_nVersionGroupId", "_vin",
+                 "_vout", "_nLockTime", "_nExpiryHeight", "_valueBalance",
+                 "shieldedSpends", "shieldedOutputs", "vJoinSplit",
+                 "joinSplitPubKey", "joinSplitSig", "bindingSig", "sha256",
+                 "hash", "_cache")
+
+    fOverwintered = _tracked("fOverwintered")
+    nVersion = _tracked("nVersion")
+    nVersionGroupId = _tracked("nVersionGroupId")
+    vin = _tracked_list("vin")
+    vout = _tracked_list("vout")
+    nLockTime = _tracked("nLockTime")
+    nExpiryHeight = _tracked("nExpiryHeight")
+    valueBalance = _tracked("valueBalance")
+
     def __init__(self, tx=None):
         if tx is None:
-            self.fOverwintered = True
-            self.nVersion = 3
-            self.nVersionGroupId = OVERWINTER_VERSION_GROUP_ID
-            self.vin = []
-            self.vout = []
-            self.nLockTime = 0
-            self.nExpiryHeight = 0
-            self.valueBalance = 0
+            self._fOverwintered = True
+            self._nVersion = 3
+            self._nVersionGroupId = OVERWINTER_VERSION_GROUP_ID
+            self._vin = _TxList()
+            self._vout = _TxList()
+            self._nLockTime = 0
+            self._nExpiryHeight = 0
+            self._valueBalance = 0
             self.shieldedSpends = []
             self.shieldedOutputs = []
             self.vJoinSplit = []
@@ -600,50 +882,53 @@ class CTransaction(object):
             self.bindingSig = None
             self.sha256 = None
             self.hash = None
+            self._cache = None
         else:
-            self.fOverwintered = tx.fOverwintered
-            self.nVersion = tx.nVersion
-            self.nVersionGroupId = tx.nVersionGroupId
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
-            self.nLockTime = tx.nLockTime
-            self.nExpiryHeight = tx.nExpiryHeight
-            self.valueBalance = tx.valueBalance
-            self.shieldedSpends = copy.deepcopy(tx.shieldedSpends)
-            self.shieldedOutputs = copy.deepcopy(tx.shieldedOutputs)
-            self.vJoinSplit = copy.deepcopy(tx.vJoinSplit)
+            self._fOverwintered = tx.fOverwintered
+            self._nVersion = tx.nVersion
+            self._nVersionGroupId = tx.nVersionGroupId
+            self._vin = _TxList([txin.copy() for txin in tx.vin])
+            self._vout = _TxList([txout.copy() for txout in tx.vout])
+            self._nLockTime = tx.nLockTime
+            self._nExpiryHeight = tx.nExpiryHeight
+            self._valueBalance = tx.valueBalance
+            self.shieldedSpends = [x.copy() for x in tx.shieldedSpends]
+            self.shieldedOutputs = [x.copy() for x in tx.shieldedOutputs]
+            self.vJoinSplit = [x.copy() for x in tx.vJoinSplit]
             self.joinSplitPubKey = tx.joinSplitPubKey
             self.joinSplitSig = tx.joinSplitSig
             self.bindingSig = tx.bindingSig
             self.sha256 = None
             self.hash = None
+            # Same fields, so the same serialization and hashes
+            self._cache = tx._cache
 
     def deserialize(self, f):
-        header = struct.unpack("<I", f.read(4))[0]
-        self.fOverwintered = bool(header >> 31)
-        self.nVersion = header & 0x7FFFFFFF
-        self.nVersionGroupId = (struct.unpack("<I", f.read(4))[0]
-                                if self.fOverwintered else 0)
-
-        isOverwinterV3 = (self.fOverwintered and
-                          self.nVersionGroupId == OVERWINTER_VERSION_GROUP_ID and
-                          self.nVersion == 3)
-        isSaplingV4 = (self.fOverwintered and
-                       self.nVersionGroupId == SAPLING_VERSION_GROUP_ID and
-                       self.nVersion == 4)
-
-        self.vin = deser_vector(f, CTxIn)
-        self.vout = deser_vector(f, CTxOut)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        header = deser_uint32(f)
+        self._fOverwintered = bool(header >> 31)
+        self._nVersion = header & 0x7FFFFFFF
+        self._nVersionGroupId = (deser_uint32(f)
+                                 if self._fOverwintered else 0)
+
+        isOverwinterV3 = (self._fOverwintered and
+                          self._nVersionGroupId == OVERWINTER_VERSION_GROUP_ID and
+                          self._nVersion == 3)
+        isSaplingV4 = (self._fOverwintered and
+                       self._nVersionGroupId == SAPLING_VERSION_GROUP_ID and
+                       self._nVersion == 4)
+
+        self._vin = _TxList(deser_vector(f, CTxIn))
+        self._vout = _TxList(deser_vector(f, CTxOut))
+        self._nLockTime = deser_uint32(f)
         if isOverwinterV3 or isSaplingV4:
-            self.nExpiryHeight = struct.unpack("<I", f.read(4))[0]
+            self._nExpiryHeight = deser_uint32(f)
 
         if isSaplingV4:
-            self.valueBalance = struct.unpack("<q", f.read(8))[0]
+            self._valueBalance = deser_int64(f)
             self.shieldedSpends = deser_vector(f, SpendDescription)
             self.shieldedOutputs = deser_vector(f, OutputDescription)
 
-        if self.nVersion >= 2:
+        if self._nVersion >= 2:
             self.vJoinSplit = deser_vector(f, JSDescription)
             if len(self.vJoinSplit) > 0:
                 self.joinSplitPubKey = deser_uint256(f)
@@ -654,46 +939,80 @@ class CTransaction(object):
 
         self.sha256 = None
         self.hash = None
-
-    def serialize(self):
-        header = (int(self.fOverwintered)<<31) | self.nVersion
-        isOverwinterV3 = (self.fOverwintered and
-                          self.nVersionGroupId == OVERWINTER_VERSION_GROUP_ID and
-                          self.nVersion == 3)
-        isSaplingV4 = (self.fOverwintered and
-                       self.nVersionGroupId == SAPLING_VERSION_GROUP_ID and
-                       self.nVersion == 4)
-
-        r = b""
-        r += struct.pack("<I", header)
-        if self.fOverwintered:
-            r += struct.pack("<I", self.nVersionGroupId)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
+        self._cache = None
+
+    def _serialize_fields(self, buf):
+        header = (int(self._fOverwintered)<<31) | self._nVersion
+        isOverwinterV3 = (self._fOverwintered and
+                          self._nVersionGroupId == OVERWINTER_VERSION_GROUP_ID and
+                          self._nVersion == 3)
+        isSaplingV4 = (self._fOverwintered and
+                       self._nVersionGroupId == SAPLING_VERSION_GROUP_ID and
+                       self._nVersion == 4)
+
+        buf += _uint32.pack(header)
+        if self._fOverwintered:
+            buf += _uint32.pack(self._nVersionGroupId)
+        ser_vector_into(buf, self._vin)
+        ser_vector_into(buf, self._vout)
+        buf += _uint32.pack(self._nLockTime)
         if isOverwinterV3 or isSaplingV4:
-            r += struct.pack("<I", self.nExpiryHeight)
+            buf += _uint32.pack(self._nExpiryHeight)
         if isSaplingV4:
-            r += struct.pack("<q", self.valueBalance)
-            r += ser_vector(self.shieldedSpends)
-            r += ser_vector(self.shieldedOutputs)
-        if self.nVersion >= 2:
-            r += ser_vector(self.vJoinSplit)
+            buf += _int64.pack(self._valueBalance)
+            ser_vector_into(buf, self.shieldedSpends)
+            ser_vector_into(buf, self.shieldedOutputs)
+        if self._nVersion >= 2:
+            ser_vector_into(buf, self.vJoinSplit)
             if len(self.vJoinSplit) > 0:
-                r += ser_uint256(self.joinSplitPubKey)
-                r += self.joinSplitSig
+                buf += ser_uint256(self.joinSplitPubKey)
+                buf += self.joinSplitSig
         if isSaplingV4 and not (len(self.shieldedSpends) == 0 and len(self.shieldedOutputs) == 0):
-            r += self.bindingSig
-        return r
+            buf += self.bindingSig
+
+    # Returns the cache, (epoch, data, sha256, hash), refilling it if
+    # anything may have changed since it was filled. The hashes are filled
+    # in lazily by calc_sha256() and kept while the data stays the same.
+    # Shielded spends/outputs and JoinSplits aren't tracked, so transactions
+    # that have them are serialized again every time.
+    def _cached(self):
+        cache = self._cache
+        if self.shieldedSpends or self.shieldedOutputs or self.vJoinSplit:
+            epoch = None
+        else:
+            epoch = _tx_epoch
+            if cache is not None and cache[0] == epoch:
+                return cache
+        buf = bytearray()
+        self._serialize_fields(buf)
+        data = bytes(buf)
+        if cache is not None and cache[1] == data:
+            cache = (epoch, data, cache[2], cache[3])
+        else:
+            cache = (epoch, data, None, None)
+        self._cache = cache
+        return cache
+
+    def serialize_into(self, buf):
+        buf += self._cached()[1]
+
+    def serialize(self):
+        return self._cached()[1]
 
     def rehash(self):
-        self.sha256 = None
         self.calc_sha256()
 
+    # Cheap while the transaction is unchanged; sha256 and hash are always
+    # those of the current fields
     def calc_sha256(self):
-        if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = hash256(self.serialize())[::-1].hex()
+        epoch, data, sha256, hash = self._cached()
+        if sha256 is None:
+            h = hash256(data)
+            sha256 = uint256_from_str(h)
+            hash = h[::-1].hex()
+            self._cache = (epoch, data, sha256, hash)
+        self.sha256 = sha256
+        self.hash = hash
 
     def is_valid(self):
         self.calc_sha256()
@@ -702,6 +1021,9 @@ class CTransaction(object):
                 return False
         return True
 
+    def copy(self):
+        return CTransaction(self)
+
     def __repr__(self):
         r = ("CTransaction(fOverwintered=%r nVersion=%i nVersionGroupId=0x%08x "
              "vin=%r vout=%r nLockTime=%i nExpiryHeight=%i "
@@ -720,7 +1042,11 @@ class CTransaction(object):
         return r
 
 
-class CBlockHeader(object):
+class CBlockHeader(Serializable):
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot",
+                 "hashFinalSaplingRoot", "nTime", "nBits", "nNonce", "nSolution",
+                 "sha256", "hash")
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -750,88 +1076,188 @@ class CBlockHeader(object):
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_int32(f)
         self.hashPrevBlock = deser_uint256(f)
         self.hashMerkleRoot = deser_uint256(f)
         self.hashFinalSaplingRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
+        self.nTime = deser_uint32(f)
+        self.nBits = deser_uint32(f)
         self.nNonce = deser_uint256(f)
         self.nSolution = deser_char_vector(f)
         self.sha256 = None
         self.hash = None
 
+    def serialize_into(self, buf):
+        buf += _int32.pack(self.nVersion)
+        buf += ser_uint256(self.hashPrevBlock)
+        buf += ser_uint256(self.hashMerkleRoot)
+        buf += ser_uint256(self.hashFinalSaplingRoot)
+        buf += _uint32.pack(self.nTime)
+        buf += _uint32.pack(self.nBits)
+        buf += ser_uint256(self.nNonce)
+        buf += ser_char_vector(self.nSolution)
+
+    # Always the header only, also when called on a CBlock
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += ser_uint256(self.hashFinalSaplingRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += ser_uint256(self.nNonce)
-        r += ser_char_vector(self.nSolution)
-        return r
+        buf = bytearray()
+        CBlockHeader.serialize_into(self, buf)
+        return bytes(buf)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += ser_uint256(self.hashFinalSaplingRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += ser_uint256(self.nNonce)
-            r += ser_char_vector(self.nSolution)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = hash256(r)[::-1].hex()
+            h = hash256(CBlockHeader.serialize(self))
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
 
     def rehash(self):
         self.sha256 = None
         self.calc_sha256()
         return self.sha256
 
+    def copy(self):
+        c = CBlockHeader.__new__(CBlockHeader)
+        CBlockHeader._copy_header(c, self)
+        return c
+
+    def _copy_header(self, header):
+        self.nVersion = header.nVersion
+        self.hashPrevBlock = header.hashPrevBlock
+        self.hashMerkleRoot = header.hashMerkleRoot
+        self.hashFinalSaplingRoot = header.hashFinalSaplingRoot
+        self.nTime = header.nTime
+        self.nBits = header.nBits
+        self.nNonce = header.nNonce
+        self.nSolution = list(header.nSolution)
+        self.sha256 = header.sha256
+        self.hash = header.hash
+
     def __repr__(self):
         return "CBlockHeader(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x hashFinalSaplingRoot=%064x nTime=%s nBits=%08x nNonce=%064x nSolution=%r)" \
             % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot, self.hashFinalSaplingRoot,
                time.ctime(self.nTime), self.nBits, self.nNonce, self.nSolution)
 
 
+class MerkleTree(object):
+    """Merkle tree over 32-byte leaf hashes that keeps its inner levels.
+
+    update() takes the complete new list of leaves and only rehashes the
+    paths above leaves that changed, so appending or replacing a leaf
+    costs O(log n) hashes. As in pasteld, an odd node at the end of a level
+    is paired with itself.
+    """
+    __slots__ = ("levels",)
+
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        self.update(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def update(self, leaves):
+        leaves = list(leaves)
+        old = self.levels[0]
+        dirty = [i for i in range(min(len(old), len(leaves)))
+                 if old[i] != leaves[i]]
+        if len(leaves) != len(old):
+            # The last node may now be paired with itself, or no longer be
+            dirty += range(max(min(len(old), len(leaves)) - 1, 0), len(leaves))
+        self.levels[0] = leaves
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            del parents[(len(nodes) + 1) // 2:]
+            dirty = sorted(set([i // 2 for i in dirty]))
+            for i in dirty:
+                left = nodes[2*i]
+                right = nodes[2*i + 1] if 2*i + 1 < len(nodes) else left
+                if i < len(parents):
+                    parents[i] = hash256(left + right)
+                else:
+                    parents.append(hash256(left + right))
+            level += 1
+        del self.levels[level + 1:]
+
+    def root(self):
+        return self.levels[-1][0]
+
+    def branch(self, index):
+        """Sibling hashes on the path from leaf index to the root."""
+        if not 0 <= index < len(self):
+            raise IndexError("leaf index out of range")
+        branch = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(nodes[sibling] if sibling < len(nodes) else nodes[index])
+            index >>= 1
+        return branch
+
+    def copy(self):
+        c = MerkleTree.__new__(MerkleTree)
+        c.levels = [list(nodes) for nodes in self.levels]
+        return c
+
+    @staticmethod
+    def root_from_branch(leaf, branch, index):
+        h = leaf
+        for sibling in branch:
+            h = hash256(sibling + h) if index & 1 else hash256(h + sibling)
+            index >>= 1
+        return h
+
+
 class CBlock(CBlockHeader):
+    __slots__ = ("vtx", "merkle_tree")
+
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        self.merkle_tree = MerkleTree()
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
-    def serialize(self):
-        r = b""
-        r += super(CBlock, self).serialize()
-        r += ser_vector(self.vtx)
-        return r
+    def serialize_into(self, buf):
+        super(CBlock, self).serialize_into(buf)
+        ser_vector_into(buf, self.vtx)
 
-    def calc_merkle_root(self):
+    # The whole block, where CBlockHeader.serialize() is the header only
+    serialize = Serializable.serialize
+
+    def copy(self):
+        c = CBlock.__new__(CBlock)
+        CBlockHeader._copy_header(c, self)
+        c.vtx = [tx.copy() for tx in self.vtx]
+        c.merkle_tree = self.merkle_tree.copy()
+        return c
+
+    # Brings merkle_tree in line with the current vtx; only the paths above
+    # added, removed or rehashed transactions are recomputed.
+    def update_merkle_tree(self):
         hashes = []
         for tx in self.vtx:
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i+1, len(hashes)-1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        return uint256_from_str(hashes[0])
+        self.merkle_tree.update(hashes)
+        return self.merkle_tree
+
+    def calc_merkle_root(self):
+        return uint256_from_str(self.update_merkle_tree().root())
+
+    def calc_merkle_branch(self, index):
+        return [uint256_from_str(h)
+                for h in self.update_merkle_tree().branch(index)]
 
     def is_valid(self, n=48, k=5):
         # H(I||...
         digest = blake2b(digest_size=(512//n)*n//8, person=zcash_person(n, k))
         digest.update(super(CBlock, self).serialize()[:108])
         hash_nonce(digest, self.nNonce)
-        if not gbp_validate(self.nSolution, digest, n, k):
+        if not gbp_validate(digest, self.nSolution, n, k):
             return False
         self.calc_sha256()
         target = uint256_from_compact(self.nBits)
@@ -844,7 +1270,11 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self, n=48, k=5):
+    def solve(self, n=48, k=5, workers=None, deterministic=False):
+        if workers is not None and workers > 1:
+            with BlockSolver(workers) as solver:
+                solver.solve(self, n, k, deterministic)
+            return
         target = uint256_from_compact(self.nBits)
         # H(I||...
         digest = blake2b(digest_size=(512//n)*n//8, person=zcash_person(n, k))
@@ -855,7 +1285,7 @@ class CBlock(CBlockHeader):
             curr_digest = digest.copy()
             hash_nonce(curr_digest, self.nNonce)
             # (x_1, x_2, ...) = A(I, V, n, k)
-            solns = gbp_basic(curr_digest, n, k)
+            solns = gbp_solve(curr_digest, n, k)
             for soln in solns:
                 assert(gbp_validate(curr_digest, soln, n, k))
                 self.nSolution = soln
@@ -871,7 +1301,133 @@ class CBlock(CBlockHeader):
                self.nNonce, self.nSolution, self.vtx)
 
 
-class CUnsignedAlert(object):
+def _validate_serialized_headers(serialized_headers, n, k):
+    items = []
+    for (header, solution) in serialized_headers:
+        # H(I||V||...
+        digest = blake2b(digest_size=(512//n)*n//8, person=zcash_person(n, k))
+        digest.update(header[:108])
+        hash_nonce(digest, uint256_from_str(header[108:140]))
+        items.append((digest, solution))
+    verdicts = gbp_validate_many(items, n, k)
+    for i, (header, solution) in enumerate(serialized_headers):
+        if not verdicts[i][0]:
+            continue
+        target = uint256_from_compact(struct.unpack("<I", header[104:108])[0])
+        if uint256_from_str(hash256(header)) > target:
+            verdicts[i] = (False, 'Invalid header: hash above target')
+    return verdicts
+
+
+def validate_many(headers, n=48, k=5, workers=None, chunk_size=500):
+    """Check the Equihash solution and proof-of-work of many block headers
+    (CBlockHeader or CBlock objects) in one call.
+
+    Returns a (valid, reason) tuple per header, in order; reason is None for
+    valid headers.  If workers > 1 the headers are validated in chunks of
+    chunk_size on a process pool."""
+    serialized = [(CBlockHeader.serialize(h), bytes(h.nSolution)) for h in headers]
+    if not workers or workers <= 1 or len(serialized) <= chunk_size:
+        return _validate_serialized_headers(serialized, n, k)
+    chunks = [serialized[i:i+chunk_size] for i in range(0, len(serialized), chunk_size)]
+    verdicts = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_validate_serialized_headers, chunks,
+                                   [n]*len(chunks), [k]*len(chunks)):
+            verdicts.extend(result)
+    return verdicts
+
+
+# Upper bound on the nonces still worth trying, shared by the processes of a
+# BlockSolver pool (set in each worker by _init_solve_worker).
+_solve_limit = None
+NONCE_SEARCH_LIMIT = 2**63 - 1
+
+def _init_solve_worker(limit):
+    global _solve_limit
+    _solve_limit = limit
+
+
+def _solve_nonces(header, target, first, last, n, k):
+    # H(I||...
+    digest = blake2b(digest_size=(512//n)*n//8, person=zcash_person(n, k))
+    digest.update(header)
+    for nonce in range(first, last):
+        if nonce >= _solve_limit.value:
+            break
+        # H(I||V||...
+        curr_digest = digest.copy()
+        hash_nonce(curr_digest, nonce)
+        # (x_1, x_2, ...) = A(I, V, n, k)
+        for soln in gbp_solve(curr_digest, n, k):
+            assert(gbp_validate(curr_digest, soln, n, k))
+            r = header + ser_uint256(nonce) + ser_char_vector(soln)
+            if uint256_from_str(hash256(r)) <= target:
+                with _solve_limit.get_lock():
+                    _solve_limit.value = min(_solve_limit.value, nonce)
+                return (nonce, soln)
+    return None
+
+
+class BlockSolver(object):
+    """Searches the nonce space of a block on a pool of worker processes.
+
+    Nonces are handed out in chunks of chunk_size.  The first solution whose
+    hash meets the target wins and the remaining work is cancelled; with
+    deterministic=True the solver instead waits for every chunk below the
+    winner, so the result is the lowest winning nonce (the one a serial
+    CBlock.solve() would find).  A solver can be reused for many blocks."""
+
+    def __init__(self, workers, chunk_size=4):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.limit = multiprocessing.Value('q', NONCE_SEARCH_LIMIT)
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=_init_solve_worker,
+                                            initargs=(self.limit,))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def solve(self, block, n=48, k=5, deterministic=False):
+        target = uint256_from_compact(block.nBits)
+        header = CBlockHeader.serialize(block)[:108]
+        self.limit.value = NONCE_SEARCH_LIMIT
+        pending = {}
+        next_nonce = 0
+        best = None
+        while True:
+            while best is None and len(pending) < 2*self.workers:
+                future = self.executor.submit(_solve_nonces, header, target, next_nonce,
+                                              next_nonce + self.chunk_size, n, k)
+                pending[future] = next_nonce
+                next_nonce += self.chunk_size
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                result = future.result()
+                if result is not None and (best is None or result[0] < best[0]):
+                    best = result
+            if best is not None:
+                # Chunks starting below the winner may still hold a lower nonce
+                if not deterministic or all(first > best[0] for first in pending.values()):
+                    break
+        # Stop the chunks that are still running and drop the queued ones
+        self.limit.value = -1
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        block.nNonce, block.nSolution = best
+        block.rehash()
+
+
+class CUnsignedAlert(Serializable):
     def __init__(self):
         self.nVersion = 1
         self.nRelayUntil = 0
@@ -888,36 +1444,34 @@ class CUnsignedAlert(object):
         self.strReserved = b""
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nRelayUntil = struct.unpack("<q", f.read(8))[0]
-        self.nExpiration = struct.unpack("<q", f.read(8))[0]
-        self.nID = struct.unpack("<i", f.read(4))[0]
-        self.nCancel = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_int32(f)
+        self.nRelayUntil = deser_int64(f)
+        self.nExpiration = deser_int64(f)
+        self.nID = deser_int32(f)
+        self.nCancel = deser_int32(f)
         self.setCancel = deser_int_vector(f)
-        self.nMinVer = struct.unpack("<i", f.read(4))[0]
-        self.nMaxVer = struct.unpack("<i", f.read(4))[0]
+        self.nMinVer = deser_int32(f)
+        self.nMaxVer = deser_int32(f)
         self.setSubVer = deser_string_vector(f)
-        self.nPriority = struct.unpack("<i", f.read(4))[0]
+        self.nPriority = deser_int32(f)
         self.strComment = deser_string(f)
         self.strStatusBar = deser_string(f)
         self.strReserved = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<q", self.nRelayUntil)
-        r += struct.pack("<q", self.nExpiration)
-        r += struct.pack("<i", self.nID)
-        r += struct.pack("<i", self.nCancel)
-        r += ser_int_vector(self.setCancel)
-        r += struct.pack("<i", self.nMinVer)
-        r += struct.pack("<i", self.nMaxVer)
-        r += ser_string_vector(self.setSubVer)
-        r += struct.pack("<i", self.nPriority)
-        r += ser_string(self.strComment)
-        r += ser_string(self.strStatusBar)
-        r += ser_string(self.strReserved)
-        return r
+    def serialize_into(self, buf):
+        buf += _int32.pack(self.nVersion)
+        buf += _int64.pack(self.nRelayUntil)
+        buf += _int64.pack(self.nExpiration)
+        buf += _int32.pack(self.nID)
+        buf += _int32.pack(self.nCancel)
+        buf += ser_int_vector(self.setCancel)
+        buf += _int32.pack(self.nMinVer)
+        buf += _int32.pack(self.nMaxVer)
+        buf += ser_string_vector(self.setSubVer)
+        buf += _int32.pack(self.nPriority)
+        buf += ser_string(self.strComment)
+        buf += ser_string(self.strStatusBar)
+        buf += ser_string(self.strReserved)
 
     def __repr__(self):
         return "CUnsignedAlert(nVersion %d, nRelayUntil %d, nExpiration %d, nID %d, nCancel %d, nMinVer %d, nMaxVer %d, nPriority %d, strComment %s, strStatusBar %s, strReserved %s)" \
@@ -926,7 +1480,7 @@ class CUnsignedAlert(object):
                self.strComment, self.strStatusBar, self.strReserved)
 
 
-class CAlert(object):
+class CAlert(Serializable):
     def __init__(self):
         self.vchMsg = b""
         self.vchSig = b""
@@ -935,11 +1489,9 @@ class CAlert(object):
         self.vchMsg = deser_string(f)
         self.vchSig = deser_string(f)
 
-    def serialize(self):
-        r = b""
-        r += ser_string(self.vchMsg)
-        r += ser_string(self.vchSig)
-        return r
+    def serialize_into(self, buf):
+        buf += ser_string(self.vchMsg)
+        buf += ser_string(self.vchSig)
 
     def __repr__(self):
         return "CAlert(vchMsg.sz %d, vchSig.sz %d)" \
@@ -947,7 +1499,7 @@ class CAlert(object):
 
 
 # Objects that correspond to messages on the wire
-class msg_version(object):
+class msg_version(Serializable):
     command = b"version"
 
     def __init__(self, protocol_version=BLOSSOM_PROTO_VERSION):
@@ -961,20 +1513,20 @@ class msg_version(object):
         self.nStartingHeight = -1
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_int32(f)
         if self.nVersion == 10300:
             self.nVersion = 300
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nServices = deser_uint64(f)
+        self.nTime = deser_int64(f)
         self.addrTo = CAddress()
         self.addrTo.deserialize(f)
         if self.nVersion >= 106:
             self.addrFrom = CAddress()
             self.addrFrom.deserialize(f)
-            self.nNonce = struct.unpack("<Q", f.read(8))[0]
+            self.nNonce = deser_uint64(f)
             self.strSubVer = deser_string(f)
             if self.nVersion >= 209:
-                self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+                self.nStartingHeight = deser_int32(f)
             else:
                 self.nStartingHeight = None
         else:
@@ -983,17 +1535,15 @@ class msg_version(object):
             self.strSubVer = None
             self.nStartingHeight = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize()
-        r += self.addrFrom.serialize()
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        return r
+    def serialize_into(self, buf):
+        buf += _int32.pack(self.nVersion)
+        buf += _uint64.pack(self.nServices)
+        buf += _int64.pack(self.nTime)
+        self.addrTo.serialize_into(buf)
+        self.addrFrom.serialize_into(buf)
+        buf += _uint64.pack(self.nNonce)
+        buf += ser_string(self.strSubVer)
+        buf += _int32.pack(self.nStartingHeight)
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i)' \
@@ -1002,7 +1552,7 @@ class msg_version(object):
                self.strSubVer, self.nStartingHeight)
 
 
-class msg_verack(object):
+class msg_verack(Serializable):
     command = b"verack"
 
     def __init__(self):
@@ -1011,14 +1561,14 @@ class msg_verack(object):
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, buf):
+        pass
 
     def __repr__(self):
         return "msg_verack()"
 
 
-class msg_addr(object):
+class msg_addr(Serializable):
     command = b"addr"
 
     def __init__(self):
@@ -1027,14 +1577,14 @@ class msg_addr(object):
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress)
 
-    def serialize(self):
-        return ser_vector(self.addrs)
+    def serialize_into(self, buf):
+        ser_vector_into(buf, self.addrs)
 
     def __repr__(self):
         return "msg_addr(addrs=%r)" % (self.addrs,)
 
 
-class msg_alert(object):
+class msg_alert(Serializable):
     command = b"alert"
 
     def __init__(self):
@@ -1044,16 +1594,14 @@ class msg_alert(object):
         self.alert = CAlert()
         self.alert.deserialize(f)
 
-    def serialize(self):
-        r = b""
-        r += self.alert.serialize()
-        return r
+    def serialize_into(self, buf):
+        self.alert.serialize_into(buf)
 
     def __repr__(self):
         return "msg_alert(alert=%s)" % (repr(self.alert), )
 
 
-class msg_inv(object):
+class msg_inv(Serializable):
     command = b"inv"
 
     def __init__(self, inv=None):
@@ -1065,14 +1613,14 @@ class msg_inv(object):
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
-    def serialize(self):
-        return ser_vector(self.inv)
+    def serialize_into(self, buf):
+        ser_vector_into(buf, self.inv)
 
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
 
 
-class msg_getdata(object):
+class msg_getdata(Serializable):
     command = b"getdata"
 
     def __init__(self, inv=None):
@@ -1081,14 +1629,14 @@ class msg_getdata(object):
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
-    def serialize(self):
-        return ser_vector(self.inv)
+    def serialize_into(self, buf):
+        ser_vector_into(buf, self.inv)
 
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
 
 
-class msg_notfound(object):
+class msg_notfound(Serializable):
     command = b"notfound"
 
     def __init__(self):
@@ -1097,14 +1645,14 @@ class msg_notfound(object):
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
-    def serialize(self):
-        return ser_vector(self.inv)
+    def serialize_into(self, buf):
+        ser_vector_into(buf, self.inv)
 
     def __repr__(self):
         return "msg_notfound(inv=%r)" % (self.inv,)
 
 
-class msg_getblocks(object):
+class msg_getblocks(Serializable):
     command = b"getblocks"
 
     def __init__(self):
@@ -1116,18 +1664,16 @@ class msg_getblocks(object):
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
             % (repr(self.locator), self.hashstop)
 
 
-class msg_tx(object):
+class msg_tx(Serializable):
     command = b"tx"
 
     def __init__(self, tx=CTransaction()):
@@ -1136,14 +1682,14 @@ class msg_tx(object):
     def deserialize(self, f):
         self.tx.deserialize(f)
 
-    def serialize(self):
-        return self.tx.serialize()
+    def serialize_into(self, buf):
+        self.tx.serialize_into(buf)
 
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
 
-class msg_block(object):
+class msg_block(Serializable):
     command = b"block"
 
     def __init__(self, block=None):
@@ -1155,14 +1701,29 @@ class msg_block(object):
     def deserialize(self, f):
         self.block.deserialize(f)
 
-    def serialize(self):
-        return self.block.serialize()
+    def serialize_into(self, buf):
+        self.block.serialize_into(buf)
 
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
 
 
-class msg_getaddr(object):
+# A message whose payload is already serialized, such as a block read back
+# from a BlockStore. It is sent as is; a known checksum saves hashing it.
+class msg_raw(object):
+    def __init__(self, command, payload, checksum=None):
+        self.command = command
+        self.payload = payload
+        self.checksum = checksum
+
+    def serialize(self):
+        return self.payload
+
+    def __repr__(self):
+        return "msg_raw(command=%s size=%d)" % (self.command.decode(), len(self.payload))
+
+
+class msg_getaddr(Serializable):
     command = b"getaddr"
 
     def __init__(self):
@@ -1171,14 +1732,14 @@ class msg_getaddr(object):
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, buf):
+        pass
 
     def __repr__(self):
         return "msg_getaddr()"
 
 
-class msg_ping_prebip31(object):
+class msg_ping_prebip31(Serializable):
     command = b"ping"
 
     def __init__(self):
@@ -1187,50 +1748,46 @@ class msg_ping_prebip31(object):
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, buf):
+        pass
 
     def __repr__(self):
         return "msg_ping() (pre-bip31)"
 
 
-class msg_ping(object):
+class msg_ping(Serializable):
     command = b"ping"
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = deser_uint64(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+    def serialize_into(self, buf):
+        buf += _uint64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
 
 
-class msg_pong(object):
+class msg_pong(Serializable):
     command = b"pong"
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = deser_uint64(f)
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+    def serialize_into(self, buf):
+        buf += _uint64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
 
 
-class msg_mempool(object):
+class msg_mempool(Serializable):
     command = b"mempool"
 
     def __init__(self):
@@ -1239,8 +1796,8 @@ class msg_mempool(object):
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, buf):
+        pass
 
     def __repr__(self):
         return "msg_mempool()"
@@ -1250,7 +1807,7 @@ class msg_mempool(object):
 # number of entries
 # vector of hashes
 # hash_stop (hash of last desired block header, 0 to get as many as possible)
-class msg_getheaders(object):
+class msg_getheaders(Serializable):
     command = b"getheaders"
 
     def __init__(self):
@@ -1262,11 +1819,9 @@ class msg_getheaders(object):
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1275,7 +1830,7 @@ class msg_getheaders(object):
 
 # headers message has
 # <count> <vector of block headers>
-class msg_headers(object):
+class msg_headers(Serializable):
     command = b"headers"
 
     def __init__(self):
@@ -1287,15 +1842,15 @@ class msg_headers(object):
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
-    def serialize(self):
+    def serialize_into(self, buf):
         blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        ser_vector_into(buf, blocks)
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
 
 
-class msg_reject(object):
+class msg_reject(Serializable):
     command = b"reject"
 
     def __init__(self):
@@ -1306,25 +1861,24 @@ class msg_reject(object):
 
     def deserialize(self, f):
         self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
+        self.code = deser_uint8(f)
         self.reason = deser_string(f)
         if (self.message == b"block" or self.message == b"tx"):
             self.data = deser_uint256(f)
 
-    def serialize(self):
-        r = ser_string(self.message)
-        r += struct.pack("<B", self.code)
-        r += ser_string(self.reason)
+    def serialize_into(self, buf):
+        buf += ser_string(self.message)
+        buf += _uint8.pack(self.code)
+        buf += ser_string(self.reason)
         if (self.message == b"block" or self.message == b"tx"):
-            r += ser_uint256(self.data)
-        return r
+            buf += ser_uint256(self.data)
 
     def __repr__(self):
         return "msg_reject: %s %d %s [%064x]" \
             % (self.message, self.code, self.reason, self.data)
 
 
-class msg_filteradd(object):
+class msg_filteradd(Serializable):
     command = b"filteradd"
 
     def __init__(self):
@@ -1333,14 +1887,14 @@ class msg_filteradd(object):
     def deserialize(self, f):
         self.data = deser_string(f)
 
-    def serialize(self):
-        return ser_string(self.data)
+    def serialize_into(self, buf):
+        buf += ser_string(self.data)
 
     def __repr__(self):
         return "msg_filteradd(data=%r)" % (self.data,)
 
 
-class msg_filterclear(object):
+class msg_filterclear(Serializable):
     command = b"filterclear"
 
     def __init__(self):
@@ -1349,18 +1903,96 @@ class msg_filterclear(object):
     def deserialize(self, f):
         pass
 
-    def serialize(self):
-        return b""
+    def serialize_into(self, buf):
+        pass
 
     def __repr__(self):
         return "msg_filterclear()"
 
 
+class MessageFramer(object):
+    """Splits a received byte stream into p2p messages.
+
+    Data is received straight into a bytearray (get_buffer() and
+    buffer_updated(), or feed()) and parsed from a moving start offset, so
+    taking a message off the front never copies the rest of the buffer.
+    The parsed prefix is only dropped when the free space at the end runs
+    out. Once the header of a large message is in, room for the whole
+    message is made at once. Payloads are returned as memoryviews into the
+    buffer and are only valid until more data is received."""
+    def __init__(self, magic, recv_size):
+        self.magic = magic
+        self.recv_size = recv_size
+        self.buf = bytearray()
+        self.start = 0
+        self.end = 0
+        # Bytes still missing from a message whose header has been parsed
+        self.missing = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = self.missing = 0
+
+    def get_buffer(self, sizehint=-1):
+        want = max(sizehint, self.recv_size, self.missing)
+        if len(self.buf) - self.end < want:
+            pending = self.end - self.start
+            if pending + want <= len(self.buf):
+                self.buf[:pending] = self.buf[self.start:self.end]
+            else:
+                # Never resized in place, as payload views may still exist
+                buf = bytearray(max(2 * len(self.buf), pending + want))
+                buf[:pending] = memoryview(self.buf)[self.start:self.end]
+                self.buf = buf
+            self.start = 0
+            self.end = pending
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        self.get_buffer(len(data))[:len(data)] = data
+        self.end += len(data)
+
+    # Returns (command, payload) for the next complete message, or None.
+    # Peers older than version 209 send no checksum.
+    def next_message(self, checksum=True):
+        buf = self.buf
+        pos = self.start
+        avail = self.end - pos
+        if avail < 4:
+            return None
+        if buf[pos:pos+4] != self.magic:
+            raise ValueError("got garbage %r" % (bytes(buf[pos:self.end]),))
+        header_len = 4 + 12 + 4 + (4 if checksum else 0)
+        if avail < header_len:
+            return None
+        command = buf[pos+4:pos+4+12].split(b"\x00", 1)[0]
+        msglen = _int32.unpack_from(buf, pos+4+12)[0]
+        if avail < header_len + msglen:
+            self.missing = header_len + msglen - avail
+            return None
+        self.missing = 0
+        msg = memoryview(buf)[pos+header_len:pos+header_len+msglen]
+        if checksum and buf[pos+4+12+4:pos+header_len] != hash256(msg)[:4]:
+            raise ValueError("got bad checksum %r" % (bytes(buf[pos:self.end]),))
+        self.start = pos + header_len + msglen
+        if self.start == self.end:
+            self.start = self.end = 0
+        return bytes(command), msg
+
+
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
 class NodeConnCB(object):
     def __init__(self):
         self.verack_received = False
+        # Held by the network thread while it runs one of the on_* callbacks
+        # and notified afterwards, see wait_until()
+        self.cb_lock = Condition(RLock())
 
     # Derived classes should call this function once to set the message map
     # which associates the derived classes' functions to incoming messages
@@ -1386,11 +2018,29 @@ class NodeConnCB(object):
         }
 
     def deliver(self, conn, message):
-        with mininode_lock:
+        with self.cb_lock:
             try:
                 self.cbmap[message.command](conn, message)
             except Exception as e:
                 print("ERROR delivering %r (%r)" % (message, e))
+            self.cb_lock.notify_all()
+        _notify_delivery()
+
+    def deliver_close(self, conn):
+        try:
+            with self.cb_lock:
+                try:
+                    self.on_close(conn)
+                finally:
+                    self.cb_lock.notify_all()
+        finally:
+            _notify_delivery()
+
+    # Waits until predicate() returns true, checking it under cb_lock after
+    # every message delivered to this callback. Returns False on timeout.
+    def wait_until(self, predicate, timeout=60):
+        with self.cb_lock:
+            return self.cb_lock.wait_for(predicate, timeout)
 
     def on_version(self, conn, message):
         if message.nVersion >= 209:
@@ -1431,8 +2081,10 @@ class NodeConnCB(object):
 
 
 # The actual NodeConn class
-# This class provides an interface for a p2p connection to a specified node
-class NodeConn(asyncore.dispatcher):
+# This class provides an interface for a p2p connection to a specified node.
+# It is an asyncio protocol; all of its I/O happens on the network thread,
+# while send_message() and disconnect_node() may be called from any thread.
+class NodeConn(asyncio.BufferedProtocol):
     messagemap = {
         b"version": msg_version,
         b"verack": msg_verack,
@@ -1458,15 +2110,23 @@ class NodeConn(asyncore.dispatcher):
         "regtest" : b"\xcd\xd8\xfa\x9e"   # regtest
    
     }
+    # Minimum free space offered to each socket read. Large messages get
+    # room for their whole payload as soon as their header has arrived.
+    recv_size = 16 * 1024
 
     def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", protocol_version=BLOSSOM_PROTO_VERSION):
-        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
         self.log = logging.getLogger("NodeConn(%s:%d)" % (dstaddr, dstport))
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.loop = network_event_loop()
+        self.transport = None
+        self.drain_waiter = None
+        # Header and payload buffers of the messages waiting for flush().
+        # The test thread appends and the network thread pops; deque makes
+        # both atomic, so neither side takes a lock.
+        self.sendq = deque()
+        self.flush_pending = False
+        self.framer = MessageFramer(self.MAGIC_BYTES[net], self.recv_size)
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -1475,7 +2135,7 @@ class NodeConn(asyncore.dispatcher):
         self.cb = callback
         self.disconnect = False
 
-        # stuff version msg into sendbuf
+        # stuff version msg into the send queue
         vt = msg_version(protocol_version)
         vt.addrTo.ip = self.dstaddr
         vt.addrTo.port = self.dstport
@@ -1485,96 +2145,108 @@ class NodeConn(asyncore.dispatcher):
         print('MiniNode: Connecting to Pastel Node IP # ' + dstaddr + ':' \
             + str(dstport) + ' using version ' + str(protocol_version))
 
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
         self.rpc = rpc
+        mininode_socket_map[id(self)] = self
+        self.connect_task = None
+        self.loop.call_soon_threadsafe(self.start_connect)
 
     def show_debug_msg(self, msg):
         self.log.debug(msg)
 
+    def start_connect(self):
+        self.connect_task = self.loop.create_task(self.connect())
+
+    async def connect(self):
+        try:
+            await self.loop.create_connection(lambda: self, self.dstaddr, self.dstport)
+        except OSError as e:
+            self.show_debug_msg("MiniNode: Connection to %s:%d failed: %r"
+                                % (self.dstaddr, self.dstport, e))
+            self.handle_close()
+
+    # asyncio.Protocol callbacks, run on the network thread
+
+    def connection_made(self, transport):
+        if self.state == b"closed":
+            # disconnect_node() was called while connecting
+            transport.abort()
+            return
+        self.transport = transport
+        self.handle_connect()
+        # Sends whatever was queued while connecting
+        self.flush()
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.framer.buffer_updated(nbytes)
+        self.got_data()
+
+    def connection_lost(self, exc):
+        self.handle_close()
+        self.transport = None
+        self.forget()
+
+    def pause_writing(self):
+        self.drain_waiter = self.loop.create_future()
+
+    def resume_writing(self):
+        waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
     def handle_connect(self):
         self.show_debug_msg("MiniNode: Connected & Listening: \n")
         self.state = b"connected"
 
     def handle_close(self):
+        if self.state == b"closed":
+            return
         self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
                             % (self.dstaddr, self.dstport))
         self.state = b"closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
-        self.cb.on_close(self)
-
-    def handle_read(self):
-        try:
-            t = self.recv(8192)
-            if len(t) > 0:
-                self.recvbuf += t
-                self.got_data()
-        except:
-            pass
-
-    def readable(self):
-        return True
-
-    def writable(self):
-        with mininode_lock:
-            length = len(self.sendbuf)
-        return (length > 0)
-
-    def handle_write(self):
-        with mininode_lock:
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
+        self.framer.clear()
+        self.sendq.clear()
+        self.resume_writing()
+        self.cb.deliver_close(self)
+        if self.transport is not None:
+            # Drops anything not sent yet; connection_lost() follows
+            self.transport.abort()
+        else:
+            self.forget()
+
+    # Stops the loop (and with it the NetworkThread) once the last
+    # connection is gone
+    def forget(self):
+        mininode_socket_map.pop(id(self), None)
+        if not mininode_socket_map:
+            self.loop.stop()
+
+    # Hands everything queued to the transport in one writelines() call,
+    # which sends it with a single scatter/gather sendmsg() on Python 3.12+
+    def flush(self):
+        # Cleared first: frames queued from here on get another flush()
+        self.flush_pending = False
+        sendq = self.sendq
+        frames = [sendq.popleft() for _ in range(len(sendq))]
+        if frames and self.state == b"connected":
+            self.transport.writelines(frames)
 
     def got_data(self):
         try:
             command = b''
             while True:
-                if len(self.recvbuf) < 4:
+                message = self.framer.next_message(self.ver_recv >= 209)
+                if message is None:
                     return
-                if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %r" % (self.recvbuf,))
-                if self.ver_recv < 209:
-                    if len(self.recvbuf) < 4 + 12 + 4:
-                        return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = None
-                    if len(self.recvbuf) < 4 + 12 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4+12+4:4+12+4+msglen]
-                    self.recvbuf = self.recvbuf[4+12+4+msglen:]
-                else:
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                        return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = self.recvbuf[4+12+4:4+12+4+4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum %r" % (self.recvbuf,))
-                    self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+                command, msg = message
                 if command in self.messagemap:
-                    f = BytesIO(msg)
                     t = self.messagemap[command]()
-                    t.deserialize(f)
+                    t.deserialize(ByteReader(msg))
                     self.got_message(t)
                 else:
-                    self.show_debug_msg(f'Unknown command: "{command}" {msg!r}')
+                    self.show_debug_msg(f'Unknown command: "{command}" {bytes(msg)!r}')
         except Exception as e:
             if command:
                 print(f'got_data({command}): {e!r}')
@@ -1583,24 +2255,59 @@ class NodeConn(asyncore.dispatcher):
             # import  traceback
             # traceback.print_tb(sys.exc_info()[2])
 
+    # Returns the header and the payload of message, ready to be queued
+    def build_message(self, message):
+        data = message.serialize()
+        if self.ver_send >= 209:
+            checksum = getattr(message, "checksum", None) or hash256(data)[:4]
+            header = _msg_header.pack(self.MAGIC_BYTES[self.network],
+                                      message.command, len(data), checksum)
+        else:
+            header = _msg_header_nochecksum.pack(self.MAGIC_BYTES[self.network],
+                                                 message.command, len(data))
+        return [header, data]
+
     def send_message(self, message, pushbuf=False):
         if self.state != b"connected" and not pushbuf:
             return
-        self.show_debug_msg("Send %s" % repr(message))
-        command = message.command
-        data = message.serialize()
-        tmsg = self.MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
-        if self.ver_send >= 209:
-            th = sha256(data)
-            h = sha256(th)
-            tmsg += h[:4]
-        tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
-            self.last_sent = time.time()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.show_debug_msg("Send %s" % repr(message))
+        self.queue_frames(self.build_message(message))
+
+    # Sends several messages with a single wakeup of the network thread and,
+    # once flushed, a single write to the transport
+    def send_messages(self, messages):
+        if self.state != b"connected":
+            return
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        frames = []
+        for message in messages:
+            if debug:
+                self.show_debug_msg("Send %s" % repr(message))
+            frames += self.build_message(message)
+        self.queue_frames(frames)
+
+    def queue_frames(self, frames):
+        self.last_sent = time.time()
+        self.sendq.extend(frames)
+        if self.transport is None:
+            # connection_made() sends the queue
+            return
+        if in_network_thread():
+            self.flush()
+        elif not self.flush_pending:
+            self.flush_pending = True
+            self.loop.call_soon_threadsafe(self.flush)
+
+    # For coroutines running on the network thread: sends the message and
+    # waits until the transport's write buffer has room again.
+    async def send_message_async(self, message):
+        self.send_message(message)
+        await self.drain()
+
+    async def drain(self):
+        if self.drain_waiter is not None:
+            await self.drain_waiter
 
     def got_message(self, message):
         if message.command == b"version":
@@ -1613,20 +2320,18 @@ class NodeConn(asyncore.dispatcher):
 
     def disconnect_node(self):
         self.disconnect = True
+        self.loop.call_soon_threadsafe(self.handle_close)
 
 
+# Runs the shared event loop until the last NodeConn has closed. Messages
+# are delivered as soon as they arrive; connections opened after the thread
+# has started are picked up as well.
 class NetworkThread(Thread):
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [ obj.handle_close() for obj in disconnected ]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        loop = network_event_loop()
+        asyncio.set_event_loop(loop)
+        if mininode_socket_map:
+            loop.run_forever()
 
 
 # An exception we can raise if we detect a potential disconnect
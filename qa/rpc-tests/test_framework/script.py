@@ -869,51 +869,74 @@ def getHashShieldedOutputs(tx):
     return digest.digest()
 
 
-def SignatureHash(script, txTo, inIdx, hashtype, amount, consensusBranchId):
-    """Consensus-correct SignatureHash"""
-    if inIdx >= len(txTo.vin):
-        raise ValueError("inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-
-    if consensusBranchId != 0:
-        # ZIP 243
-        hashPrevouts = b'\x00'*32
-        hashSequence = b'\x00'*32
-        hashOutputs = b'\x00'*32
-        hashJoinSplits = b'\x00'*32
-        hashShieldedSpends = b'\x00'*32
-        hashShieldedOutputs = b'\x00'*32
+class SighashCache(object):
+    """Signature hashes of the inputs of txTo for one consensus branch
 
-        if not (hashtype & SIGHASH_ANYONECANPAY):
-            hashPrevouts = getHashPrevouts(txTo)
-
-        if (not (hashtype & SIGHASH_ANYONECANPAY)) and \
-            (hashtype & 0x1f) != SIGHASH_SINGLE and \
-            (hashtype & 0x1f) != SIGHASH_NONE:
-            hashSequence = getHashSequence(txTo)
-
-        if (hashtype & 0x1f) != SIGHASH_SINGLE and \
-            (hashtype & 0x1f) != SIGHASH_NONE:
-            hashOutputs = getHashOutputs(txTo)
-        elif (hashtype & 0x1f) == SIGHASH_SINGLE and \
-            0 <= inIdx and inIdx < len(txTo.vout):
-            digest = blake2b(digest_size=32, person=b'ZcashOutputsHash')
-            digest.update(txTo.vout[inIdx].serialize())
-            hashOutputs = digest.digest()
+    The per-transaction digests of ZIP 243 are computed once, and the state
+    of the signature hash digest after everything up to the hashtype is kept
+    for every hashtype, so each input only hashes its own fields.
+    Pre-Overwinter hashes reuse a single copy of txTo that is changed for
+    the input being hashed and restored afterwards.
 
-        if len(txTo.vJoinSplit) > 0:
-            hashJoinSplits = getHashJoinSplits(txTo)
+    Only the scriptSigs of txTo may change while the cache is in use, as
+    they are not part of any signature hash.
+    """
 
-        if len(txTo.shieldedSpends) > 0:
-            hashShieldedSpends = getHashShieldedSpends(txTo)
+    def __init__(self, txTo, consensusBranchId):
+        self.txTo = txTo
+        self.consensusBranchId = consensusBranchId
+        self._digests = {}
+        self._midstates = {}
+        self._txtmp = None
 
-        if len(txTo.shieldedOutputs) > 0:
-            hashShieldedOutputs = getHashShieldedOutputs(txTo)
+    def _digest(self, name, compute):
+        try:
+            return self._digests[name]
+        except KeyError:
+            digest = self._digests[name] = compute(self.txTo)
+            return digest
+
+    # hashOutputs of SIGHASH_SINGLE: the digest of the output at inIdx only
+    def _output_digest(self, inIdx):
+        def compute(tx):
+            digest = blake2b(digest_size=32, person=b'ZcashOutputsHash')
+            digest.update(tx.vout[inIdx].serialize())
+            return digest.digest()
+        return self._digest(('output', inIdx), compute)
+
+    # Signature hash digest fed with every field up to the hashtype.
+    # hashOutputs differs per input for SIGHASH_SINGLE, so that state is
+    # built for each input instead of being kept.
+    def _midstate(self, hashtype, inIdx):
+        base = hashtype & 0x1f
+        single = base == SIGHASH_SINGLE
+        if not single and hashtype in self._midstates:
+            return self._midstates[hashtype]
+        txTo = self.txTo
+        zero = b'\x00'*32
+
+        hashPrevouts = zero
+        hashSequence = zero
+        hashOutputs = zero
+        if not (hashtype & SIGHASH_ANYONECANPAY):
+            hashPrevouts = self._digest('prevouts', getHashPrevouts)
+            if base != SIGHASH_SINGLE and base != SIGHASH_NONE:
+                hashSequence = self._digest('sequence', getHashSequence)
+        if base != SIGHASH_SINGLE and base != SIGHASH_NONE:
+            hashOutputs = self._digest('outputs', getHashOutputs)
+        elif single and 0 <= inIdx and inIdx < len(txTo.vout):
+            hashOutputs = self._output_digest(inIdx)
+        hashJoinSplits = self._digest('joinsplits', getHashJoinSplits) \
+            if len(txTo.vJoinSplit) > 0 else zero
+        hashShieldedSpends = self._digest('spends', getHashShieldedSpends) \
+            if len(txTo.shieldedSpends) > 0 else zero
+        hashShieldedOutputs = self._digest('shieldedoutputs', getHashShieldedOutputs) \
+            if len(txTo.shieldedOutputs) > 0 else zero
 
         digest = blake2b(
             digest_size=32,
-            person=b'ZcashSigHash' + struct.pack('<I', consensusBranchId),
+            person=b'ZcashSigHash' + struct.pack('<I', self.consensusBranchId),
         )
-
         digest.update(struct.pack('<I', (int(txTo.fOverwintered)<<31) | txTo.nVersion))
         digest.update(struct.pack('<I', txTo.nVersionGroupId))
         digest.update(hashPrevouts)
@@ -926,7 +949,66 @@ def SignatureHash(script, txTo, inIdx, hashtype, amount, consensusBranchId):
         digest.update(struct.pack('<I', txTo.nExpiryHeight))
         digest.update(struct.pack('<Q', txTo.valueBalance))
         digest.update(struct.pack('<I', hashtype))
+        if not single:
+            self._midstates[hashtype] = digest
+        return digest
+
+    def _legacy_hash(self, script, inIdx, hashtype):
+        if self._txtmp is None:
+            self._txtmp = CTransaction(self.txTo)
+            for txin in self._txtmp.vin:
+                txin.scriptSig = b''
+        txtmp = self._txtmp
+        vin = txtmp.vin
+        vout = txtmp.vout
+        txin = vin[inIdx]
+        base = hashtype & 0x1f
+        sequences = None
+        txin.scriptSig = script
+        try:
+            if base == SIGHASH_NONE:
+                txtmp.vout = []
+            elif base == SIGHASH_SINGLE:
+                outIdx = inIdx
+                if outIdx >= len(vout):
+                    raise ValueError("outIdx %d out of range (%d)" % (outIdx, len(vout)))
+                txtmp.vout = [CTxOut() for i in range(outIdx)] + [vout[outIdx]]
+
+            if hashtype & SIGHASH_ANYONECANPAY:
+                txtmp.vin = [txin]
+            elif base == SIGHASH_NONE or base == SIGHASH_SINGLE:
+                sequences = [x.nSequence for x in vin]
+                for i in range(len(vin)):
+                    if i != inIdx:
+                        vin[i].nSequence = 0
+
+            # Bypasses CTransaction's serialization cache: txtmp changes for
+            # every input, so a cached copy would never be used again
+            s = bytearray()
+            txtmp._serialize_fields(s)
+        finally:
+            txtmp.vin = vin
+            txtmp.vout = vout
+            txin.scriptSig = b''
+            if sequences is not None:
+                for x, nSequence in zip(vin, sequences):
+                    x.nSequence = nSequence
+
+        s += struct.pack(b"<I", hashtype)
+        return hash256(s)
+
+    def signature_hash(self, script, inIdx, hashtype, amount):
+        """Consensus-correct SignatureHash of input inIdx"""
+        txTo = self.txTo
+        if inIdx >= len(txTo.vin):
+            raise ValueError("inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+
+        if self.consensusBranchId == 0:
+            # Pre-Overwinter
+            return (self._legacy_hash(script, inIdx, hashtype), None)
 
+        # ZIP 243
+        digest = self._midstate(hashtype, inIdx).copy()
         if inIdx is not None:
             digest.update(txTo.vin[inIdx].prevout.serialize())
             digest.update(ser_string(script))
@@ -934,44 +1016,29 @@ def SignatureHash(script, txTo, inIdx, hashtype, amount, consensusBranchId):
             digest.update(struct.pack('<I', txTo.vin[inIdx].nSequence))
 
         return (digest.digest(), None)
-    else:
-        # Pre-Overwinter
-        txtmp = CTransaction(txTo)
-
-        for txin in txtmp.vin:
-            txin.scriptSig = b''
-        txtmp.vin[inIdx].scriptSig = script
 
-        if (hashtype & 0x1f) == SIGHASH_NONE:
-            txtmp.vout = []
 
-            for i in range(len(txtmp.vin)):
-                if i != inIdx:
-                    txtmp.vin[i].nSequence = 0
+def SignatureHash(script, txTo, inIdx, hashtype, amount, consensusBranchId):
+    """Consensus-correct SignatureHash
 
-        elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-            outIdx = inIdx
-            if outIdx >= len(txtmp.vout):
-                raise ValueError("outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
+    Use a SighashCache to hash several inputs of the same transaction."""
+    return SighashCache(txTo, consensusBranchId).signature_hash(script, inIdx, hashtype, amount)
 
-            tmp = txtmp.vout[outIdx]
-            txtmp.vout = []
-            for i in range(outIdx):
-                txtmp.vout.append(CTxOut())
-            txtmp.vout.append(tmp)
 
-            for i in range(len(txtmp.vin)):
-                if i != inIdx:
-                    txtmp.vin[i].nSequence = 0
+def signature_hashes(txTo, spent, hashtype=SIGHASH_ALL, consensusBranchId=0):
+    """Signature hashes of all inputs of txTo
 
-        if hashtype & SIGHASH_ANYONECANPAY:
-            tmp = txtmp.vin[inIdx]
-            txtmp.vin = []
-            txtmp.vin.append(tmp)
+    spent[i] is the (scriptPubKey, amount) of the output spent by input i."""
+    cache = SighashCache(txTo, consensusBranchId)
+    return [cache.signature_hash(script, inIdx, hashtype, amount)[0]
+            for inIdx, (script, amount) in enumerate(spent)]
 
-        s = txtmp.serialize()
-        s += struct.pack(b"<I", hashtype)
 
-        hash = hash256(s)
+def sign_all_inputs(txTo, spent, sign, hashtype=SIGHASH_ALL, consensusBranchId=0):
+    """Sets the scriptSig of every input of txTo
 
-        return (hash, None)
+    spent[i] is the (scriptPubKey, amount) of the output spent by input i,
+    and sign(inIdx, sighash) returns the scriptSig of input inIdx."""
+    for inIdx, sighash in enumerate(signature_hashes(txTo, spent, hashtype, consensusBranchId)):
+        txTo.vin[inIdx].scriptSig = sign(inIdx, sighash)
+    txTo.rehash()
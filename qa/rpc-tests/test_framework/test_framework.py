@@ -25,6 +25,7 @@ from .util import (
     assert_equal,
     check_json_precision,
     initialize_chain_clean,
+    report_sync_waits,
 )
 
 
@@ -164,6 +165,8 @@ class BitcoinTestFramework(object):
         except KeyboardInterrupt as e:
             print("Exiting after " + repr(e))
 
+        report_sync_waits()
+
         if not self.options.noshutdown:
             print("Stopping nodes")
             stop_nodes(self.nodes)
@@ -204,6 +207,10 @@ class ComparisonTestFramework(BitcoinTestFramework):
         parser.add_option("--refbinary", dest="refbinary",
                           default=os.getenv("PASTELD", "pasteld"),
                           help="pasteld binary to use for reference nodes (if any)")
+        parser.add_option("--differential", dest="differential", default=False, action="store_true",
+                          help="Don't stop at the first mismatch between the nodes, report all of them at the end")
+        parser.add_option("--comparelog", dest="comparelog", default=None,
+                          help="Write the per-node outcome of every check to this JSON file")
 
     def setup_chain(self):
         print(f'Initializing test directory {self.options.tmpdir}')
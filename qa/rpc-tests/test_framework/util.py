@@ -8,9 +8,10 @@
 # Helpful routines for regression testing
 #
 
+import asyncio
 import os
-import sys
 from binascii import hexlify, unhexlify
+from contextlib import contextmanager
 from base64 import b64encode
 from decimal import Decimal, ROUND_DOWN
 import json
@@ -20,12 +21,39 @@ import shutil
 import subprocess
 import time
 import re
-from .authproxy import AuthServiceProxy
+import hashlib
+from .authproxy import AuthServiceProxy, AsyncAuthServiceProxy, JSONRPCException
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+# Each port kind gets a PORT_RANGE wide block. qa/pull-tester/rpc-tests.py
+# sets PORT_SEED to the job slot of every test it runs in parallel, so each
+# job owns MAX_NODES ports of every block; standalone runs fall back to the pid.
+MAX_NODES = 20
+PORT_RANGE = 1000
+
+def port_seed():
+    seed = os.environ.get("PORT_SEED")
+    if seed is None:
+        return os.getpid()%999
+    offset = int(seed) * MAX_NODES
+    assert offset + MAX_NODES <= PORT_RANGE, "PORT_SEED %s is out of range" % seed
+    return offset
 
 def p2p_port(n):
-    return 11000 + n + os.getpid()%999
+    return 11000 + n + port_seed()
 def rpc_port(n):
-    return 12000 + n + os.getpid()%999
+    return 12000 + n + port_seed()
+def zmq_port(n):
+    return 13000 + n + port_seed()
 
 def check_json_precision():
     """Make sure json library being used does not lose precision converting PASTEL values"""
@@ -43,21 +71,126 @@ def hex_str_to_bytes(hex_str):
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
 
+class SyncNotifier():
+    """
+    Subscriber to the hashblock and hashtx ZMQ feeds of the nodes started by
+    start_node(), used to wake up the sync helpers as soon as a node gets a
+    new tip or mempool transaction
+    """
+    def __init__(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"hashtx")
+        self.endpoints = set()
+
+    def connect(self, endpoint):
+        # ZMQ connects in the background and reconnects after node restarts
+        if endpoint not in self.endpoints:
+            self.socket.connect(endpoint)
+            self.endpoints.add(endpoint)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for a notification from any node and
+        discard everything received. Returns True if there was one.
+        """
+        if not self.socket.poll(timeout * 1000):
+            return False
+        while self.socket.poll(0):
+            self.socket.recv_multipart()
+        return True
+
+_sync_notifier = None
+
+def sync_notifier():
+    """
+    Return the shared SyncNotifier, or None without the zmq module
+    """
+    global _sync_notifier
+    if _sync_notifier is None and zmq is not None:
+        _sync_notifier = SyncNotifier()
+    return _sync_notifier
+
+# Time spent in wait_for_sync() and comptool's wait_until() by the name of
+# the waiting helper, as [number of waits, seconds]
+sync_wait_stats = {}
+
+def record_sync_wait(name, seconds):
+    stats = sync_wait_stats.setdefault(name, [0, 0.0])
+    stats[0] += 1
+    stats[1] += seconds
+
+def report_sync_waits():
+    total = 0.0
+    for name, (calls, seconds) in sorted(sync_wait_stats.items()):
+        print("%s: waited %.2f sec in %d calls" % (name, seconds, calls))
+        total += seconds
+    print("Total time spent waiting for sync: %.2f sec" % total)
+
+def wait_for_sync(name, predicate, wait=1, timeout=None):
+    """
+    Call predicate() until it returns true or timeout seconds have passed.
+    Between calls, wait for a block or transaction notification from any
+    node; without one, back off from 0.05 sec up to wait seconds.
+    Returns the last result of predicate().
+    """
+    start = time.time()
+    delay = min(0.05, wait)
+    notifier = sync_notifier()
+    try:
+        while True:
+            if predicate():
+                return True
+            remaining = None
+            if timeout is not None:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    return False
+            pause = delay if remaining is None else min(delay, remaining)
+            if notifier is not None:
+                notified = notifier.wait(pause)
+            else:
+                time.sleep(pause)
+                notified = False
+            if not notified:
+                delay = min(delay * 2, wait)
+    finally:
+        record_sync_wait(name, time.time() - start)
+
+_rpc_loop = None
+
+def run_async(coro):
+    """
+    Run coro on the event loop the test thread uses for
+    AsyncAuthServiceProxy calls and return its result
+    """
+    global _rpc_loop
+    if _rpc_loop is None:
+        _rpc_loop = asyncio.new_event_loop()
+    return _rpc_loop.run_until_complete(coro)
+
+def call_all(rpc_connections, method, *args):
+    """
+    Call an RPC method on all nodes at once and return the results
+    in the order of rpc_connections
+    """
+    async def gather():
+        return await asyncio.gather(*[ getattr(x.async_proxy(), method)(*args)
+                                       for x in rpc_connections ])
+    return run_async(gather())
+
 def sync_blocks(rpc_connections, wait=1, stop_after=-1):
     """
     Wait until everybody has the same block count
     """
     print("Waiting for blocks to sync (wait interval=%d sec each, max tries=%d" %(wait, stop_after))
-    count = 0
-    while True:
-        counts = [ x.getblockcount() for x in rpc_connections ]
-        count += 1
-        if counts == [ counts[0] ]*len(counts):
-            break
-        if stop_after != -1 and count > stop_after:
-            break
-        print("loop = " + str(count))
-        time.sleep(wait)
+    def synced():
+        counts = call_all(rpc_connections, "getblockcount")
+        return counts == [ counts[0] ]*len(counts)
+    wait_for_sync("sync_blocks", synced, wait,
+                  None if stop_after == -1 else stop_after * wait)
 
 def sync_mempools(rpc_connections, wait=1, stop_after=-1):
     """
@@ -65,20 +198,11 @@ def sync_mempools(rpc_connections, wait=1, stop_after=-1):
     pools
     """
     print("Waiting for mempools to sync (wait interval=%d sec each, max tries=%d" %(wait, stop_after))
-    count = 0
-    while True:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        count += 1
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match = num_match+1
-        if num_match == len(rpc_connections):
-            break
-        if stop_after != -1 and count > stop_after:
-            break
-        print("loop = " + str(count))
-        time.sleep(wait)
+    def synced():
+        pools = [ set(x) for x in call_all(rpc_connections, "getrawmempool") ]
+        return pools == [ pools[0] ]*len(pools)
+    wait_for_sync("sync_mempools", synced, wait,
+                  None if stop_after == -1 else stop_after * wait)
 
 pasteld_processes = {}
 
@@ -96,78 +220,131 @@ def initialize_datadir(dirname, n):
         f.write("listenonion=0\n")
     return datadir
 
-def initialize_chain(test_dir):
+def chain_cache_dir(num_nodes=4, height=200, extra_args=None):
+    """
+    Return the cache directory of the chain built by initialize_chain() with
+    these parameters. The default 200-block chain stays in "cache" itself.
     """
-    Create (or copy from cache) a 200-block-long chain and
-    4 wallets.
-    pasteld and pastel-cli must be in search path.
+    if (num_nodes, height, extra_args) == (4, 200, None):
+        return "cache"
+    key = json.dumps([num_nodes, height, extra_args], sort_keys=True)
+    return os.path.join("cache", "chain-%d-%d-%s" % (
+        num_nodes, height, hashlib.sha256(key.encode('utf8')).hexdigest()[:12]))
+
+@contextmanager
+def cache_lock(cache_dir):
     """
+    Hold an exclusive lock on cache_dir, so that tests running in parallel
+    build each cached chain only once
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs("cache", exist_ok=True)
+    with open(cache_dir.rstrip(os.sep) + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def build_chain_cache(cache_dir, num_nodes, height, extra_args):
+    build_dir = "%s.build-%d" % (cache_dir.rstrip(os.sep), os.getpid())
+    shutil.rmtree(build_dir, ignore_errors=True)
+    # Create cache directories, run pasteld:
+    node_args = []
+    for i in range(num_nodes):
+        initialize_datadir(build_dir, i)
+        args = []
+        if i > 0:
+            args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
+        if extra_args is not None and extra_args[i] is not None:
+            args.extend(extra_args[i])
+        node_args.append(args)
+    rpcs = start_nodes(num_nodes, build_dir, node_args, rest=False)
+
+    # Create the chain; the nodes take turns to mine 25 blocks each, so
+    # with the default 4 nodes and 200 blocks each of them gets 25 mature
+    # blocks and 25 immature.
+    # blocks are created with timestamps 2 minutes apart, starting
+    # at 25th Dec 2020 - 1608854400
+    block_time = 1608854400
+    peer = 0
+    while height > 0:
+        for j in range(min(25, height)):
+            set_node_times(rpcs, block_time)
+            rpcs[peer].generate(1)
+            block_time += 2*60
+        height -= min(25, height)
+        # Must sync before next peer starts generating blocks
+        sync_blocks(rpcs)
+        peer = (peer + 1) % num_nodes
+
+    # Shut them down, and clean up cache directories:
+    stop_nodes(rpcs)
+    wait_pastelds()
+    for i in range(num_nodes):
+        for logname in ("debug.log", "db.log", "peers.dat", "fee_estimates.dat"):
+            if os.path.exists(log_filename(build_dir, i, logname)):
+                os.remove(log_filename(build_dir, i, logname))
 
-    if os.name == "nt":
-        isWindows = True
-        PastelDaemon = "pasteld.exe"
-        PastelClient = "pastel-cli.exe"
-    else:
-        isWindows = False
-        PastelDaemon = "pasteld"
-        PastelClient = "pastel-cli"
-    if not os.path.isdir(os.path.join("cache", "node0")):
-        print("Rebuilding cache...")
-        if not isWindows:
-            devnull = open("/dev/null", "w+")
-        # Create cache directories, run pasteld:
-        for i in range(4):
-            datadir=initialize_datadir("cache", i)
-            args = [ os.getenv("PASTELD", PastelDaemon), "-keypool=1", "-datadir="+datadir, "-discover=0" ]
-            if i > 0:
-                args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
-            pasteld_processes[i] = subprocess.Popen(args)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: pasteld started, calling pastel-cli -rpcwait getblockcount")
-            subprocess.check_call([ os.getenv("PASTELDCLI", PastelClient), "-datadir="+datadir,
-                                    "-rpcwait", "getblockcount"], stdout=devnull)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: pastel-cli -rpcwait getblockcount completed")
-        devnull.close()
-        rpcs = []
-        for i in range(4):
-            try:
-                url = "http://rt:rt@127.0.0.1:%d"%(rpc_port(i),)
-                rpcs.append(AuthServiceProxy(url))
-            except:
-                sys.stderr.write("Error connecting to "+url+"\n")
-                sys.exit(1)
-
-        # Create a 200-block-long chain; each of the 4 nodes
-        # gets 25 mature blocks and 25 immature.
-        # blocks are created with timestamps 10 minutes apart, starting
-        # at 25th Dec 2020 - 1608854400
-        block_time = 1608854400
-        for i in range(2):
-            for peer in range(4):
-                for j in range(25):
-                    set_node_times(rpcs, block_time)
-                    rpcs[peer].generate(1)
-                    # block_time += 10*60
-                    block_time += 2*60
-                # Must sync before next peer starts generating blocks
-                sync_blocks(rpcs)
-
-        # Shut them down, and clean up cache directories:
-        stop_nodes(rpcs)
-        wait_pastelds()
-        for i in range(4):
-            os.remove(log_filename("cache", i, "debug.log"))
-            os.remove(log_filename("cache", i, "db.log"))
-            os.remove(log_filename("cache", i, "peers.dat"))
-            os.remove(log_filename("cache", i, "fee_estimates.dat"))
-
-        print("Finished Rebuilding cache...")
-
-    for i in range(4):
-        from_dir = os.path.join("cache", "node"+str(i))
+    os.makedirs(cache_dir, exist_ok=True)
+    # node0 last, its presence marks a complete cache
+    for i in reversed(range(num_nodes)):
+        os.rename(os.path.join(build_dir, "node"+str(i)),
+                  os.path.join(cache_dir, "node"+str(i)))
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+# Linux ioctl that makes dst share the data blocks of src until either is
+# written (btrfs, XFS and other filesystems with reflink support)
+FICLONE = 0x40049409
+
+# LevelDB table files, which are never modified once written
+_immutable_file = re.compile(r'^[0-9]+\.(ldb|sst)$')
+
+def snapshot_file(src, dst):
+    """
+    copy_function for shutil.copytree() that clones src if the filesystem
+    supports it, hard links files that are never written to, and copies
+    the rest
+    """
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    if _immutable_file.match(os.path.basename(src)):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+def initialize_chain(test_dir, num_nodes=4, height=200, extra_args=None):
+    """
+    Create (or copy from cache) a chain of height blocks mined by num_nodes
+    wallets, 200 blocks and 4 wallets by default. extra_args are the
+    per-node pasteld arguments used to mine it (e.g. -nuparams) and are
+    part of the cache key, so tests using the same ones share the chain.
+    pasteld must be in search path.
+    """
+    cache_dir = chain_cache_dir(num_nodes, height, extra_args)
+    if not os.path.isdir(os.path.join(cache_dir, "node0")):
+        with cache_lock(cache_dir):
+            if not os.path.isdir(os.path.join(cache_dir, "node0")):
+                print("Rebuilding cache %s..." % cache_dir)
+                build_chain_cache(cache_dir, num_nodes, height, extra_args)
+                print("Finished Rebuilding cache...")
+
+    for i in range(num_nodes):
+        from_dir = os.path.join(cache_dir, "node"+str(i))
         to_dir = os.path.join(test_dir,  "node"+str(i))
-        shutil.copytree(from_dir, to_dir)
+        shutil.copytree(from_dir, to_dir, copy_function=snapshot_file)
         initialize_datadir(test_dir, i) # Overwrite port/rpcport in pastel.conf
 
 def initialize_chain_clean(test_dir, num_nodes):
@@ -179,46 +356,68 @@ def initialize_chain_clean(test_dir, num_nodes):
         initialize_datadir(test_dir, i)
 
 
-def _rpchost_to_args(rpchost):
-    '''Convert optional IP:port spec to rpcconnect/rpcport args'''
-    if rpchost is None:
-        return []
-
-    match = re.match('(\[[0-9a-fA-f:]+\]|[^:]+)(?::([0-9]+))?$', rpchost)
-    if not match:
-        raise ValueError('Invalid RPC host spec ' + rpchost)
-
-    rpcconnect = match.group(1)
-    rpcport = match.group(2)
+def rpc_url(i, rpchost=None):
+    host, port = '127.0.0.1', rpc_port(i)
+    if rpchost is not None:
+        match = re.match('(\[[0-9a-fA-f:]+\]|[^:]+)(?::([0-9]+))?$', rpchost)
+        if not match:
+            raise ValueError('Invalid RPC host spec ' + rpchost)
+        host = match.group(1)
+        if match.group(2):
+            port = int(match.group(2))
+    return "http://rt:rt@%s:%d" % (host, port)
 
-    if rpcconnect.startswith('['): # remove IPv6 [...] wrapping
-        rpcconnect = rpcconnect[1:-1]
-
-    rv = ['-rpcconnect=' + rpcconnect]
-    if rpcport:
-        rv += ['-rpcport=' + rpcport]
-    return rv
-
-def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+def launch_node(i, dirname, extra_args=None, binary=None, rest=True):
     """
-    Start a pasteld and return RPC connection to it
+    Start pasteld i without waiting for it to be ready
     """
     datadir = os.path.join(dirname, "node"+str(i))
     if binary is None:
         binary = os.getenv("PASTELD", "pasteld")
-    args = [ binary, "-datadir="+datadir, "-keypool=1", "-discover=0", "-rest" ]
+    args = [ binary, "-datadir="+datadir, "-keypool=1", "-discover=0" ]
+    if rest:
+        args.append("-rest")
+    notifier = sync_notifier()
+    if notifier is not None:
+        # For wait_for_sync(); a later -zmqpub* in extra_args takes precedence
+        endpoint = "tcp://127.0.0.1:%d" % zmq_port(i)
+        args += [ "-zmqpubhashblock="+endpoint, "-zmqpubhashtx="+endpoint ]
+        notifier.connect(endpoint)
     if extra_args is not None: args.extend(extra_args)
     pasteld_processes[i] = subprocess.Popen(args)
-    devnull = open("/dev/null", "w+")
     if os.getenv("PYTHON_DEBUG", ""):
-        print("start_node: pasteld started, calling pastel-cli -rpcwait getblockcount")
-    subprocess.check_call([ os.getenv("PASTELCLI", "pastel-cli"), "-datadir="+datadir] +
-                          _rpchost_to_args(rpchost)  +
-                          ["-rpcwait", "getblockcount"], stdout=devnull)
+        print("launch_node: pasteld %d started" % i)
+
+async def wait_for_rpc(i, url):
+    """
+    Wait until pasteld i answers RPC calls, like pastel-cli -rpcwait.
+    Fails if the process exits first.
+    """
+    proxy = AsyncAuthServiceProxy(url, timeout=30)
+    delay = 0.05
+    try:
+        while True:
+            if pasteld_processes[i].poll() is not None:
+                raise AssertionError("pasteld %d exited with code %d during startup"
+                                     % (i, pasteld_processes[i].returncode))
+            try:
+                await proxy.getblockcount()
+                break
+            except JSONRPCException as e:
+                # -28: still warming up; -342: not serving JSON-RPC yet
+                if e.error['code'] not in (-28, -342):
+                    raise
+            except (OSError, EOFError, http.client.HTTPException, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+    finally:
+        proxy.close()
     if os.getenv("PYTHON_DEBUG", ""):
-        print("start_node: calling pastel-cli -rpcwait getblockcount returned")
-    devnull.close()
-    url = "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
+        print("wait_for_rpc: pasteld %d is ready" % i)
+
+def node_proxy(i, rpchost=None, timewait=None):
+    url = rpc_url(i, rpchost)
     if timewait is not None:
         proxy = AuthServiceProxy(url, timeout=timewait)
     else:
@@ -226,13 +425,28 @@ def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=
     proxy.url = url # store URL on proxy for info
     return proxy
 
-def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, binary=None):
+def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+    """
+    Start a pasteld and return RPC connection to it
     """
-    Start multiple pastelds, return RPC connections to them
+    launch_node(i, dirname, extra_args, binary)
+    run_async(wait_for_rpc(i, rpc_url(i, rpchost)))
+    return node_proxy(i, rpchost, timewait)
+
+def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, binary=None, rest=True):
+    """
+    Start multiple pastelds at once, wait until all of them are ready and
+    return RPC connections to them
     """
     if extra_args is None: extra_args = [ None for i in range(num_nodes) ]
     if binary is None: binary = [ None for i in range(num_nodes) ]
-    return [ start_node(i, dirname, extra_args[i], rpchost, binary=binary[i]) for i in range(num_nodes) ]
+    for i in range(num_nodes):
+        launch_node(i, dirname, extra_args[i], binary[i], rest)
+    async def ready():
+        await asyncio.gather(*[ wait_for_rpc(i, rpc_url(i, rpchost))
+                                for i in range(num_nodes) ])
+    run_async(ready())
+    return [ node_proxy(i, rpchost) for i in range(num_nodes) ]
 
 def log_filename(dirname, n_node, logname):
     return os.path.join(dirname, "node"+str(n_node), "regtest", logname)
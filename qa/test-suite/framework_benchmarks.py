@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmarks for hot paths of the RPC/p2p test framework in
+# qa/rpc-tests/test_framework.
+#
+# Usage:
+#   qa/test-suite/framework_benchmarks.py [benchmark ...]
+#
+# Runs all benchmarks when none is named; see --help for the list.
+#
+
+import argparse
+import copy
+import os
+import random
+import struct
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rpc-tests'))
+
+from test_framework import authproxy, blockstore, equihash, mininode, script
+
+
+def report(name, before, after):
+    print('  %-40s %10.2f us %10.2f us %8.1fx' % (
+        name, before*1e6, after*1e6, before/after if after else float('inf')))
+
+def measure(stmt, number):
+    return min(timeit.repeat(stmt, number=number, repeat=3))/number
+
+
+#
+# expand_array / compress_array
+#
+
+# The per-bit loops that expand_array() and compress_array() used before
+# they were moved onto precomputed codec plans; kept as the baseline.
+def bitwise_expand_array(inp, out_len, bit_len, byte_pad=0):
+    assert bit_len >= 8 and equihash.word_size >= 7+bit_len
+    out_width = (bit_len+7)//8 + byte_pad
+    assert out_len == 8*out_width*len(inp)//bit_len
+    out = bytearray(out_len)
+    bit_len_mask = (1 << bit_len) - 1
+    acc_bits = 0
+    acc_value = 0
+    j = 0
+    for i in range(len(inp)):
+        acc_value = ((acc_value << 8) & equihash.word_mask) | inp[i]
+        acc_bits += 8
+        if acc_bits >= bit_len:
+            acc_bits -= bit_len
+            for x in range(byte_pad, out_width):
+                out[j+x] = (acc_value >> (acc_bits+(8*(out_width-x-1)))) & \
+                    ((bit_len_mask >> (8*(out_width-x-1))) & 0xFF)
+            j += out_width
+    return out
+
+def bitwise_compress_array(inp, out_len, bit_len, byte_pad=0):
+    assert bit_len >= 8 and equihash.word_size >= 7+bit_len
+    in_width = (bit_len+7)//8 + byte_pad
+    assert out_len == bit_len*len(inp)//(8*in_width)
+    out = bytearray(out_len)
+    bit_len_mask = (1 << bit_len) - 1
+    acc_bits = 0
+    acc_value = 0
+    j = 0
+    for i in range(out_len):
+        if acc_bits < 8:
+            acc_value = ((acc_value << bit_len) & equihash.word_mask) | inp[j]
+            for x in range(byte_pad, in_width):
+                acc_value = acc_value | (
+                    (inp[j+x] & ((bit_len_mask >> (8*(in_width-x-1))) & 0xFF))
+                    << (8*(in_width-x-1)))
+            j += in_width
+            acc_bits += bit_len
+        acc_bits -= 8
+        out[i] = (acc_value >> acc_bits) & 0xFF
+    return out
+
+def bench_codec():
+    print('expand_array / compress_array (bit loop vs. codec plan)')
+    random.seed(1)
+    for (n, k) in [(48, 5), (200, 9)]:
+        collision_length = n//(k+1)
+        hash_length = (k+1)*((collision_length+7)//8)
+        bit_len = collision_length+1
+        byte_pad = 4 - (bit_len+7)//8
+        count = 1 << k
+        hash_row = bytearray(random.getrandbits(8) for _ in range(n//8))
+        indices = [random.getrandbits(bit_len) for _ in range(count)]
+        index_bytes = bytearray(b''.join(struct.pack('>I', i) for i in indices))
+        minimal = equihash.get_minimal_from_indices(indices, bit_len)
+        print(' %-41s %13s %13s %9s' % ('n=%d, k=%d' % (n, k), 'before', 'after', 'speedup'))
+
+        assert bitwise_expand_array(hash_row, hash_length, collision_length) == \
+            equihash.expand_array(hash_row, hash_length, collision_length)
+        report('expand hash row',
+               measure(lambda: bitwise_expand_array(hash_row, hash_length, collision_length), 2000),
+               measure(lambda: equihash.expand_array(hash_row, hash_length, collision_length), 2000))
+
+        assert bitwise_expand_array(minimal, 4*count, bit_len, byte_pad) == \
+            equihash.expand_array(minimal, 4*count, bit_len, byte_pad)
+        report('expand minimal solution',
+               measure(lambda: bitwise_expand_array(minimal, 4*count, bit_len, byte_pad), 200),
+               measure(lambda: equihash.expand_array(minimal, 4*count, bit_len, byte_pad), 200))
+
+        assert bitwise_compress_array(index_bytes, len(minimal), bit_len, byte_pad) == minimal
+        report('compress solution indices',
+               measure(lambda: bitwise_compress_array(index_bytes, len(minimal), bit_len, byte_pad), 200),
+               measure(lambda: equihash.compress_array(index_bytes, len(minimal), bit_len, byte_pad), 200))
+
+        report('get_indices_from_minimal',
+               measure(lambda: [struct.unpack('>I', b[i:i+4])[0] for b in
+                                [bitwise_expand_array(minimal, 4*count, bit_len, byte_pad)]
+                                for i in range(0, 4*count, 4)], 200),
+               measure(lambda: equihash.get_indices_from_minimal(minimal, bit_len), 200))
+
+
+#
+# Block and transaction serialization
+#
+
+# Serialization as done before serialize_into(): every field is appended to
+# an immutable bytes object, and each nested object returns its own copy.
+# Only covers the transparent Overwinter transactions built below.
+def concat_ser_uint256(u):
+    rs = b""
+    for i in range(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFF)
+        u >>= 32
+    return rs
+
+def concat_ser_tx(tx):
+    r = b""
+    r += struct.pack("<I", (int(tx.fOverwintered)<<31) | tx.nVersion)
+    if tx.fOverwintered:
+        r += struct.pack("<I", tx.nVersionGroupId)
+    r += mininode.ser_compactsize(len(tx.vin))
+    for txin in tx.vin:
+        o = b""
+        o += concat_ser_uint256(txin.prevout.hash)
+        o += struct.pack("<I", txin.prevout.n)
+        i = b""
+        i += o
+        i += mininode.ser_string(txin.scriptSig)
+        i += struct.pack("<I", txin.nSequence)
+        r += i
+    r += mininode.ser_compactsize(len(tx.vout))
+    for txout in tx.vout:
+        o = b""
+        o += struct.pack("<q", txout.nValue)
+        o += mininode.ser_string(txout.scriptPubKey)
+        r += o
+    r += struct.pack("<I", tx.nLockTime)
+    if tx.fOverwintered:
+        r += struct.pack("<I", tx.nExpiryHeight)
+    if tx.nVersion >= 2:
+        r += mininode.ser_compactsize(0)
+    return r
+
+def concat_ser_block(block):
+    r = b""
+    r += struct.pack("<i", block.nVersion)
+    r += concat_ser_uint256(block.hashPrevBlock)
+    r += concat_ser_uint256(block.hashMerkleRoot)
+    r += concat_ser_uint256(block.hashFinalSaplingRoot)
+    r += struct.pack("<I", block.nTime)
+    r += struct.pack("<I", block.nBits)
+    r += concat_ser_uint256(block.nNonce)
+    r += mininode.ser_compactsize(len(block.nSolution))
+    for i in block.nSolution:
+        r += struct.pack("B", i)
+    r += mininode.ser_compactsize(len(block.vtx))
+    for tx in block.vtx:
+        r += concat_ser_tx(tx)
+    return r
+
+# serialize_into() without the CTransaction serialization cache, which would
+# otherwise answer every call after the first
+def fresh_ser_tx(tx):
+    buf = bytearray()
+    tx._serialize_fields(buf)
+    return bytes(buf)
+
+def fresh_ser_block(block):
+    buf = bytearray()
+    mininode.CBlockHeader.serialize_into(block, buf)
+    buf += mininode.ser_compactsize(len(block.vtx))
+    for tx in block.vtx:
+        tx._serialize_fields(buf)
+    return bytes(buf)
+
+def bench_serialize():
+    print('CBlock.serialize (bytes concatenation vs. serialize_into)')
+    random.seed(1)
+    block = mininode.CBlock()
+    block.nSolution = [random.getrandbits(8) for _ in range(36)]
+    for _ in range(10000):
+        tx = mininode.CTransaction()
+        for n in range(2):
+            tx.vin.append(mininode.CTxIn(
+                mininode.COutPoint(random.getrandbits(256), n),
+                bytes(random.getrandbits(8) for _ in range(107)), 0xffffffff))
+            tx.vout.append(mininode.CTxOut(random.randrange(10**9), bytes(25)))
+        block.vtx.append(tx)
+    print(' %-41s %13s %13s %9s' % ('10000 transactions', 'before', 'after', 'speedup'))
+
+    assert concat_ser_block(block) == fresh_ser_block(block) == block.serialize()
+    concat_block = measure(lambda: concat_ser_block(block), 3)
+    report('serialize block', concat_block,
+           measure(lambda: fresh_ser_block(block), 3))
+    report('serialize block, transactions cached', concat_block,
+           measure(lambda: block.serialize(), 3))
+    tx = block.vtx[0]
+    concat_tx = measure(lambda: concat_ser_tx(tx), 10000)
+    report('serialize transaction', concat_tx,
+           measure(lambda: fresh_ser_tx(tx), 10000))
+    report('serialize transaction, cached', concat_tx,
+           measure(lambda: tx.serialize(), 10000))
+
+
+#
+# Memory use and copying of mininode objects
+#
+
+def plain_class(cls):
+    # A class with the same attributes as cls, but stored in a per-instance
+    # __dict__ the way the mininode classes did before they used __slots__.
+    return type('Plain' + cls.__name__, (object,), {})
+
+def allocated(make, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [make() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objs
+    return size/count
+
+def bench_memory():
+    print('Bytes per object (__dict__ vs. __slots__)')
+    random.seed(1)
+    block = mininode.CBlock()
+    block.nSolution = [random.getrandbits(8) for _ in range(36)]
+    for _ in range(1000):
+        tx = mininode.CTransaction()
+        tx.vin.append(mininode.CTxIn(mininode.COutPoint(random.getrandbits(256), 0),
+                                     bytes(107), 0xffffffff))
+        tx.vout.append(mininode.CTxOut(random.randrange(10**9), bytes(25)))
+        block.vtx.append(tx)
+    samples = [block.vtx[0].vin[0].prevout, block.vtx[0].vin[0],
+               block.vtx[0].vout[0], block.vtx[0], mininode.CBlockHeader(block),
+               mininode.CInv(2, block.sha256)]
+    print(' %-41s %13s %13s %9s' % ('', 'before', 'after', 'saving'))
+    for obj in samples:
+        cls = obj.__class__
+        plain = plain_class(cls)
+        fields = [(name, getattr(obj, name)) for name in cls.__slots__]
+        def make_plain():
+            o = plain()
+            for name, value in fields:
+                setattr(o, name, value)
+            return o
+        def make_slots():
+            o = cls.__new__(cls)
+            for name, value in fields:
+                setattr(o, name, value)
+            return o
+        before = allocated(make_plain, 100000)
+        after = allocated(make_slots, 100000)
+        print('  %-40s %10.0f B  %10.0f B  %7.0f%%' % (
+            cls.__name__, before, after, 100*(1 - after/before)))
+
+    print()
+    print('Copying (copy.deepcopy vs. copy())')
+    print(' %-41s %13s %13s %9s' % ('', 'before', 'after', 'speedup'))
+    tx = block.vtx[0]
+    report('copy transaction',
+           measure(lambda: copy.deepcopy(tx), 2000),
+           measure(lambda: tx.copy(), 2000))
+    report('copy 1000-transaction block',
+           measure(lambda: copy.deepcopy(block), 3),
+           measure(lambda: block.copy(), 3))
+
+
+#
+# Receive framing
+#
+
+# NodeConn's receive path before MessageFramer: recv(8192) appended to a
+# bytes buffer, which is re-sliced after every message.
+def concat_framing(chunks, magic):
+    recvbuf = b""
+    count = 0
+    for t in chunks:
+        recvbuf += t
+        while len(recvbuf) >= 4 + 12 + 4 + 4:
+            assert recvbuf[:4] == magic
+            msglen = struct.unpack("<i", recvbuf[4+12:4+12+4])[0]
+            if len(recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                break
+            msg = memoryview(recvbuf)[4+12+4+4:4+12+4+4+msglen]
+            assert recvbuf[4+12+4:4+12+4+4] == mininode.hash256(msg)[:4]
+            recvbuf = recvbuf[4+12+4+4+msglen:]
+            count += 1
+    return count
+
+def framer_framing(stream, read_size, magic):
+    framer = mininode.MessageFramer(magic, mininode.NodeConn.recv_size)
+    count = 0
+    pos = 0
+    while pos < len(stream):
+        # What recv_into() does with the buffer asyncio gets from NodeConn
+        view = framer.get_buffer(-1)
+        n = min(len(view), read_size, len(stream) - pos)
+        view[:n] = stream[pos:pos+n]
+        del view
+        framer.buffer_updated(n)
+        pos += n
+        while framer.next_message() is not None:
+            count += 1
+    return count
+
+def message_frame(magic, command, payload):
+    return magic + command + b"\x00"*(12 - len(command)) + \
+        struct.pack("<I", len(payload)) + mininode.hash256(payload)[:4] + payload
+
+def bench_framing():
+    print('Receive framing of 2 MB blocks, each followed by a ping')
+    magic = mininode.NodeConn.MAGIC_BYTES["regtest"]
+    block = message_frame(magic, b"block", os.urandom(2000000))
+    ping = message_frame(magic, b"ping", struct.pack("<Q", 1))
+    unit = block + ping
+    print(' %-41s %13s %13s %9s' % ('per block', 'before', 'after', 'speedup'))
+    old_blocks = 10
+    old_chunks = [unit[i:i+8192] for i in range(0, len(unit), 8192)] * old_blocks
+    start = timeit.default_timer()
+    assert concat_framing(old_chunks, magic) == 2*old_blocks
+    before = (timeit.default_timer() - start)/old_blocks
+    new_blocks = 1000
+    stream = memoryview(unit * new_blocks)
+    start = timeit.default_timer()
+    assert framer_framing(stream, 8192, magic) == 2*new_blocks
+    after = (timeit.default_timer() - start)/new_blocks
+    report('8 KiB reads', before, after)
+    start = timeit.default_timer()
+    assert framer_framing(stream, 256*1024, magic) == 2*new_blocks
+    report('256 KiB reads (recv_into)', before,
+           (timeit.default_timer() - start)/new_blocks)
+
+
+#
+# Decoding of large RPC responses
+#
+
+# AuthServiceProxy._get_response() before decode_response(): Decimal for
+# every float, and the result re-encoded for log.debug() even with debug
+# logging off.
+def plain_decode(data):
+    responsedata = data.decode('utf8')
+    response = authproxy.json.loads(responsedata, parse_float=authproxy.decimal.Decimal)
+    if "error" in response and response["error"] is None:
+        authproxy.log.debug("<-%s- %s"%(response["id"], authproxy.json.dumps(
+            response["result"], default=authproxy.EncodeDecimal)))
+    return response["result"]
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench_rpcdecode():
+    count = 50000
+    print('Decoding a listunspent result with %d entries' % count)
+    random.seed(1)
+    unspent = [{"txid": "%064x" % random.getrandbits(256), "vout": i % 3,
+                "generated": False, "address": "tPXXXXXXXXXXXXXXXXXXXXXXXXXXXX%05d" % (i % 100000),
+                "scriptPubKey": "76a914%040x88ac" % random.getrandbits(160),
+                "amount": random.randrange(10**10)/10**5,
+                "confirmations": random.randrange(1, 1000), "spendable": True}
+               for i in range(count)]
+    data = authproxy.json.dumps({"result": unspent, "error": None, "id": 1}).encode()
+    chunks = [data[i:i+authproxy.STREAM_CHUNK_SIZE]
+              for i in range(0, len(data), authproxy.STREAM_CHUNK_SIZE)]
+    def streamed(fields):
+        for item in authproxy.iter_json_result(chunks, fields):
+            pass
+    print(' %-41s %13s %13s %9s' % ('', 'before', 'after', 'speedup'))
+    before = measure(lambda: plain_decode(data), 1)
+    report('full decode', before,
+           measure(lambda: authproxy.decode_response(data), 1))
+    report('stream, all floats Decimal', before,
+           measure(lambda: streamed(None), 1))
+    report('stream, Decimal amount only', before,
+           measure(lambda: streamed(["amount"]), 1))
+    print()
+    print('Peak memory (chunks of %d KiB)' % (authproxy.STREAM_CHUNK_SIZE//1024))
+    before = peak_memory(lambda: plain_decode(data))
+    print('  %-40s %10.1f MB' % ('before', before/1e6))
+    print('  %-40s %10.1f MB' % ('full decode', peak_memory(lambda: authproxy.decode_response(data))/1e6))
+    print('  %-40s %10.1f MB' % ('stream', peak_memory(lambda: streamed(["amount"]))/1e6))
+
+
+#
+# BlockStore lookups
+#
+
+# The store before backends and the object cache: repr() keys and a
+# deserialize() on every get, also when only checking for existence.
+class ReprKeyStore(object):
+    def __init__(self):
+        self.blockDB = dict()
+
+    def add_block(self, block):
+        self.blockDB[repr(block.sha256)] = bytes(block.serialize())
+
+    def get(self, blockhash):
+        try:
+            serialized_block = self.blockDB[repr(blockhash)]
+        except KeyError:
+            return None
+        ret = mininode.CBlock()
+        ret.deserialize(mininode.ByteReader(serialized_block))
+        ret.calc_sha256()
+        return ret
+
+def make_chain(count, txs):
+    random.seed(1)
+    blocks = []
+    for height in range(count):
+        block = mininode.CBlock()
+        block.hashPrevBlock = blocks[-1].sha256 if blocks else 0
+        block.nSolution = [random.getrandbits(8) for _ in range(36)]
+        for _ in range(txs):
+            tx = mininode.CTransaction()
+            tx.vin.append(mininode.CTxIn(mininode.COutPoint(random.getrandbits(256), 0),
+                                         bytes(107), 0xffffffff))
+            tx.vout.append(mininode.CTxOut(random.randrange(10**9), bytes(25)))
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        blocks.append(block)
+    return blocks
+
+def bench_store():
+    print('BlockStore lookups (repr keys, deserialize on get vs. backends with LRU cache)')
+    blocks = make_chain(200, 20)
+    hashes = [b.sha256 for b in blocks]
+    old = ReprKeyStore()
+    for block in blocks:
+        old.add_block(block)
+    datadir = tempfile.TemporaryDirectory(prefix='bench')
+    print(' %-41s %13s %13s %9s' % ('200 blocks of 20 transactions', 'before', 'after', 'speedup'))
+    for backend in ('memory', 'sqlite'):
+        store = blockstore.BlockStore(datadir.name, backend)
+        for block in blocks:
+            store.add_block(block)
+        report('%s: existence check' % backend,
+               measure(lambda: [old.get(h) is not None for h in hashes], 3)/len(hashes),
+               measure(lambda: [store.contains(h) for h in hashes], 3)/len(hashes))
+        recent = hashes[-16:]
+        report('%s: get, 16 recent blocks' % backend,
+               measure(lambda: [old.get(h) for h in recent], 10)/len(recent),
+               measure(lambda: [store.get(h) for h in recent], 10)/len(recent))
+        store.close()
+    datadir.cleanup()
+
+def bench_getdata():
+    print('Answering a getdata for 500 blocks (get_blocks + msg_block vs. stored bytes)')
+    blocks = make_chain(500, 20)
+    inv = [mininode.CInv(2, b.sha256) for b in blocks]
+    old = ReprKeyStore()
+    store = blockstore.BlockStore(None, 'memory', cache_size=0)
+    for block in blocks:
+        old.add_block(block)
+        store.add_block(block)
+    # Just what NodeConn.build_message() needs
+    conn = types.SimpleNamespace(ver_send=209, network='regtest',
+                                 MAGIC_BYTES=mininode.NodeConn.MAGIC_BYTES)
+    magic = conn.MAGIC_BYTES['regtest']
+    def before():
+        return b''.join(message_frame(magic, b'block', mininode.msg_block(old.get(i.hash)).serialize())
+                        for i in inv)
+    def after():
+        frames = []
+        for message in store.get_block_messages(inv):
+            frames += mininode.NodeConn.build_message(conn, message)
+        return b''.join(frames)
+    assert before() == after()
+    print(' %-41s %13s %13s %9s' % ('', 'before', 'after', 'speedup'))
+    report('per block', measure(before, 3)/len(inv), measure(after, 3)/len(inv))
+
+
+#
+# Signature hashes
+#
+
+def bench_sighash():
+    print('Signature hashes of all inputs (SignatureHash per input vs. one SighashCache)')
+    random.seed(1)
+    print(' %-41s %13s %13s %9s' % ('', 'before', 'after', 'speedup'))
+    for name, branch in (('pre-Overwinter', 0), ('Sapling', 0x76b809bb)):
+        for count in (10, 100):
+            tx = mininode.CTransaction()
+            if branch == 0:
+                tx.fOverwintered = False
+                tx.nVersion = 1
+                tx.nVersionGroupId = 0
+            for n in range(count):
+                tx.vin.append(mininode.CTxIn(
+                    mininode.COutPoint(random.getrandbits(256), n), b'', 0xffffffff))
+            tx.vout.append(mininode.CTxOut(random.randrange(10**9), bytes(25)))
+            spent = [(script.CScript(bytes(25)), 10**8)] * count
+            def per_input():
+                return [script.SignatureHash(s, tx, n, script.SIGHASH_ALL, amount, branch)[0]
+                        for n, (s, amount) in enumerate(spent)]
+            def cached():
+                return script.signature_hashes(tx, spent, script.SIGHASH_ALL, branch)
+            assert per_input() == cached()
+            report('%s, %d inputs' % (name, count), measure(per_input, 3), measure(cached, 3))
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'framing': bench_framing,
+    'getdata': bench_getdata,
+    'memory': bench_memory,
+    'rpcdecode': bench_rpcdecode,
+    'serialize': bench_serialize,
+    'sighash': bench_sighash,
+    'store': bench_store,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Test framework micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -154,9 +154,9 @@ STAGE_COMMANDS = {
     'secp256k1': ['make', '-C', repofile('src/secp256k1'), 'check'],
     'libsnark': ['make', '-C', repofile('src'), 'libsnark-tests'],
     'univalue': ['make', '-C', repofile('src/univalue'), 'check'],
-    'rpc-common': [repofile('qa/pull-tester/rpc-tests.sh'), '--group=testScripts'],
-    'rpc-ext': [repofile('qa/pull-tester/rpc-tests.sh'), '--group=testScriptsExt'],
-    'rpc-mn': [repofile('qa/pull-tester/rpc-tests.sh'), '--group=testScriptsMN'],
+    'rpc-common': [repofile('qa/pull-tester/rpc-tests.py'), '--group=testScripts'],
+    'rpc-ext': [repofile('qa/pull-tester/rpc-tests.py'), '--group=testScriptsExt'],
+    'rpc-mn': [repofile('qa/pull-tester/rpc-tests.py'), '--group=testScriptsMN'],
 }
 
 